@@ -0,0 +1,21 @@
+import math
+import time
+
+
+def time_per_call(fn, iterations):
+	"""Return the mean wall time of `fn()` over `iterations` calls, in milliseconds"""
+	start = time.perf_counter()
+	for _ in range(iterations):
+		fn()
+
+	return (time.perf_counter() - start) * 1000 / iterations
+
+
+def percentile(samples, percent):
+	"""Return the nearest-rank `percent` percentile of `samples`"""
+	if not samples:
+		return 0
+
+	ordered = sorted(samples)
+	rank = max(math.ceil(percent / 100 * len(ordered)), 1)
+	return ordered[rank - 1]
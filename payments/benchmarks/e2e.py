@@ -0,0 +1,408 @@
+"""
+End-to-end payment flows against local stand-ins of the gateway APIs.
+
+	bench --site <site> execute payments.benchmarks.e2e.run --kwargs "{'iterations': 50, 'latency_ms': 20}"
+
+Every payment goes through the gateway's `get_payment_url`, the payment call of its
+checkout, the gateway callback and `on_payment_authorized` of the reference document, while
+all gateway requests are answered by `payments.tests.utils`. The result reports the
+throughput, p50/p95/p99 latency and database queries of a payment per gateway as sorted,
+rounded JSON, so that runs of different releases can be diffed.
+
+Only run it on a scratch site with `allow_tests` set: it overwrites the Razorpay, PayPal and
+Paytm settings with dummy credentials, and deletes the records it created once it is done.
+
+Injected errors count towards the circuit breakers of the gateways, so with a high
+`error_rate` the payments start failing fast once a circuit opens, as they would in
+production. The circuits are reset before and after every gateway.
+
+Razorpay, PayPal and Paytm pay a ToDo. GoCardless and Mpesa need an ERPNext Payment Request
+made through one of their gateways, passed as `gocardless_payment_request` and
+`mpesa_payment_request`, and are skipped without one.
+"""
+
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlsplit
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+from frappe.utils import flt
+
+from payments.benchmarks import percentile
+from payments.tests.utils import get_payment_callback_payload, random_id, run_standins
+from payments.utils import get_payment_gateway_controller
+from payments.utils.circuit_breaker import reset_circuit
+
+GATEWAYS = ("Razorpay", "PayPal", "Paytm", "GoCardless", "Mpesa")
+# records created by the flows, deleted once the run is over
+CREATED_DOCTYPES = (
+	"Integration Request",
+	"Error Log",
+	"GoCardless Mandate",
+	"Mpesa Payment Ledger",
+)
+
+
+class ScenarioUnavailable(Exception):
+	pass
+
+
+def run(
+	gateways=None,
+	iterations=20,
+	latency_ms=0,
+	error_rate=0.0,
+	seed=0,
+	gocardless_payment_request=None,
+	mpesa_payment_request=None,
+):
+	if not frappe.conf.allow_tests:
+		frappe.throw(_("The end-to-end benchmark only runs on sites with allow_tests set"))
+
+	gateways = gateways or GATEWAYS
+	payment_requests = {"GoCardless": gocardless_payment_request, "Mpesa": mpesa_payment_request}
+	result = {
+		"iterations": iterations,
+		"latency_ms": latency_ms,
+		"error_rate": error_rate,
+		"seed": seed,
+		"gateways": {},
+	}
+
+	reference = frappe.get_doc(
+		{"doctype": "ToDo", "description": "Payments end-to-end benchmark"}
+	).insert(ignore_permissions=True)
+	frappe.db.commit()
+
+	with track_created_records(CREATED_DOCTYPES) as created:
+		try:
+			with run_standins(gateways, latency_ms, seed=seed) as standins, count_authorizations() as calls:
+				for gateway in gateways:
+					standin = standins[gateway]
+					reset_circuit(gateway)
+					try:
+						pay = SCENARIOS[gateway](reference, payment_requests.get(gateway), standin)
+					except Exception as e:
+						frappe.db.rollback()
+						result["gateways"][gateway] = {"skipped": str(e) or repr(e)}
+						continue
+
+					# the setup calls always succeed, only the payments see injected errors
+					standin.error_rate = error_rate
+					result["gateways"][gateway] = measure(pay, iterations, standin, calls)
+					reset_circuit(gateway)
+		finally:
+			# only the records of the run, the site may be serving other payments meanwhile
+			for doctype, names in created.items():
+				frappe.db.delete(doctype, {"name": ("in", names)})
+			reference.delete(ignore_permissions=True)
+			frappe.db.commit()
+
+	return result
+
+
+def measure(pay, iterations, standin, authorizations):
+	"""Make `iterations` payments with `pay()` and summarize them"""
+	outcomes = {"completed": 0, "failed": 0, "errors": 0}
+	latencies, queries = [], []
+	gateway_requests = standin.request_count
+	started = time.perf_counter()
+
+	for _iteration in range(iterations):
+		authorized = authorizations["count"]
+		with count_queries() as query_count:
+			begin = time.perf_counter()
+			try:
+				pay()
+			except Exception:
+				outcome = "errors"
+				frappe.db.rollback()
+			else:
+				outcome = "completed" if authorizations["count"] > authorized else "failed"
+			latencies.append((time.perf_counter() - begin) * 1000)
+
+		outcomes[outcome] += 1
+		queries.append(query_count["count"])
+
+	elapsed = time.perf_counter() - started
+	return {
+		**outcomes,
+		"payments_per_second": round(iterations / elapsed, 2),
+		"latency_ms": {
+			"mean": round(sum(latencies) / iterations, 2),
+			"p50": round(percentile(latencies, 50), 2),
+			"p95": round(percentile(latencies, 95), 2),
+			"p99": round(percentile(latencies, 99), 2),
+		},
+		"queries_per_payment": {
+			"mean": round(sum(queries) / iterations, 2),
+			"max": max(queries),
+		},
+		"gateway_requests_per_payment": round(
+			(standin.request_count - gateway_requests) / iterations, 2
+		),
+	}
+
+
+def razorpay_scenario(reference, payment_request, standin):
+	from payments.templates.pages.razorpay_checkout import make_payment
+
+	# saving validates the credentials against the stand-in
+	update_settings("Razorpay Settings", api_key="rzp_test_benchmark", api_secret="benchmark")
+
+	def pay():
+		controller = get_payment_gateway_controller("Razorpay")
+		url = controller.get_payment_url(**get_payment_details(reference, "INR"))
+		make_payment(
+			razorpay_payment_id=f"pay_{random_id(14)}",
+			options="{}",
+			reference_doctype=reference.doctype,
+			reference_docname=reference.name,
+			token=get_query_param(url, "token"),
+		)
+
+	return pay
+
+
+def paypal_scenario(reference, payment_request, standin):
+	from payments.payment_gateways.doctype.paypal_settings.paypal_settings import (
+		confirm_payment,
+		get_express_checkout_details,
+	)
+
+	update_settings(
+		"PayPal Settings",
+		api_username="benchmark",
+		api_password="benchmark",
+		signature="benchmark",
+		paypal_sandbox=1,
+	)
+
+	def pay():
+		controller = get_payment_gateway_controller("PayPal")
+		url = controller.get_payment_url(**get_payment_details(reference, "USD"))
+		token = get_query_param(url, "token")
+
+		# the payer is sent back from paypal, then confirms the payment
+		get_express_checkout_details(token)
+		confirm_payment(token)
+
+	return pay
+
+
+def paytm_scenario(reference, payment_request, standin):
+	from paytmchecksum import generateSignature
+
+	from payments.payment_gateways.doctype.paytm_settings.paytm_settings import (
+		get_paytm_config,
+		get_paytm_params,
+		verify_transaction,
+	)
+
+	update_settings(
+		"Paytm Settings",
+		merchant_id="BENCHMARK",
+		merchant_key="benchmark_key_16",
+		staging=1,
+		website="WEBSTAGING",
+		industry_type_id="Retail",
+	)
+
+	def pay():
+		controller = get_payment_gateway_controller("Paytm")
+		url = controller.get_payment_url(**get_payment_details(reference, "INR"))
+		order_id = get_query_param(url, "order_id")
+
+		# the parameters rendered by the checkout page, then the callback paytm makes
+		config = get_paytm_config()
+		data = json.loads(frappe.db.get_value("Integration Request", order_id, "data"))
+		params = get_paytm_params(data, order_id, config)
+		callback = {
+			"MID": params["MID"],
+			"ORDERID": order_id,
+			"TXNID": random_id(14),
+			"TXNAMOUNT": params["TXN_AMOUNT"],
+			"CURRENCY": "INR",
+			"STATUS": "TXN_SUCCESS",
+			"RESPCODE": "01",
+			"RESPMSG": "Txn Success",
+		}
+		callback["CHECKSUMHASH"] = generateSignature(callback, config.merchant_key)
+		verify_transaction(**callback)
+
+	return pay
+
+
+def gocardless_scenario(reference, payment_request, standin):
+	from payments.payment_gateways.doctype.gocardless_settings.gocardless_settings import (
+		get_gateway_controller,
+	)
+	from payments.templates.pages.gocardless_checkout import check_mandate
+	from payments.templates.pages.gocardless_confirmation import confirm_payment
+
+	if not payment_request:
+		raise ScenarioUnavailable("needs gocardless_payment_request, an ERPNext Payment Request")
+
+	pr = frappe.get_doc("Payment Request", payment_request)
+	settings = frappe.get_doc("GoCardless Settings", get_gateway_controller(pr.name))
+	data = {
+		"amount": flt(pr.grand_total, pr.precision("grand_total")),
+		"title": pr.subject,
+		"description": pr.subject,
+		"reference_doctype": pr.doctype,
+		"reference_docname": pr.name,
+		"payer_email": pr.email_to or frappe.session.user,
+		"payer_name": frappe.db.get_value(pr.reference_doctype, pr.reference_name, "customer_name"),
+		"order_id": pr.name,
+		"currency": pr.currency,
+	}
+
+	def pay():
+		settings.get_payment_url(**data)
+
+		# the payer sets up a mandate on gocardless and is sent back to the confirmation page
+		redirect_to = check_mandate(json.dumps(data), pr.doctype, pr.name)["redirect_to"]
+		if redirect_to != "payment-failed":
+			confirm_payment(redirect_to.rsplit("/", 1)[-1], pr.doctype, pr.name)
+
+	return pay
+
+
+def mpesa_scenario(reference, payment_request, standin):
+	from payments.payment_gateways.doctype.mpesa_settings.mpesa_settings import verify_transaction
+
+	if not payment_request:
+		raise ScenarioUnavailable("needs mpesa_payment_request, an ERPNext Payment Request")
+
+	pr = frappe.get_doc("Payment Request", payment_request)
+	settings = frappe.get_doc(
+		"Mpesa Settings",
+		frappe.db.get_value("Payment Gateway", pr.payment_gateway, "gateway_controller"),
+	)
+
+	def pay():
+		issued = len(standin.issued_ids)
+		settings.request_for_payment(
+			reference_doctype=pr.doctype,
+			reference_docname=pr.name,
+			payment_reference=pr.reference_name,
+			request_amount=pr.grand_total,
+			sender="0700000000",
+			currency=pr.currency,
+			payment_gateway=pr.payment_gateway,
+		)
+
+		# safaricom calls back once per stk push of the split request
+		for checkout_id in standin.issued_ids[issued:]:
+			data = json.loads(frappe.db.get_value("Integration Request", checkout_id, "data"))
+			verify_transaction(
+				**get_payment_callback_payload(
+					Amount=data["request_amount"],
+					CheckoutRequestID=checkout_id,
+					MpesaReceiptNumber=random_id(10),
+				)
+			)
+
+	return pay
+
+
+SCENARIOS = {
+	"Razorpay": razorpay_scenario,
+	"PayPal": paypal_scenario,
+	"Paytm": paytm_scenario,
+	"GoCardless": gocardless_scenario,
+	"Mpesa": mpesa_scenario,
+}
+
+
+def update_settings(doctype, **values):
+	settings = frappe.get_single(doctype)
+	settings.update(values)
+	settings.save(ignore_permissions=True)
+	frappe.db.commit()
+
+
+def get_payment_details(reference, currency):
+	return {
+		"amount": 100,
+		"title": "Benchmark",
+		"description": "End-to-end benchmark payment",
+		"reference_doctype": reference.doctype,
+		"reference_docname": reference.name,
+		"payer_email": "payer@example.com",
+		"payer_name": "Benchmark Payer",
+		"order_id": reference.name,
+		"currency": currency,
+	}
+
+
+def get_query_param(url, key):
+	return parse_qs(urlsplit(url).query)[key][0]
+
+
+@contextmanager
+def count_authorizations():
+	"""Count the `on_payment_authorized` calls on reference documents in the block"""
+	authorizations = {"count": 0}
+	run_method = Document.run_method
+
+	def counting_run_method(self, method, *args, **kwargs):
+		if method == "on_payment_authorized":
+			authorizations["count"] += 1
+		return run_method(self, method, *args, **kwargs)
+
+	Document.run_method = counting_run_method
+	try:
+		yield authorizations
+	finally:
+		Document.run_method = run_method
+
+
+@contextmanager
+def track_created_records(doctypes):
+	"""Collect the names of the records of `doctypes` inserted in the block, by doctype"""
+	created = defaultdict(list)
+	db_insert = Document.db_insert
+	bulk_insert = frappe.db.bulk_insert
+
+	def tracking_db_insert(self, *args, **kwargs):
+		inserted = db_insert(self, *args, **kwargs)
+		if self.doctype in doctypes:
+			created[self.doctype].append(self.name)
+		return inserted
+
+	def tracking_bulk_insert(doctype, fields, values, *args, **kwargs):
+		values = list(values)
+		if doctype in doctypes and "name" in fields:
+			index = list(fields).index("name")
+			created[doctype].extend(row[index] for row in values)
+		return bulk_insert(doctype, fields, values, *args, **kwargs)
+
+	Document.db_insert = tracking_db_insert
+	frappe.db.bulk_insert = tracking_bulk_insert
+	try:
+		yield created
+	finally:
+		Document.db_insert = db_insert
+		del frappe.db.bulk_insert
+
+
+@contextmanager
+def count_queries():
+	"""Count the database queries made in the block"""
+	queries = {"count": 0}
+	sql = frappe.db.sql
+
+	def counting_sql(*args, **kwargs):
+		queries["count"] += 1
+		return sql(*args, **kwargs)
+
+	frappe.db.sql = counting_sql
+	try:
+		yield queries
+	finally:
+		del frappe.db.sql
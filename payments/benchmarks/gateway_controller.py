@@ -0,0 +1,34 @@
+"""
+Per-call cost of resolving a payment gateway controller, with and without the cache.
+
+	bench --site <site> execute payments.benchmarks.gateway_controller.run --kwargs "{'payment_gateway': 'Razorpay'}"
+"""
+
+import frappe
+
+from payments.benchmarks import time_per_call
+from payments.utils import clear_payment_gateway_controller_cache, get_payment_gateway_controller
+from payments.utils.utils import resolve_payment_gateway_settings
+
+
+def run(payment_gateway, iterations=1000):
+	def uncached():
+		frappe.get_doc(resolve_payment_gateway_settings(payment_gateway))
+
+	def cached():
+		get_payment_gateway_controller(payment_gateway)
+
+	def cached_across_requests():
+		# drop the request local layer, as a new request would
+		frappe.local.cache.pop(frappe.cache().make_key("payment_gateway_controller"), None)
+		get_payment_gateway_controller(payment_gateway)
+
+	clear_payment_gateway_controller_cache()
+	result = {
+		"payment_gateway": payment_gateway,
+		"iterations": iterations,
+		"uncached_ms_per_call": time_per_call(uncached, iterations),
+		"cached_ms_per_call": time_per_call(cached, iterations),
+		"cached_across_requests_ms_per_call": time_per_call(cached_across_requests, iterations),
+	}
+	return result
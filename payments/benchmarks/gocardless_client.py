@@ -0,0 +1,61 @@
+"""
+Latency and TLS handshakes of GoCardless API calls, with a new client per call as before
+and with the cached, pooled client of the settings record.
+
+	bench --site <site> execute payments.benchmarks.gocardless_client.run --kwargs "{'gateway_name': 'Sandbox'}"
+
+Every iteration resolves the client and makes one lightweight API call, as each step of
+a payment does. Use a sandbox account: the calls hit the GoCardless API.
+"""
+
+from contextlib import contextmanager
+
+import frappe
+import gocardless_pro
+from urllib3.connection import HTTPSConnection
+
+from payments.benchmarks import time_per_call
+from payments.payment_gateways.doctype.gocardless_settings.gocardless_settings import (
+	clear_gocardless_clients,
+	get_gocardless_client_stats,
+)
+
+
+def run(gateway_name, iterations=20):
+	settings = frappe.get_doc("GoCardless Settings", gateway_name)
+	environment = settings.get_environment()
+
+	def new_client_per_call():
+		client = gocardless_pro.Client(access_token=settings.access_token, environment=environment)
+		client.creditors.list(params={"limit": 1})
+
+	def cached_client():
+		settings.initialize_client().creditors.list(params={"limit": 1})
+
+	clear_gocardless_clients(gateway_name)
+	result = {"gateway_name": gateway_name, "iterations": iterations}
+
+	for label, fn in (("new_client_per_call", new_client_per_call), ("cached_client", cached_client)):
+		with count_handshakes() as handshakes:
+			result[f"{label}_ms_per_call"] = time_per_call(fn, iterations)
+		result[f"{label}_handshakes"] = handshakes["count"]
+
+	result["client_stats"] = get_gocardless_client_stats()
+	return result
+
+
+@contextmanager
+def count_handshakes():
+	"""Count the TLS connections opened in the block"""
+	handshakes = {"count": 0}
+	connect = HTTPSConnection.connect
+
+	def counting_connect(self):
+		handshakes["count"] += 1
+		return connect(self)
+
+	HTTPSConnection.connect = counting_connect
+	try:
+		yield handshakes
+	finally:
+		HTTPSConnection.connect = connect
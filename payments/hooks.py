@@ -100,13 +100,33 @@ override_doctype_class = {"Web Form": "payments.overrides.payment_webform.Paymen
 # ---------------
 # Hook on document methods and events
 
-# doc_events = {
-# 	"*": {
-# 		"on_update": "method",
-# 		"on_cancel": "method",
-# 		"on_trash": "method"
-# 	}
-# }
+doc_events = {
+	"Integration Request": {
+		"validate": "payments.utils.set_integration_request_gateway_fields",
+	},
+	**{
+		settings: {
+			"validate": "payments.utils.validate_not_from_controller_cache",
+			"on_update": [
+				"payments.utils.clear_payment_gateway_controller_cache",
+				"payments.utils.secrets.invalidate_secrets",
+			],
+			"on_trash": [
+				"payments.utils.clear_payment_gateway_controller_cache",
+				"payments.utils.secrets.invalidate_secrets",
+			],
+		}
+		for settings in (
+			"Braintree Settings",
+			"GoCardless Settings",
+			"Mpesa Settings",
+			"PayPal Settings",
+			"Paytm Settings",
+			"Razorpay Settings",
+			"Stripe Settings",
+		)
+	},
+}
 
 # Scheduled Tasks
 # ---------------
@@ -114,6 +134,16 @@ override_doctype_class = {"Web Form": "payments.overrides.payment_webform.Paymen
 scheduler_events = {
 	"all": [
 		"payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.capture_payment",
+		"payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.process_subscription_webhooks",
+		"payments.payment_gateways.doctype.paypal_settings.paypal_settings.process_ipn_notifications",
+		"payments.payment_gateways.doctype.braintree_settings.braintree_settings.refill_client_token_pools",
+		"payments.utils.metrics.update_gateway_metrics",
+	],
+	"hourly": [
+		"payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.reconcile_payments",
+	],
+	"daily": [
+		"payments.utils.archive.archive_integration_requests",
 	],
 }
 
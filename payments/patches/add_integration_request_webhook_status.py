@@ -0,0 +1,5 @@
+from payments.utils import make_integration_request_fields
+
+
+def execute():
+	make_integration_request_fields()
@@ -0,0 +1,16 @@
+import frappe
+
+from payments.utils import get_gateway_fields, iterate_in_pages, make_integration_request_fields
+
+
+def execute():
+	make_integration_request_fields()
+
+	for page in iterate_in_pages(
+		"Integration Request", filters={"data": ("!=", "")}, fields=["name", "data"], page_length=1000
+	):
+		for row in page:
+			if fields := get_gateway_fields(row.data):
+				frappe.db.set_value("Integration Request", row.name, fields, update_modified=False)
+
+		frappe.db.commit()
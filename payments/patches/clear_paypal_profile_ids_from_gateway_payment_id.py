@@ -0,0 +1,21 @@
+import frappe
+
+from payments.utils import get_gateway_fields, iterate_in_pages
+
+
+def execute():
+	"""PayPal recurring profile ids used to be stored as the payment id of their requests"""
+	for page in iterate_in_pages(
+		"Integration Request",
+		filters={"integration_request_service": "PayPal", "gateway_payment_id": ("!=", "")},
+		fields=["name", "data", "gateway_payment_id"],
+		page_length=1000,
+	):
+		for row in page:
+			payment_id = get_gateway_fields(row.data).get("gateway_payment_id")
+			if payment_id != row.gateway_payment_id:
+				frappe.db.set_value(
+					"Integration Request", row.name, "gateway_payment_id", payment_id, update_modified=False
+				)
+
+		frappe.db.commit()
@@ -1,6 +1,10 @@
 # Copyright (c) 2018, Frappe Technologies and contributors
 # License: MIT. See LICENSE
 
+import hashlib
+import json
+import threading
+import time
 from urllib.parse import urlencode
 
 import braintree
@@ -8,9 +12,22 @@ import frappe
 from frappe import _
 from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
-from frappe.utils import call_hook_method, get_url
+from frappe.utils import call_hook_method, cint, get_url
 
-from payments.utils import create_payment_gateway
+from payments.utils import create_payment_gateway, get_cache_counters, get_site_thread_pool
+from payments.utils.circuit_breaker import circuit_breaker
+from payments.utils.metrics import track_gateway_call
+from payments.utils.secrets import get_decrypted_secret
+
+# client tokens are generated ahead of checkouts by `refill_client_token_pools`, site config
+# `braintree_client_token_pool_size` and `braintree_client_token_ttl` (seconds) override these
+DEFAULT_CLIENT_TOKEN_POOL_SIZE = 20
+DEFAULT_CLIENT_TOKEN_TTL = 3600
+MAX_CLIENT_TOKEN_WORKERS = 8
+
+# (site, settings name) -> (credentials fingerprint, braintree.BraintreeGateway)
+_gateways = {}
+_lock = threading.Lock()
 
 
 class BraintreeSettings(Document):
@@ -154,9 +171,13 @@ class BraintreeSettings(Document):
 
 	def validate(self):
 		if not self.flags.ignore_mandatory:
-			self.configure_braintree()
+			# the key may not be saved yet, so it can't come from the secret cache
+			self.get_braintree_gateway(self.get_password(fieldname="private_key", raise_exception=False))
 
 	def on_update(self):
+		clear_braintree_gateway(self.name)
+		# tokens of the previous credentials can't be used anymore
+		clear_client_token_pool(self.name)
 		create_payment_gateway(
 			"Braintree-" + self.gateway_name,
 			settings="Braintree Settings",
@@ -164,18 +185,44 @@ class BraintreeSettings(Document):
 		)
 		call_hook_method("payment_gateway_enabled", gateway="Braintree-" + self.gateway_name)
 
-	def configure_braintree(self):
+	def get_braintree_gateway(self, private_key=None):
+		"""Return the cached `braintree.BraintreeGateway` of this merchant.
+
+		Unlike `braintree.Configuration.configure`, gateways don't touch any global state, so
+		requests for different merchants can run concurrently in the same process. A gateway
+		is rebuilt whenever the credentials it was built from change.
+		"""
 		if self.use_sandbox:
 			environment = "sandbox"
 		else:
 			environment = "production"
 
-		braintree.Configuration.configure(
-			environment=environment,
-			merchant_id=self.merchant_id,
-			public_key=self.public_key,
-			private_key=self.get_password(fieldname="private_key", raise_exception=False),
+		private_key = private_key or get_decrypted_secret(
+			self.doctype, self.name, "private_key", raise_exception=False
 		)
+		fingerprint = hashlib.sha256(
+			f"{environment}:{self.merchant_id}:{self.public_key}:{private_key}".encode()
+		).hexdigest()
+		key = (frappe.local.site, self.name)
+
+		with _lock:
+			cached = _gateways.get(key)
+			if cached and cached[0] == fingerprint:
+				return cached[1]
+
+		gateway = braintree.BraintreeGateway(
+			braintree.Configuration(
+				environment=environment,
+				merchant_id=self.merchant_id,
+				public_key=self.public_key,
+				private_key=private_key,
+			)
+		)
+
+		with _lock:
+			_gateways[key] = (fingerprint, gateway)
+
+		return gateway
 
 	def validate_transaction_currency(self, currency):
 		if currency not in self.supported_currencies:
@@ -208,18 +255,23 @@ class BraintreeSettings(Document):
 			}
 
 	def create_charge_on_braintree(self):
-		self.configure_braintree()
+		gateway = self.get_braintree_gateway()
 
 		redirect_to = self.data.get("redirect_to") or None
 		redirect_message = self.data.get("redirect_message") or None
 
-		result = braintree.Transaction.sale(
-			{
-				"amount": self.data.amount,
-				"payment_method_nonce": self.data.payload_nonce,
-				"options": {"submit_for_settlement": True},
-			}
-		)
+		# sandbox and production have a circuit each
+		breaker = circuit_breaker("Braintree", gateway.config.environment.server)
+		with breaker, track_gateway_call("Braintree", "Transaction.sale") as call:
+			result = gateway.transaction.sale(
+				{
+					"amount": self.data.amount,
+					"payment_method_nonce": self.data.payload_nonce,
+					"options": {"submit_for_settlement": True},
+				}
+			)
+			if not result.is_success:
+				call["outcome"] = "failure"
 
 		if result.is_success:
 			self.integration_request.db_set("status", "Completed", update_modified=False)
@@ -283,9 +335,98 @@ def get_gateway_controller(doc):
 	return gateway_controller
 
 
-def get_client_token(doc):
-	gateway_controller = get_gateway_controller(doc)
+def get_client_token(doc, gateway_controller=None):
+	gateway_controller = gateway_controller or get_gateway_controller(doc)
+	if token := pop_client_token(gateway_controller):
+		return token
+
+	record_client_token_stat(gateway_controller, "misses")
 	settings = frappe.get_doc("Braintree Settings", gateway_controller)
-	settings.configure_braintree()
 
-	return braintree.ClientToken.generate()
+	return generate_client_token(settings.get_braintree_gateway())
+
+
+def pop_client_token(name):
+	"""Take the oldest unexpired client token from the pool of a merchant"""
+	ttl = cint(frappe.conf.braintree_client_token_ttl) or DEFAULT_CLIENT_TOKEN_TTL
+
+	while entry := frappe.cache().lpop(get_client_token_pool_key(name)):
+		entry = json.loads(entry)
+		if time.time() - entry["created"] < ttl:
+			record_client_token_stat(name, "hits")
+			return entry["token"]
+
+		record_client_token_stat(name, "expired")
+
+
+def refill_client_token_pools():
+	"""Top up the client token pool of every Braintree merchant, runs from the scheduler"""
+	for name in frappe.get_all("Braintree Settings", pluck="name"):
+		try:
+			refill_client_token_pool(name)
+		except Exception:
+			frappe.log_error(title=f"Braintree client token pool refill failed for {name}")
+
+
+def refill_client_token_pool(name):
+	key = get_client_token_pool_key(name)
+	ttl = cint(frappe.conf.braintree_client_token_ttl) or DEFAULT_CLIENT_TOKEN_TTL
+	pool_size = cint(frappe.conf.braintree_client_token_pool_size) or DEFAULT_CLIENT_TOKEN_POOL_SIZE
+
+	# tokens are appended in the order they were generated, so expired ones are at the head
+	while oldest := frappe.cache().lrange(key, 0, 0):
+		if time.time() - json.loads(oldest[0])["created"] < ttl:
+			break
+
+		frappe.cache().lpop(key)
+		record_client_token_stat(name, "expired")
+
+	missing = pool_size - frappe.cache().llen(key)
+	if missing <= 0:
+		return
+
+	gateway = frappe.get_doc("Braintree Settings", name).get_braintree_gateway()
+	with get_site_thread_pool(min(missing, MAX_CLIENT_TOKEN_WORKERS)) as executor:
+		tokens = list(executor.map(lambda _: generate_client_token(gateway), range(missing)))
+
+	created = time.time()
+	for token in tokens:
+		frappe.cache().rpush(key, json.dumps({"token": token, "created": created}))
+
+
+def generate_client_token(gateway):
+	breaker = circuit_breaker("Braintree", gateway.config.environment.server)
+	with breaker, track_gateway_call("Braintree", "ClientToken.generate"):
+		return gateway.client_token.generate()
+
+
+def clear_client_token_pool(name):
+	frappe.cache().delete_value(get_client_token_pool_key(name))
+
+
+def get_client_token_pool_key(name):
+	return f"braintree_client_tokens:{name}"
+
+
+def record_client_token_stat(name, stat):
+	frappe.cache().hincrby(frappe.cache().make_key(f"braintree_client_token_stats:{name}"), stat, 1)
+
+
+def get_client_token_pool_stats(name):
+	"""Return the size of the client token pool of a merchant and how it served checkouts"""
+	stats = get_cache_counters(f"braintree_client_token_stats:{name}")
+	stats = {stat: cint(value) for stat, value in stats.items()}
+	hits, misses = stats.get("hits", 0), stats.get("misses", 0)
+
+	return {
+		"size": frappe.cache().llen(get_client_token_pool_key(name)),
+		"hits": hits,
+		"misses": misses,
+		"expired": stats.get("expired", 0),
+		"hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+	}
+
+
+def clear_braintree_gateway(name):
+	with _lock:
+		_gateways.pop((frappe.local.site, name), None)
@@ -7,6 +7,16 @@ import hmac
 import json
 
 import frappe
+from frappe.utils import cint, now_datetime
+
+from payments.utils.webhooks import claim_webhook_event, release_webhook_event
+
+
+# mandate actions after which the mandate can still be used
+ACTIVE_MANDATE_ACTIONS = ("pending_customer_approval", "pending_submission", "submitted", "active")
+
+# larger batches are processed by a background job
+DEFAULT_INLINE_EVENTS = 50
 
 
 @frappe.whitelist(allow_guest=True)
@@ -19,39 +29,75 @@ def webhooks():
 		raise frappe.AuthenticationError
 
 	gocardless_events = json.loads(r.get_data()) or []
-	for event in gocardless_events["events"]:
-		set_status(event)
+	# retried deliveries are dropped before anything is written
+	events = [
+		event
+		for event in gocardless_events["events"]
+		if claim_webhook_event("GoCardless", event.get("id"))
+	]
+	if not events:
+		return 200
+
+	if len(events) > (cint(frappe.conf.gocardless_webhook_inline_events) or DEFAULT_INLINE_EVENTS):
+		try:
+			frappe.enqueue(
+				"payments.payment_gateways.doctype.gocardless_settings.process_events",
+				queue="short",
+				events=events,
+			)
+		except Exception:
+			for event in events:
+				release_webhook_event("GoCardless", event.get("id"))
+			raise
+	else:
+		process_events(events)
 
 	return 200
 
 
-def set_status(event):
-	resource_type = event.get("resource_type", {})
+def process_events(events):
+	"""Apply the latest action of every mandate in `events`, one UPDATE per disabled value"""
+	mandates_by_status = {0: [], 1: []}
+	for mandate, disabled in get_latest_mandate_statuses(events).items():
+		mandates_by_status[disabled].append(mandate)
+
+	GoCardlessMandate = frappe.qb.DocType("GoCardless Mandate")
+	try:
+		for disabled, mandates in mandates_by_status.items():
+			if mandates:
+				frappe.qb.update(GoCardlessMandate).set(GoCardlessMandate.disabled, disabled).set(
+					GoCardlessMandate.modified, now_datetime()
+				).where(GoCardlessMandate.name.isin(mandates)).run()
+	except Exception:
+		# let the retry of GoCardless process these events again
+		for event in events:
+			release_webhook_event("GoCardless", event.get("id"))
+		raise
 
-	if resource_type == "mandates":
-		set_mandate_status(event)
 
+def get_latest_mandate_statuses(events):
+	"""Return the `disabled` value of every mandate as set by its most recent event"""
+	latest = {}
+	for event in events:
+		if event.get("resource_type") != "mandates":
+			continue
 
-def set_mandate_status(event):
-	mandates = []
+		disabled = 0 if event["action"] in ACTIVE_MANDATE_ACTIONS else 1
+		created_at = event.get("created_at") or ""
+
+		for mandate in get_mandates(event):
+			# ISO 8601 timestamps sort chronologically, ties keep the order of the batch
+			if mandate not in latest or created_at >= latest[mandate][0]:
+				latest[mandate] = (created_at, disabled)
+
+	return {mandate: disabled for mandate, (created_at, disabled) in latest.items()}
+
+
+def get_mandates(event):
 	if isinstance(event["links"], (list,)):
-		for link in event["links"]:
-			mandates.append(link["mandate"])
-	else:
-		mandates.append(event["links"]["mandate"])
-
-	if (
-		event["action"] == "pending_customer_approval"
-		or event["action"] == "pending_submission"
-		or event["action"] == "submitted"
-		or event["action"] == "active"
-	):
-		disabled = 0
-	else:
-		disabled = 1
+		return [link["mandate"] for link in event["links"]]
 
-	for mandate in mandates:
-		frappe.db.set_value("GoCardless Mandate", mandate, "disabled", disabled)
+	return [event["links"]["mandate"]]
 
 
 def authenticate_signature(r):
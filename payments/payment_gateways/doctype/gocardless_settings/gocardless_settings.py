@@ -2,6 +2,10 @@
 # For license information, please see license.txt
 
 
+import hashlib
+import json
+import os
+import threading
 from urllib.parse import urlencode
 
 import frappe
@@ -10,6 +14,15 @@ from frappe import _
 from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
 from frappe.utils import call_hook_method, cint, flt, get_url
+from gocardless_pro.api_client import ApiClient
+
+from payments.utils.http_client import send_request
+
+# (site, settings name, access token hash, environment) -> gocardless_pro.Client
+_clients = {}
+_client_stats = {"constructed": 0, "reused": 0}
+_pid = os.getpid()
+_lock = threading.Lock()
 
 
 class GoCardlessSettings(Document):
@@ -21,9 +34,7 @@ class GoCardlessSettings(Document):
 	def initialize_client(self):
 		self.environment = self.get_environment()
 		try:
-			self.client = gocardless_pro.Client(
-				access_token=self.access_token, environment=self.environment
-			)
+			self.client = get_gocardless_client(self.name, self.access_token, self.environment)
 			return self.client
 		except Exception as e:
 			frappe.throw(e)
@@ -31,6 +42,8 @@ class GoCardlessSettings(Document):
 	def on_update(self):
 		from payments.utils import create_payment_gateway
 
+		clear_gocardless_clients(self.name)
+
 		create_payment_gateway(
 			"GoCardless-" + self.gateway_name, settings="GoCardless Settings", controller=self.gateway_name
 		)
@@ -215,3 +228,82 @@ def gocardless_initialization(doc):
 	settings = frappe.get_doc("GoCardless Settings", gateway_controller)
 	client = settings.initialize_client()
 	return client
+
+
+class PooledApiClient(ApiClient):
+	"""`ApiClient` sending its requests over the pooled sessions of `payments.utils.http_client`"""
+
+	def get(self, path, params=None, headers=None):
+		return self.send("GET", path, params=params, headers=self._headers(headers))
+
+	def post(self, path, body, headers=None):
+		return self.send("POST", path, data=json.dumps(body), headers=self._headers(headers))
+
+	def put(self, path, body, headers=None):
+		return self.send("PUT", path, data=json.dumps(body), headers=self._headers(headers))
+
+	def delete(self, path, body, headers=None):
+		return self.send("DELETE", path, data=json.dumps(body), headers=self._headers(headers))
+
+	def send(self, method, path, **kwargs):
+		response = send_request(
+			method,
+			self._url_for(path),
+			gateway="GoCardless",
+			operation=get_operation(method, path),
+			**kwargs,
+		)
+		self._handle_errors(response)
+		return response
+
+
+def get_operation(method, path):
+	"""Name an API call after its resource and action, e.g. `payments.create`"""
+	segments = path.strip("/").split("/")
+	if "actions" in segments:
+		return f"{segments[0]}.{segments[-1]}"
+
+	actions = {"GET": "list" if len(segments) == 1 else "get", "POST": "create", "PUT": "update"}
+	return f"{segments[0]}.{actions.get(method, method.lower())}"
+
+
+def get_gocardless_client(name, access_token, environment):
+	"""Return the `gocardless_pro.Client` of a settings record, built once per process.
+
+	Clients are keyed by a hash of the access token, so a new token gets a new client.
+	"""
+	global _pid
+
+	token_hash = hashlib.sha256((access_token or "").encode()).hexdigest()
+	key = (frappe.local.site, name, token_hash, environment)
+
+	with _lock:
+		if _pid != os.getpid():
+			_clients.clear()
+			_pid = os.getpid()
+
+		client = _clients.get(key)
+		if client:
+			_client_stats["reused"] += 1
+			return client
+
+		client = gocardless_pro.Client(access_token=access_token, environment=environment)
+		# the stock api client opens a new connection for every request
+		client._api_client = PooledApiClient(client._api_client.base_url, access_token)
+
+		_clients[key] = client
+		_client_stats["constructed"] += 1
+
+	return client
+
+
+def clear_gocardless_clients(name):
+	with _lock:
+		for key in [key for key in _clients if key[:2] == (frappe.local.site, name)]:
+			del _clients[key]
+
+
+def get_gocardless_client_stats():
+	"""Return how many clients this process constructed and how often they were reused"""
+	with _lock:
+		return dict(_client_stats)
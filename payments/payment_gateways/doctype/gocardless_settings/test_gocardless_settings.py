@@ -3,6 +3,36 @@
 
 import unittest
 
+from payments.payment_gateways.doctype.gocardless_settings import get_latest_mandate_statuses
+
 
 class TestGoCardlessSettings(unittest.TestCase):
-	pass
+	def test_latest_action_per_mandate_wins(self):
+		events = [
+			{
+				"resource_type": "mandates",
+				"action": "cancelled",
+				"created_at": "2024-01-02T10:00:00.000Z",
+				"links": {"mandate": "MD1"},
+			},
+			{
+				"resource_type": "mandates",
+				"action": "active",
+				"created_at": "2024-01-01T10:00:00.000Z",
+				"links": {"mandate": "MD1"},
+			},
+			{
+				"resource_type": "mandates",
+				"action": "submitted",
+				"created_at": "2024-01-01T10:00:00.000Z",
+				"links": {"mandate": "MD2"},
+			},
+			{
+				"resource_type": "payments",
+				"action": "failed",
+				"created_at": "2024-01-03T10:00:00.000Z",
+				"links": {"mandate": "MD2"},
+			},
+		]
+
+		self.assertEqual(get_latest_mandate_statuses(events), {"MD1": 1, "MD2": 0})
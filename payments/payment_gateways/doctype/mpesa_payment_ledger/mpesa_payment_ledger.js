@@ -0,0 +1,5 @@
+// Copyright (c) 2026, Frappe Technologies and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Mpesa Payment Ledger', {
+});
@@ -0,0 +1,61 @@
+# Copyright (c) 2026, Frappe Technologies and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import flt
+
+
+class MpesaPaymentLedger(Document):
+	"""Running total of the Mpesa payments received against a reference document."""
+
+	def autoname(self):
+		self.name = get_ledger_name(self.reference_doctype, self.reference_docname)
+
+	def get_checkout_ids(self):
+		return (self.checkout_ids or "").split()
+
+	def add_payment(self, checkout_id, amount, mpesa_receipt):
+		"""Add a completed payment, repeated callbacks for the same checkout are counted once"""
+		checkout_ids = self.get_checkout_ids()
+		if checkout_id not in checkout_ids:
+			self.paid_amount = flt(self.paid_amount) + flt(amount)
+			self.mpesa_receipts = ", ".join(filter(None, [self.mpesa_receipts, mpesa_receipt]))
+			self.checkout_ids = "\n".join(checkout_ids + [checkout_id])
+
+		self.last_checkout_id = checkout_id
+
+
+def get_ledger_name(reference_doctype, reference_docname):
+	return f"{reference_doctype}-{reference_docname}"
+
+
+def get_payment_ledger(reference_doctype, reference_docname):
+	"""Return the ledger of a reference document locked for update.
+
+	A missing ledger is built from the completed Integration Requests of the reference, so
+	that payments made before the ledger existed are still accounted for.
+	"""
+	from payments.payment_gateways.doctype.mpesa_settings.mpesa_settings import (
+		get_completed_mpesa_payments,
+	)
+
+	name = get_ledger_name(reference_doctype, reference_docname)
+
+	if not frappe.db.exists("Mpesa Payment Ledger", name):
+		ledger = frappe.new_doc("Mpesa Payment Ledger")
+		ledger.reference_doctype = reference_doctype
+		ledger.reference_docname = reference_docname
+
+		for checkout_id, amount, mpesa_receipt in get_completed_mpesa_payments(
+			reference_doctype, reference_docname
+		):
+			ledger.add_payment(checkout_id, amount, mpesa_receipt)
+
+		try:
+			ledger.insert(ignore_permissions=True)
+		except frappe.DuplicateEntryError:
+			# created by a concurrent callback for the same reference
+			pass
+
+	return frappe.get_doc("Mpesa Payment Ledger", name, for_update=True)
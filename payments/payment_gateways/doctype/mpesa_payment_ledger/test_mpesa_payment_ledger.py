@@ -0,0 +1,18 @@
+# Copyright (c) 2026, Frappe Technologies and Contributors
+# See license.txt
+
+import unittest
+
+import frappe
+
+
+class TestMpesaPaymentLedger(unittest.TestCase):
+	def test_repeated_callback_is_counted_once(self):
+		ledger = frappe.new_doc("Mpesa Payment Ledger")
+		ledger.add_payment("ws_CO_1", 150, "LGR7OWQX0R")
+		ledger.add_payment("ws_CO_2", 30, "LGR7OWQX0S")
+		ledger.add_payment("ws_CO_1", 150, "LGR7OWQX0R")
+
+		self.assertEqual(ledger.paid_amount, 180)
+		self.assertEqual(ledger.mpesa_receipts, "LGR7OWQX0R, LGR7OWQX0S")
+		self.assertEqual(ledger.last_checkout_id, "ws_CO_1")
@@ -1,9 +1,19 @@
 import base64
 import datetime
+import hashlib
+from contextlib import contextmanager
 
-import requests
+import frappe
+from frappe.utils import cint
 from requests.auth import HTTPBasicAuth
 
+from payments.utils.async_http_client import async_send_request
+from payments.utils.http_client import send_request
+
+# refresh cached access tokens this many seconds before Safaricom expires them
+TOKEN_EXPIRY_MARGIN = 60
+TOKEN_LOCK_TIMEOUT = 30
+
 
 class MpesaConnector:
 	def __init__(
@@ -28,14 +38,62 @@ class MpesaConnector:
 		"""
 		This method is used to fetch the access token required by Mpesa.
 
+		Tokens are shared through Redis per consumer key and environment until shortly before
+		they expire. Only one process at a time refreshes an expired token, the others wait
+		for it and reuse the new one.
+
 		Returns:
 		        access_token (str): This token is to be used with the Bearer header for further API calls to Mpesa.
 		"""
-		authenticate_uri = "/oauth/v1/generate?grant_type=client_credentials"
-		authenticate_url = f"{self.base_url}{authenticate_uri}"
-		r = requests.get(authenticate_url, auth=HTTPBasicAuth(self.app_key, self.app_secret))
-		self.authentication_token = r.json()["access_token"]
-		return r.json()["access_token"]
+		cache_key = self.get_token_cache_key()
+		token = frappe.cache().get_value(cache_key, expires=True)
+
+		if not token:
+			with self.lock_token_refresh(cache_key):
+				# another process may have refreshed the token while we waited for the lock
+				token = frappe.cache().get_value(cache_key, expires=True) or self.fetch_access_token(cache_key)
+
+		self.authentication_token = token
+		return token
+
+	def fetch_access_token(self, cache_key):
+		r = send_request(
+			"GET",
+			self.get_authenticate_url(),
+			auth=HTTPBasicAuth(self.app_key, self.app_secret),
+			gateway="Mpesa",
+			operation="generate_token",
+		)
+		return self.cache_access_token(cache_key, r.json())
+
+	def get_authenticate_url(self):
+		return f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
+
+	@contextmanager
+	def lock_token_refresh(self, cache_key):
+		lock = frappe.cache().lock(
+			frappe.cache().make_key(f"{cache_key}:lock"),
+			timeout=TOKEN_LOCK_TIMEOUT,
+			blocking_timeout=TOKEN_LOCK_TIMEOUT,
+		)
+		locked = lock.acquire()
+		try:
+			yield
+		finally:
+			if locked:
+				lock.release()
+
+	def cache_access_token(self, cache_key, response):
+		expires_in = cint(response.get("expires_in")) - TOKEN_EXPIRY_MARGIN
+		if expires_in > 0:
+			frappe.cache().set_value(cache_key, response["access_token"], expires_in_sec=expires_in)
+
+		return response["access_token"]
+
+	def get_token_cache_key(self):
+		# the secret is part of the key so that rotated credentials never reuse an old token
+		credentials = hashlib.sha256(f"{self.app_key}:{self.app_secret}".encode()).hexdigest()
+		return f"mpesa_access_token:{self.env}:{credentials}"
 
 	def get_balance(
 		self,
@@ -66,7 +124,36 @@ class MpesaConnector:
 		        ResponseDescription (str): Response Description message
 		"""
 
-		payload = {
+		payload = self.get_balance_payload(
+			initiator=initiator,
+			security_credential=security_credential,
+			party_a=party_a,
+			identifier_type=identifier_type,
+			remarks=remarks,
+			queue_timeout_url=queue_timeout_url,
+			result_url=result_url,
+		)
+		r = send_request(
+			"POST",
+			self.get_balance_url(),
+			headers=self.get_headers(),
+			json=payload,
+			gateway="Mpesa",
+			operation="account_balance",
+		)
+		return r.json()
+
+	def get_balance_payload(
+		self,
+		initiator=None,
+		security_credential=None,
+		party_a=None,
+		identifier_type=None,
+		remarks=None,
+		queue_timeout_url=None,
+		result_url=None,
+	):
+		return {
 			"Initiator": initiator,
 			"SecurityCredential": security_credential,
 			"CommandID": "AccountBalance",
@@ -76,13 +163,15 @@ class MpesaConnector:
 			"QueueTimeOutURL": queue_timeout_url,
 			"ResultURL": result_url,
 		}
-		headers = {
+
+	def get_balance_url(self):
+		return "{}{}".format(self.base_url, "/mpesa/accountbalance/v1/query")
+
+	def get_headers(self):
+		return {
 			"Authorization": f"Bearer {self.authentication_token}",
 			"Content-Type": "application/json",
 		}
-		saf_url = "{}{}".format(self.base_url, "/mpesa/accountbalance/v1/query")
-		r = requests.post(saf_url, headers=headers, json=payload)
-		return r.json()
 
 	def stk_push(
 		self,
@@ -119,12 +208,41 @@ class MpesaConnector:
 		        errorMessage(str): This is a predefined code that indicates the reason for request failure.
 		"""
 
+		payload = self.get_stk_push_payload(
+			business_shortcode=business_shortcode,
+			passcode=passcode,
+			amount=amount,
+			callback_url=callback_url,
+			reference_code=reference_code,
+			phone_number=phone_number,
+			description=description,
+		)
+		r = send_request(
+			"POST",
+			self.get_stk_push_url(),
+			headers=self.get_headers(),
+			json=payload,
+			gateway="Mpesa",
+			operation="stk_push",
+		)
+		return r.json()
+
+	def get_stk_push_payload(
+		self,
+		business_shortcode=None,
+		passcode=None,
+		amount=None,
+		callback_url=None,
+		reference_code=None,
+		phone_number=None,
+		description=None,
+	):
 		time = (
 			str(datetime.datetime.now()).split(".")[0].replace("-", "").replace(" ", "").replace(":", "")
 		)
 		password = f"{str(business_shortcode)}{str(passcode)}{time}"
 		encoded = base64.b64encode(bytes(password, encoding="utf8"))
-		payload = {
+		return {
 			"BusinessShortCode": business_shortcode,
 			"Password": encoded.decode("utf-8"),
 			"Timestamp": time,
@@ -139,11 +257,77 @@ class MpesaConnector:
 			if self.env == "sandbox"
 			else "CustomerBuyGoodsOnline",
 		}
-		headers = {
-			"Authorization": f"Bearer {self.authentication_token}",
-			"Content-Type": "application/json",
-		}
 
-		saf_url = "{}{}".format(self.base_url, "/mpesa/stkpush/v1/processrequest")
-		r = requests.post(saf_url, headers=headers, json=payload)
+	def get_stk_push_url(self):
+		return "{}{}".format(self.base_url, "/mpesa/stkpush/v1/processrequest")
+
+
+class AsyncMpesaConnector(MpesaConnector):
+	"""asyncio counterpart of `MpesaConnector`, over `payments.utils.async_http_client`.
+
+	The access token is not fetched on init: await `authenticate` once before making calls,
+	which can then run concurrently on the token it cached.
+	"""
+
+	def __init__(
+		self,
+		env="sandbox",
+		app_key=None,
+		app_secret=None,
+		sandbox_url="https://sandbox.safaricom.co.ke",
+		live_url="https://api.safaricom.co.ke",
+	):
+		self.env = env
+		self.app_key = app_key
+		self.app_secret = app_secret
+		self.base_url = sandbox_url if env == "sandbox" else live_url
+		self.authentication_token = None
+
+	async def authenticate(self):
+		"""See `MpesaConnector.authenticate`"""
+		cache_key = self.get_token_cache_key()
+		token = frappe.cache().get_value(cache_key, expires=True)
+
+		if not token:
+			with self.lock_token_refresh(cache_key):
+				# another process may have refreshed the token while we waited for the lock
+				token = frappe.cache().get_value(cache_key, expires=True)
+				if not token:
+					token = await self.fetch_access_token(cache_key)
+
+		self.authentication_token = token
+		return token
+
+	async def fetch_access_token(self, cache_key):
+		r = await async_send_request(
+			"GET",
+			self.get_authenticate_url(),
+			auth=(self.app_key, self.app_secret),
+			gateway="Mpesa",
+			operation="generate_token",
+		)
+		return self.cache_access_token(cache_key, r.json())
+
+	async def get_balance(self, **kwargs):
+		"""See `MpesaConnector.get_balance`"""
+		r = await async_send_request(
+			"POST",
+			self.get_balance_url(),
+			headers=self.get_headers(),
+			json=self.get_balance_payload(**kwargs),
+			gateway="Mpesa",
+			operation="account_balance",
+		)
+		return r.json()
+
+	async def stk_push(self, **kwargs):
+		"""See `MpesaConnector.stk_push`"""
+		r = await async_send_request(
+			"POST",
+			self.get_stk_push_url(),
+			headers=self.get_headers(),
+			json=self.get_stk_push_payload(**kwargs),
+			gateway="Mpesa",
+			operation="stk_push",
+		)
 		return r.json()
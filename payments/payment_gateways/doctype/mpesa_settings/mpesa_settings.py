@@ -2,19 +2,36 @@
 # For license information, please see license.txt
 
 
+import asyncio
 from json import dumps, loads
 
 import frappe
 from frappe import _
 from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
-from frappe.utils import call_hook_method, fmt_money, get_request_site_address
+from frappe.utils import call_hook_method, fmt_money, get_datetime, get_request_site_address
 
-from payments.payment_gateways.doctype.mpesa_settings.mpesa_connector import MpesaConnector
+from payments.payment_gateways.doctype.mpesa_payment_ledger.mpesa_payment_ledger import (
+	get_payment_ledger,
+)
+from payments.payment_gateways.doctype.mpesa_settings.mpesa_connector import (
+	AsyncMpesaConnector,
+	MpesaConnector,
+)
 from payments.payment_gateways.doctype.mpesa_settings.mpesa_custom_fields import (
 	create_custom_pos_fields,
 )
-from payments.utils import erpnext_app_import_guard
+from payments.utils import (
+	bulk_create_request_logs,
+	erpnext_app_import_guard,
+	get_site_thread_pool,
+)
+from payments.utils.archive import get_archived_integration_requests, get_integration_request
+from payments.utils.async_http_client import async_client, gather_bounded, use_async_transport
+from payments.utils.circuit_breaker import GatewayUnavailableError
+from payments.utils.secrets import get_decrypted_secret
+
+MAX_STK_PUSH_WORKERS = 8
 
 
 class MpesaSettings(Document):
@@ -50,19 +67,25 @@ class MpesaSettings(Document):
 	def request_for_payment(self, **kwargs):
 		args = frappe._dict(kwargs)
 		request_amounts = self.split_request_amount_according_to_transaction_limit(args)
+		request_dicts = [frappe._dict(args, request_amount=amount) for amount in request_amounts]
 
-		for i, amount in enumerate(request_amounts):
-			args.request_amount = amount
-			if frappe.flags.in_test:
-				from payments.payment_gateways.doctype.mpesa_settings.test_mpesa_settings import (
-					get_payment_request_response_payload,
-				)
-
-				response = frappe._dict(get_payment_request_response_payload(amount))
-			else:
-				response = frappe._dict(generate_stk_push(**args))
+		if frappe.flags.in_test:
+			from payments.payment_gateways.doctype.mpesa_settings.test_mpesa_settings import (
+				get_payment_request_response_payload,
+			)
 
-			self.handle_api_response("CheckoutRequestID", args, response)
+			responses = [get_payment_request_response_payload(amount) for amount in request_amounts]
+		else:
+			responses = generate_stk_pushes(self, request_dicts)
+
+		self.handle_api_responses(
+			"CheckoutRequestID",
+			request_dicts,
+			[
+				response if isinstance(response, Exception) else frappe._dict(response)
+				for response in responses
+			],
+		)
 
 	def split_request_amount_according_to_transaction_limit(self, args):
 		request_amount = args.request_amount
@@ -118,43 +141,113 @@ class MpesaSettings(Document):
 		if error:
 			frappe.throw(_(getattr(response, "errorMessage")), title=_("Transaction Error"))
 
+	def handle_api_responses(self, global_id, request_dicts, responses):
+		"""Log the responses of a split request in one insert, then report the first error.
+
+		`responses` may hold the exception of a push that got no answer in place of its
+		response. The pushes that went through are logged first either way, so that their
+		callbacks find their Integration Request.
+		"""
+		logs, errors, failures = [], [], []
+		for request_dict, response in zip(request_dicts, responses):
+			if isinstance(response, Exception):
+				failures.append(response)
+			elif getattr(response, "requestId"):
+				errors.append(response)
+				logs.append(dict(data=request_dict, name=response.requestId, error=response))
+			else:
+				logs.append(dict(data=request_dict, name=getattr(response, global_id)))
+
+		existing = frappe.get_all(
+			"Integration Request", filters={"name": ("in", [log["name"] for log in logs])}, pluck="name"
+		)
+		bulk_create_request_logs(
+			[log for log in logs if log["name"] not in existing], "Mpesa", integration_type="Host"
+		)
+		frappe.db.commit()  # nosemgrep
+
+		if failures:
+			raise_stk_push_error(failures[0])
+
+		if errors:
+			frappe.throw(_(getattr(errors[0], "errorMessage")), title=_("Transaction Error"))
+
 
 def generate_stk_push(**kwargs):
 	"""Generate stk push by making a API call to the stk push API."""
 	args = frappe._dict(kwargs)
+	mpesa_settings = frappe.get_doc("Mpesa Settings", args.payment_gateway[6:])
+	response = generate_stk_pushes(mpesa_settings, [args])[0]
+	if isinstance(response, Exception):
+		raise_stk_push_error(response)
+
+	return response
+
+
+def generate_stk_pushes(mpesa_settings, request_dicts):
+	"""Send one stk push per request concurrently, sharing a single connector and settings.
+
+	Returns the response of every push in order, or the exception raised by a push that
+	failed, so that the pushes that did reach Safaricom can still be logged.
+	"""
 	try:
 		callback_url = (
 			get_request_site_address(True)
 			+ "/api/method/payments.payment_gateways.doctype.mpesa_settings.mpesa_settings.verify_transaction"
 		)
 
-		mpesa_settings = frappe.get_doc("Mpesa Settings", args.payment_gateway[6:])
 		env = "production" if not mpesa_settings.sandbox else "sandbox"
 		# for sandbox, business shortcode is same as till number
 		business_shortcode = (
 			mpesa_settings.business_shortcode if env == "production" else mpesa_settings.till_number
 		)
 
-		connector = MpesaConnector(
+		connector_args = dict(
 			env=env,
 			app_key=mpesa_settings.consumer_key,
-			app_secret=mpesa_settings.get_password("consumer_secret"),
+			app_secret=get_decrypted_secret("Mpesa Settings", mpesa_settings.name, "consumer_secret"),
 		)
+		passcode = get_decrypted_secret("Mpesa Settings", mpesa_settings.name, "online_passkey")
+
+		def get_stk_push_args(args):
+			return dict(
+				business_shortcode=business_shortcode,
+				amount=args.request_amount,
+				passcode=passcode,
+				callback_url=callback_url,
+				reference_code=mpesa_settings.till_number,
+				phone_number=sanitize_mobile_number(args.sender),
+				description="POS Payment",
+			)
 
-		mobile_number = sanitize_mobile_number(args.sender)
+		if len(request_dicts) > 1 and use_async_transport():
+			return asyncio.run(
+				generate_stk_pushes_async(connector_args, [get_stk_push_args(args) for args in request_dicts])
+			)
 
-		response = connector.stk_push(
-			business_shortcode=business_shortcode,
-			amount=args.request_amount,
-			passcode=mpesa_settings.get_password("online_passkey"),
-			callback_url=callback_url,
-			reference_code=mpesa_settings.till_number,
-			phone_number=mobile_number,
-			description="POS Payment",
-		)
+		connector = MpesaConnector(**connector_args)
+
+		def stk_push(args):
+			return connector.stk_push(**get_stk_push_args(args))
+
+		if len(request_dicts) == 1:
+			return [stk_push(request_dicts[0])]
+
+		with get_site_thread_pool(min(len(request_dicts), MAX_STK_PUSH_WORKERS)) as executor:
+			futures = [executor.submit(stk_push, args) for args in request_dicts]
+
+		return [future.exception() or future.result() for future in futures]
+
+	except Exception as e:
+		raise_stk_push_error(e)
 
-		return response
 
+def raise_stk_push_error(exception):
+	"""Log a failed stk push and report it to the user"""
+	try:
+		raise exception
+	except GatewayUnavailableError:
+		raise
 	except Exception:
 		frappe.log_error("Mpesa Express Transaction Error")
 		frappe.throw(
@@ -163,6 +256,16 @@ def generate_stk_push(**kwargs):
 		)
 
 
+async def generate_stk_pushes_async(connector_args, stk_pushes):
+	"""Send the stk pushes concurrently on the running event loop, see `generate_stk_pushes`"""
+	connector = AsyncMpesaConnector(**connector_args)
+
+	async with async_client():
+		await connector.authenticate()
+		# failed pushes are returned as their exception, like with the thread pool
+		return await gather_bounded(connector.stk_push(**args) for args in stk_pushes)
+
+
 def sanitize_mobile_number(number):
 	"""Add country code and strip leading zeroes from the phone number."""
 	return "254" + str(number).lstrip("0")
@@ -177,13 +280,15 @@ def verify_transaction(**kwargs):
 	if not isinstance(checkout_id, str):
 		frappe.throw(_("Invalid Checkout Request ID"))
 
-	integration_request = frappe.get_doc("Integration Request", checkout_id)
+	integration_request = get_integration_request(checkout_id)
 	transaction_data = frappe._dict(loads(integration_request.data))
 	total_paid = 0  # for multiple integration request made against a pos invoice
 	success = False  # for reporting successfull callback to point of sale ui
 
 	if transaction_response["ResultCode"] == 0:
 		if integration_request.reference_doctype and integration_request.reference_docname:
+			# the payment is recorded in full or not at all
+			frappe.db.savepoint("mpesa_verify_transaction")
 			try:
 				item_response = transaction_response["CallbackMetadata"]["Item"]
 				amount = fetch_param_value(item_response, "Amount", "Name")
@@ -192,20 +297,28 @@ def verify_transaction(**kwargs):
 					integration_request.reference_doctype, integration_request.reference_docname
 				)
 
-				mpesa_receipts, completed_payments = get_completed_integration_requests_info(
-					integration_request.reference_doctype, integration_request.reference_docname, checkout_id
+				ledger = get_payment_ledger(
+					integration_request.reference_doctype, integration_request.reference_docname
 				)
+				ledger.add_payment(checkout_id, amount, mpesa_receipt)
 
-				total_paid = amount + sum(completed_payments)
-				mpesa_receipts = ", ".join(mpesa_receipts + [mpesa_receipt])
+				integration_request.db_set("gateway_payment_id", mpesa_receipt, update_modified=False)
+				integration_request.handle_success(transaction_response)
+
+				# the ledger only counts the payments of completed requests
+				ledger.save(ignore_permissions=True)
+				frappe.db.set_value(
+					"POS Invoice", pr.reference_name, "mpesa_receipt_number", ledger.mpesa_receipts
+				)
+				total_paid = ledger.paid_amount
 
 				if total_paid >= pr.grand_total:
 					pr.run_method("on_payment_authorized", "Completed")
 					success = True
-
-				frappe.db.set_value("POS Invoice", pr.reference_name, "mpesa_receipt_number", mpesa_receipts)
-				integration_request.handle_success(transaction_response)
 			except Exception:
+				frappe.db.rollback(save_point="mpesa_verify_transaction")
+				total_paid = 0
+				success = False
 				integration_request.handle_failure(transaction_response)
 				frappe.log_error("Mpesa: Failed to verify transaction")
 
@@ -227,29 +340,30 @@ def verify_transaction(**kwargs):
 	)
 
 
-def get_completed_integration_requests_info(reference_doctype, reference_docname, checkout_id):
-	output_of_other_completed_requests = frappe.get_all(
-		"Integration Request",
-		filters={
-			"name": ["!=", checkout_id],
-			"reference_doctype": reference_doctype,
-			"reference_docname": reference_docname,
-			"status": "Completed",
-		},
-		pluck="output",
+def get_completed_mpesa_payments(reference_doctype, reference_docname):
+	"""Return (checkout id, amount, receipt) of the completed requests against a reference."""
+	filters = {
+		"reference_doctype": reference_doctype,
+		"reference_docname": reference_docname,
+		"status": "Completed",
+	}
+	completed_requests = frappe.get_all(
+		"Integration Request", filters=filters, fields=["name", "output", "creation"]
 	)
+	# requests settled long ago may have been archived since
+	completed_requests += get_archived_integration_requests(filters)
+	completed_requests.sort(key=lambda request: get_datetime(request.creation))
 
-	mpesa_receipts, completed_payments = [], []
+	completed_payments = []
 
-	for out in output_of_other_completed_requests:
-		out = frappe._dict(loads(out))
+	for request in completed_requests:
+		out = frappe._dict(loads(request.output))
 		item_response = out["CallbackMetadata"]["Item"]
 		completed_amount = fetch_param_value(item_response, "Amount", "Name")
 		completed_mpesa_receipt = fetch_param_value(item_response, "MpesaReceiptNumber", "Name")
-		completed_payments.append(completed_amount)
-		mpesa_receipts.append(completed_mpesa_receipt)
+		completed_payments.append((request.name, completed_amount, completed_mpesa_receipt))
 
-	return mpesa_receipts, completed_payments
+	return completed_payments
 
 
 def get_account_balance(request_payload):
@@ -260,7 +374,7 @@ def get_account_balance(request_payload):
 		connector = MpesaConnector(
 			env=env,
 			app_key=mpesa_settings.consumer_key,
-			app_secret=mpesa_settings.get_password("consumer_secret"),
+			app_secret=get_decrypted_secret("Mpesa Settings", mpesa_settings.name, "consumer_secret"),
 		)
 
 		callback_url = (
@@ -292,7 +406,7 @@ def process_balance_info(**kwargs):
 	if not isinstance(conversation_id, str):
 		frappe.throw(_("Invalid Conversation ID"))
 
-	request = frappe.get_doc("Integration Request", conversation_id)
+	request = get_integration_request(conversation_id)
 
 	if request.status == "Completed":
 		return
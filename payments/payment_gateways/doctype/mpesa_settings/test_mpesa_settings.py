@@ -1,21 +1,35 @@
 # Copyright (c) 2020, Frappe Technologies Pvt. Ltd. and Contributors
 # See license.txt
 
+import asyncio
+import base64
 import unittest
 from json import dumps
 
 import frappe
+from frappe.utils import add_days, now_datetime
 
 from erpnext.accounts.doctype.payment_entry.test_payment_entry import create_customer
 from erpnext.accounts.doctype.pos_invoice.test_pos_invoice import create_pos_invoice
 from erpnext.stock.doctype.item.test_item import make_item
 from erpnext.accounts.doctype.pos_profile.test_pos_profile import make_pos_profile
 
+from payments.payment_gateways.doctype.mpesa_payment_ledger.mpesa_payment_ledger import (
+	get_ledger_name,
+)
+from payments.payment_gateways.doctype.mpesa_settings.mpesa_connector import (
+	AsyncMpesaConnector,
+	MpesaConnector,
+)
 from payments.payment_gateways.doctype.mpesa_settings.mpesa_settings import (
+	get_completed_mpesa_payments,
 	process_balance_info,
 	verify_transaction,
 )
 from payments.payment_gateways.doctype.mpesa_settings.mpesa_settings import create_mode_of_payment
+from payments.tests.utils import get_payment_callback_payload, run_standins
+from payments.utils.archive import archive_integration_requests
+from payments.utils.async_http_client import async_client, gather_bounded
 
 
 class TestMpesaSettings(unittest.TestCase):
@@ -43,6 +57,7 @@ class TestMpesaSettings(unittest.TestCase):
 	def tearDown(self):
 		frappe.db.sql("delete from `tabMpesa Settings`")
 		frappe.db.sql("delete from `tabIntegration Request` where integration_request_service = 'Mpesa'")
+		frappe.db.sql("delete from `tabMpesa Payment Ledger`")
 
 	def test_creation_of_payment_gateway(self):
 		mode_of_payment = create_mode_of_payment("Mpesa-_Test", payment_type="Phone")
@@ -206,6 +221,12 @@ class TestMpesaSettings(unittest.TestCase):
 		pos_invoice.reload()
 		self.assertEqual(pos_invoice.mpesa_receipt_number, ", ".join(mpesa_receipt_numbers))
 
+		# the ledger keeps the running total of the split payment
+		ledger = frappe.get_doc("Mpesa Payment Ledger", get_ledger_name(pr.doctype, pr.name))
+		self.assertEqual(ledger.paid_amount, 500 * len(integration_req_ids))
+		self.assertEqual(ledger.mpesa_receipts, ", ".join(mpesa_receipt_numbers))
+		self.assertEqual(ledger.last_checkout_id, integration_req_ids[-1])
+
 		frappe.db.set_value("Customer", "_Test Customer", "default_currency", "")
 		[d.delete() for d in integration_requests]
 		pr.reload()
@@ -292,6 +313,123 @@ class TestMpesaSettings(unittest.TestCase):
 		pr.delete()
 		pos_invoice.delete()
 
+	def test_stk_pushes_that_went_through_are_logged_when_another_one_fails(self):
+		mpesa_doc = create_mpesa_settings(payment_gateway_name="_Test")
+		request_dicts = [
+			frappe._dict(reference_doctype="POS Invoice", reference_docname=name, request_amount=150)
+			for name in ("_Test Invoice 1", "_Test Invoice 2")
+		]
+		response = frappe._dict(get_payment_request_response_payload())
+
+		with self.assertRaises(frappe.ValidationError):
+			mpesa_doc.handle_api_responses(
+				"CheckoutRequestID", request_dicts, [response, ConnectionError("timed out")]
+			)
+
+		integration_request = frappe.get_doc("Integration Request", response.CheckoutRequestID)
+		self.assertEqual(integration_request.integration_type, "Host")
+		self.assertEqual(integration_request.reference_docname, "_Test Invoice 1")
+
+	def test_archived_payments_are_still_completed_payments(self):
+		checkout_id = frappe.generate_hash(length=10)
+		callback = get_payment_callback_payload(Amount=250, CheckoutRequestID=checkout_id)
+		frappe.get_doc(
+			{
+				"doctype": "Integration Request",
+				"integration_request_service": "Mpesa",
+				"reference_doctype": "Payment Request",
+				"reference_docname": "_Test Archived Payment",
+				"data": "{}",
+			}
+		).insert(ignore_permissions=True, set_name=checkout_id)
+		frappe.db.set_value(
+			"Integration Request",
+			checkout_id,
+			{
+				"status": "Completed",
+				"output": dumps(callback["Body"]["stkCallback"]),
+				"creation": add_days(now_datetime(), -365),
+			},
+			update_modified=False,
+		)
+
+		try:
+			archive_integration_requests(filters={"name": checkout_id})
+			self.assertTrue(frappe.db.exists("Integration Request Archive", checkout_id))
+			self.assertEqual(
+				get_completed_mpesa_payments("Payment Request", "_Test Archived Payment"),
+				[(checkout_id, 250, "LGR7OWQX0R")],
+			)
+		finally:
+			# archiving commits, so the archived request is deleted rather than rolled back
+			frappe.db.delete("Integration Request Archive", {"name": checkout_id})
+			frappe.db.commit()
+
+
+class TestAsyncStkPush(unittest.TestCase):
+	def test_gather_bounded_limits_concurrency_and_keeps_exceptions_in_order(self):
+		running = {"now": 0, "max": 0}
+
+		async def call(i):
+			running["now"] += 1
+			running["max"] = max(running["max"], running["now"])
+			await asyncio.sleep(0.01)
+			running["now"] -= 1
+			if i % 3 == 0:
+				raise ValueError(i)
+			return i
+
+		results = asyncio.run(gather_bounded((call(i) for i in range(10)), limit=4))
+
+		self.assertEqual(running["max"], 4)
+		self.assertEqual(len(results), 10)
+		for i, result in enumerate(results):
+			if i % 3 == 0:
+				self.assertIsInstance(result, ValueError)
+				self.assertEqual(result.args, (i,))
+			else:
+				self.assertEqual(result, i)
+
+	def test_async_connector_sends_the_same_stk_push_as_the_connector(self):
+		connector_args = dict(env="sandbox", app_key="_test_parity_key", app_secret="_test_secret")
+		push_args = dict(
+			business_shortcode="174379",
+			passcode="LVI1oS3oBGPJfh3JyvLHwZOd",
+			amount=150,
+			callback_url="https://example.com/callback",
+			reference_code="174379",
+			phone_number="254723575670",
+			description="POS Payment",
+		)
+
+		with run_standins(["Mpesa"]) as standins:
+			standin = standins["Mpesa"]
+			pushes = []
+			route = standin.route
+
+			def record(standin, method, path, query, body):
+				if path.endswith("/processrequest"):
+					pushes.append(body)
+				return route(standin, method, path, query, body)
+
+			standin.route = record
+
+			MpesaConnector(**connector_args).stk_push(**push_args)
+
+			async def async_stk_push():
+				connector = AsyncMpesaConnector(**connector_args)
+				async with async_client():
+					await connector.authenticate()
+					return await connector.stk_push(**push_args)
+
+			asyncio.run(async_stk_push())
+
+		self.assertEqual(len(pushes), 2)
+		for push in pushes:
+			password = base64.b64decode(push.pop("Password")).decode()
+			self.assertEqual(password, "174379LVI1oS3oBGPJfh3JyvLHwZOd" + push.pop("Timestamp"))
+		self.assertEqual(pushes[0], pushes[1])
+
 
 def create_mpesa_settings(payment_gateway_name="Express"):
 	if frappe.db.exists("Mpesa Settings", payment_gateway_name):
@@ -364,31 +502,6 @@ def get_payment_request_response_payload(Amount=500):
 	}
 
 
-def get_payment_callback_payload(
-	Amount=500, CheckoutRequestID="ws_CO_061020201133231972", MpesaReceiptNumber="LGR7OWQX0R"
-):
-	"""Response received from the server as callback after calling the stkpush process request API."""
-	return {
-		"Body": {
-			"stkCallback": {
-				"MerchantRequestID": "19465-780693-1",
-				"CheckoutRequestID": CheckoutRequestID,
-				"ResultCode": 0,
-				"ResultDesc": "The service request is processed successfully.",
-				"CallbackMetadata": {
-					"Item": [
-						{"Name": "Amount", "Value": Amount},
-						{"Name": "MpesaReceiptNumber", "Value": MpesaReceiptNumber},
-						{"Name": "Balance"},
-						{"Name": "TransactionDate", "Value": 20170727154800},
-						{"Name": "PhoneNumber", "Value": 254721566839},
-					]
-				},
-			}
-		}
-	}
-
-
 def get_account_balance_callback_payload():
 	"""Response received from the server as callback after calling the account balance API."""
 	return {
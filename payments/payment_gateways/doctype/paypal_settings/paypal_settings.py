@@ -68,12 +68,20 @@ from urllib.parse import urlencode
 import frappe
 import pytz
 from frappe import _
-from frappe.integrations.utils import create_request_log, make_post_request
+from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
 from frappe.utils import call_hook_method, cint, get_datetime, get_url
 from frappe.utils.data import get_system_timezone
 
 from payments.utils import create_payment_gateway
+from payments.utils.archive import get_integration_request, restore_integration_request
+from payments.utils.async_http_client import async_make_post_request
+from payments.utils.http_client import make_post_request
+from payments.utils.webhooks import (
+	has_pending_webhooks,
+	persist_webhook,
+	process_pending_webhooks,
+)
 
 api_path = "/api/method/payments.payment_gateways.doctype.paypal_settings.paypal_settings"
 
@@ -111,8 +119,8 @@ class PayPalSettings(Document):
 		setattr(self, "use_sandbox", 0)
 
 	def setup_sandbox_env(self, token):
-		data = json.loads(frappe.db.get_value("Integration Request", token, "data"))
-		setattr(self, "use_sandbox", cint(frappe._dict(data).use_sandbox) or 0)
+		restore_integration_request(token)
+		setattr(self, "use_sandbox", cint(frappe.db.get_value("Integration Request", token, "is_sandbox")))
 
 	def validate(self):
 		create_payment_gateway("PayPal")
@@ -162,7 +170,13 @@ class PayPalSettings(Document):
 		params = urlencode(params)
 
 		try:
-			res = make_post_request(url=url, data=params.encode("utf-8"))
+			res = make_post_request(
+				url=url,
+				data=params.encode("utf-8"),
+				gateway="PayPal",
+				operation="GetPalDetails",
+				is_declined=is_declined,
+			)
 
 			if res["ACK"][0] == "Failure":
 				raise Exception
@@ -209,7 +223,13 @@ class PayPalSettings(Document):
 			self.configure_recurring_payments(params, kwargs)
 
 		params = urlencode(params)
-		response = make_post_request(url, data=params.encode("utf-8"))
+		response = make_post_request(
+			url,
+			data=params.encode("utf-8"),
+			gateway="PayPal",
+			operation="SetExpressCheckout",
+			is_declined=is_declined,
+		)
 
 		if response.get("ACK")[0] != "Success":
 			frappe.throw(_("Looks like something is wrong with this site's Paypal configuration."))
@@ -238,7 +258,7 @@ def get_paypal_and_transaction_details(token):
 	doc.setup_sandbox_env(token)
 	params, url = doc.get_paypal_params_and_url()
 
-	integration_request = frappe.get_doc("Integration Request", token)
+	integration_request = get_integration_request(token)
 	data = json.loads(integration_request.data)
 
 	return data, params, url
@@ -271,7 +291,13 @@ def get_express_checkout_details(token):
 		params, url = doc.get_paypal_params_and_url()
 		params.update({"METHOD": "GetExpressCheckoutDetails", "TOKEN": token})
 
-		response = make_post_request(url, data=params)
+		response = make_post_request(
+			url,
+			data=params,
+			gateway="PayPal",
+			operation="GetExpressCheckoutDetails",
+			is_declined=is_declined,
+		)
 
 		if response.get("ACK")[0] != "Success":
 			frappe.respond_as_web_page(
@@ -285,7 +311,7 @@ def get_express_checkout_details(token):
 
 			return
 
-		doc = frappe.get_doc("Integration Request", token)
+		doc = get_integration_request(token)
 		update_integration_request_status(
 			token,
 			{"payerid": response.get("PAYERID")[0], "payer_email": response.get("EMAIL")[0]},
@@ -317,7 +343,13 @@ def confirm_payment(token):
 			}
 		)
 
-		response = make_post_request(url, data=params)
+		response = make_post_request(
+			url,
+			data=params,
+			gateway="PayPal",
+			operation="DoExpressCheckoutPayment",
+			is_declined=is_declined,
+		)
 
 		if response.get("ACK")[0] == "Success":
 			update_integration_request_status(
@@ -384,7 +416,13 @@ def create_recurring_profile(token, payerid):
 		# "PROFILESTARTDATE": datetime.utcfromtimestamp(get_timestamp(starts_at)).isoformat()
 		params.update({"PROFILESTARTDATE": starts_at.isoformat()})
 
-		response = make_post_request(url, data=params)
+		response = make_post_request(
+			url,
+			data=params,
+			gateway="PayPal",
+			operation="CreateRecurringPaymentsProfile",
+			is_declined=is_declined,
+		)
 
 		if response.get("ACK")[0] == "Success":
 			update_integration_request_status(
@@ -418,7 +456,7 @@ def create_recurring_profile(token, payerid):
 
 def update_integration_request_status(token, data, status, error=False, doc=None):
 	if not doc:
-		doc = frappe.get_doc("Integration Request", token)
+		doc = get_integration_request(token)
 
 	doc.update_status(data, status)
 
@@ -441,7 +479,13 @@ def manage_recurring_payment_profile_status(profile_id, action, args, url):
 		}
 	)
 
-	response = make_post_request(url, data=args)
+	response = make_post_request(
+		url,
+		data=args,
+		gateway="PayPal",
+		operation="ManageRecurringPaymentsProfileStatus",
+		is_declined=is_declined,
+	)
 
 	# error code 11556 indicates profile is not in active state(or already cancelled)
 	# thus could not cancel the subscription.
@@ -453,38 +497,34 @@ def manage_recurring_payment_profile_status(profile_id, action, args, url):
 
 @frappe.whitelist(allow_guest=True)
 def ipn_handler():
+	"""Store the IPN right away, it is verified with PayPal by `process_ipn_notifications`"""
 	try:
 		data = frappe.local.form_dict
 
-		validate_ipn_request(data)
-
-		data.update({"payment_gateway": "PayPal"})
-
-		doc = frappe.get_doc(
-			{
-				"data": json.dumps(frappe.local.form_dict),
-				"doctype": "Integration Request",
-				"request_description": "Subscription Notification",
-				"is_remote_request": 1,
-				"status": "Queued",
-			}
-		).insert(ignore_permissions=True)
-		frappe.db.commit()
-
-		frappe.enqueue(
-			method="payments.payment_gateways.doctype.paypal_settings.paypal_settings.handle_subscription_notification",
-			queue="long",
-			timeout=600,
-			is_async=True,
-			**{"doctype": "Integration Request", "docname": doc.name},
-		)
+		if data.get("recurring_payment_id"):
+			persist_webhook(
+				"PayPal", {**data, "payment_gateway": "PayPal"}, event_id=data.get("ipn_track_id")
+			)
 
-	except frappe.InvalidStatusError:
-		pass
 	except Exception as e:
 		frappe.log(frappe.log_error(title=e))
 
 
+def process_ipn_notifications():
+	"""Verify pending IPNs, with one profile lookup for all the IPNs of a profile"""
+	if not has_pending_webhooks("PayPal"):
+		return
+
+	params, url = frappe.get_doc("PayPal Settings").get_paypal_params_and_url()
+
+	process_pending_webhooks(
+		"PayPal",
+		lambda data: data.get("recurring_payment_id"),
+		lambda profile_id: is_valid_recurring_profile(params, url, profile_id),
+		"payments.payment_gateways.doctype.paypal_settings.paypal_settings.handle_subscription_notification",
+	)
+
+
 def validate_ipn_request(data):
 	def _throw():
 		frappe.throw(_("In Valid Request"), exc=frappe.InvalidStatusError)
@@ -492,21 +532,43 @@ def validate_ipn_request(data):
 	if not data.get("recurring_payment_id"):
 		_throw()
 
-	doc = frappe.get_doc("PayPal Settings")
-	params, url = doc.get_paypal_params_and_url()
+	params, url = frappe.get_doc("PayPal Settings").get_paypal_params_and_url()
 
-	params.update(
-		{
-			"METHOD": "GetRecurringPaymentsProfileDetails",
-			"PROFILEID": data.get("recurring_payment_id"),
-		}
+	if not is_valid_recurring_profile(params, url, data.get("recurring_payment_id")):
+		_throw()
+
+
+def is_declined(response):
+	"""Whether PayPal declined an NVP call, which it answers with a 200 and an ACK of Failure"""
+	return isinstance(response, dict) and not response.get("ACK", [""])[0].startswith("Success")
+
+
+def is_valid_recurring_profile(params, url, profile_id):
+	params = urlencode(
+		{**params, "METHOD": "GetRecurringPaymentsProfileDetails", "PROFILEID": profile_id}
+	)
+	res = make_post_request(
+		url=url,
+		data=params.encode("utf-8"),
+		gateway="PayPal",
+		operation="GetRecurringPaymentsProfileDetails",
+		is_declined=is_declined,
 	)
 
-	params = urlencode(params)
-	res = make_post_request(url=url, data=params.encode("utf-8"))
+	return res["ACK"][0] == "Success"
 
-	if res["ACK"][0] != "Success":
-		_throw()
+
+async def async_is_valid_recurring_profile(params, url, profile_id):
+	"""asyncio counterpart of `is_valid_recurring_profile`"""
+	res = await async_make_post_request(
+		url=url,
+		data={**params, "METHOD": "GetRecurringPaymentsProfileDetails", "PROFILEID": profile_id},
+		gateway="PayPal",
+		operation="GetRecurringPaymentsProfileDetails",
+		is_declined=is_declined,
+	)
+
+	return res["ACK"][0] == "Success"
 
 
 def handle_subscription_notification(doctype, docname):
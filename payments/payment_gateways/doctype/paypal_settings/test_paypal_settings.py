@@ -0,0 +1,72 @@
+# Copyright (c) 2026, Frappe Technologies and Contributors
+# See license.txt
+
+import unittest
+
+import frappe
+
+from payments.payment_gateways.doctype.paypal_settings.paypal_settings import (
+	ipn_handler,
+	process_ipn_notifications,
+)
+from payments.tests.utils import run_standins
+from payments.utils.webhooks import release_webhook_event
+
+
+class TestPayPalSettings(unittest.TestCase):
+	def setUp(self):
+		self.ipn_track_id = frappe.generate_hash(length=12)
+		self.profile_id = f"I-{frappe.generate_hash(length=12).upper()}"
+
+	def tearDown(self):
+		# notifications are committed when they are received
+		frappe.db.rollback()
+		for name in get_ipn_notifications(self.profile_id):
+			frappe.delete_doc("Integration Request", name, force=True, ignore_permissions=True)
+		frappe.db.commit()
+		release_webhook_event("PayPal", self.ipn_track_id)
+
+	def test_ipn_is_processed_once(self):
+		# PayPal retries the IPN until it is acknowledged
+		for _i in range(2):
+			receive_ipn(recurring_payment_id=self.profile_id, ipn_track_id=self.ipn_track_id)
+
+		notifications = get_ipn_notifications(self.profile_id)
+		self.assertEqual(len(notifications), 1)
+
+		with run_standins(["PayPal"]) as standins:
+			standin = standins["PayPal"]
+			verified_profiles = []
+			route = standin.route
+
+			def record(standin, method, path, query, body):
+				if body.get("METHOD") == "GetRecurringPaymentsProfileDetails":
+					verified_profiles.append(body.get("PROFILEID"))
+				return route(standin, method, path, query, body)
+
+			standin.route = record
+
+			for _i in range(2):
+				process_ipn_notifications()
+
+		self.assertEqual(verified_profiles, [self.profile_id])
+		self.assertEqual(
+			frappe.db.get_value("Integration Request", notifications[0], "webhook_status"), "Verified"
+		)
+
+
+def receive_ipn(**data):
+	form_dict = frappe.local.form_dict
+	frappe.local.form_dict = frappe._dict(data)
+	try:
+		ipn_handler()
+	finally:
+		frappe.local.form_dict = form_dict
+
+
+def get_ipn_notifications(profile_id):
+	return frappe.get_all(
+		"Integration Request",
+		filters={"integration_request_service": "PayPal", "data": ("like", f"%{profile_id}%")},
+		pluck="name",
+	)
@@ -5,7 +5,6 @@ import json
 from urllib.parse import urlencode
 
 import frappe
-import requests
 from frappe import _
 from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
@@ -17,10 +16,13 @@ from frappe.utils import (
 	get_request_site_address,
 	get_url,
 )
-from frappe.utils.password import get_decrypted_password
 from paytmchecksum import generateSignature, verifySignature
 
 from payments.utils import create_payment_gateway
+from payments.utils.archive import get_integration_request
+from payments.utils.async_http_client import async_send_request
+from payments.utils.http_client import send_request
+from payments.utils.secrets import get_decrypted_secret
 
 
 class PaytmSettings(Document):
@@ -52,7 +54,7 @@ def get_paytm_config():
 
 	paytm_config = frappe.db.get_singles_dict("Paytm Settings")
 	paytm_config.update(
-		dict(merchant_key=get_decrypted_password("Paytm Settings", "Paytm Settings", "merchant_key"))
+		dict(merchant_key=get_decrypted_secret("Paytm Settings", "Paytm Settings", "merchant_key"))
 	)
 
 	if cint(paytm_config.staging):
@@ -134,24 +136,55 @@ def verify_transaction(**paytm_params):
 
 def verify_transaction_status(paytm_config, order_id):
 	"""Verify transaction completion after checksum has been verified"""
-	paytm_params = dict(MID=paytm_config.merchant_id, ORDERID=order_id)
+	response = send_request(
+		"POST",
+		paytm_config.transaction_status_url,
+		data=json.dumps(get_transaction_status_params(paytm_config, order_id)),
+		headers={"Content-type": "application/json"},
+		gateway="Paytm",
+		operation="order_status",
+		is_declined=is_declined,
+	).json()
+	finalize_request(order_id, response)
 
-	checksum = generateSignature(paytm_params, paytm_config.merchant_key)
-	paytm_params["CHECKSUMHASH"] = checksum
 
-	post_data = json.dumps(paytm_params)
-	url = paytm_config.transaction_status_url
+async def async_get_transaction_status(paytm_config, order_id):
+	"""Return the status of an order from Paytm's order status API, e.g. to poll pending orders.
+
+	asyncio counterpart of the lookup made by `verify_transaction_status`, which doesn't
+	update the Integration Request.
+	"""
+	response = await async_send_request(
+		"POST",
+		paytm_config.transaction_status_url,
+		json=get_transaction_status_params(paytm_config, order_id),
+		gateway="Paytm",
+		operation="order_status",
+		is_declined=is_declined,
+	)
+	return response.json()
 
-	response = requests.post(url, data=post_data, headers={"Content-type": "application/json"}).json()
-	finalize_request(order_id, response)
+
+def is_declined(response):
+	"""Whether the order status API reports a failed transaction; it answers those with a 200"""
+	return isinstance(response, dict) and response.get("STATUS") == "TXN_FAILURE"
+
+
+def get_transaction_status_params(paytm_config, order_id):
+	paytm_params = dict(MID=paytm_config.merchant_id, ORDERID=order_id)
+	paytm_params["CHECKSUMHASH"] = generateSignature(paytm_params, paytm_config.merchant_key)
+	return paytm_params
 
 
 def finalize_request(order_id, transaction_response):
-	request = frappe.get_doc("Integration Request", order_id)
+	request = get_integration_request(order_id)
 	transaction_data = frappe._dict(json.loads(request.data))
 	redirect_to = transaction_data.get("redirect_to") or None
 	redirect_message = transaction_data.get("redirect_message") or None
 
+	if transaction_response.get("TXNID"):
+		request.db_set("gateway_payment_id", transaction_response["TXNID"], update_modified=False)
+
 	if transaction_response["STATUS"] == "TXN_SUCCESS":
 		if transaction_data.reference_doctype and transaction_data.reference_docname:
 			custom_redirect_to = None
@@ -1,8 +1,31 @@
 # Copyright (c) 2020, Frappe Technologies and Contributors
 # License: MIT. See LICENSE
-# import frappe
 import unittest
 
+import frappe
+
+from payments.utils.secrets import get_decrypted_secret, get_secret_cache_stats
+
 
 class TestPaytmSettings(unittest.TestCase):
-	pass
+	def tearDown(self):
+		frappe.db.rollback()
+
+	def test_cached_merchant_key_is_dropped_when_the_settings_change(self):
+		settings = frappe.get_single("Paytm Settings")
+		settings.update({"merchant_id": "TEST", "merchant_key": "first_key_16char"})
+		settings.save(ignore_permissions=True)
+
+		self.assertEqual(get_merchant_key(), "first_key_16char")
+		hits = get_secret_cache_stats()["hits"]
+		self.assertEqual(get_merchant_key(), "first_key_16char")
+		self.assertEqual(get_secret_cache_stats()["hits"], hits + 1)
+
+		settings.merchant_key = "other_key_16char"
+		settings.save(ignore_permissions=True)
+
+		self.assertEqual(get_merchant_key(), "other_key_16char")
+
+
+def get_merchant_key():
+	return get_decrypted_secret("Paytm Settings", "Paytm Settings", "merchant_key")
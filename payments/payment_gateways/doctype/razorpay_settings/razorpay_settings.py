@@ -59,23 +59,71 @@ For razorpay payment status is Authorized
 
 """
 
+import asyncio
 import hashlib
 import hmac
 import json
+import time
+from concurrent.futures import as_completed
 from urllib.parse import urlencode
+from zoneinfo import ZoneInfo
 
 import frappe
 import razorpay
 from frappe import _
-from frappe.integrations.utils import (
-	create_request_log,
-	make_get_request,
-	make_post_request,
-)
+from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
-from frappe.utils import call_hook_method, cint, get_timestamp, get_url
+from frappe.query_builder.functions import Min
+from frappe.utils import (
+	add_to_date,
+	call_hook_method,
+	cint,
+	get_datetime,
+	get_timestamp,
+	get_url,
+	now_datetime,
+)
+from frappe.utils.data import get_system_timezone
+
+from payments.utils import (
+	claim_integration_requests,
+	create_payment_gateway,
+	get_filter_conditions,
+	get_gateway_amount,
+	get_lease_owner,
+	get_site_thread_pool,
+	iterate_in_pages,
+	release_integration_request_lease,
+)
+from payments.utils.archive import get_integration_request
+from payments.utils.async_http_client import (
+	async_client,
+	async_make_get_request,
+	async_make_post_request,
+	gather_bounded,
+	use_async_transport,
+)
+from payments.utils.circuit_breaker import GatewayUnavailableError
+from payments.utils.http_client import make_get_request, make_post_request
+from payments.utils.secrets import get_decrypted_secret
+from payments.utils.webhooks import (
+	claim_webhook_event,
+	has_pending_webhooks,
+	persist_webhook,
+	process_pending_webhooks,
+	release_webhook_event,
+)
+
+DEFAULT_CAPTURE_BATCH_SIZE = 100
+DEFAULT_CAPTURE_WORKERS = 8
+MAX_CAPTURE_WORKERS = 32
+DEFAULT_CAPTURE_LISTING_HOURS = 24
+PAYMENTS_PAGE_LENGTH = 100
+# global default holding the end of the window of the last successful reconciliation
+RECONCILED_UNTIL_KEY = "razorpay_reconciled_until"
 
-from payments.utils import create_payment_gateway
+# Integration Request status for the terminal states of a Razorpay payment
+RECONCILED_STATUSES = {"captured": "Completed", "failed": "Failed"}
 
 
 class RazorpaySettings(Document):
@@ -83,7 +131,7 @@ class RazorpaySettings(Document):
 
 	def init_client(self):
 		if self.api_key:
-			secret = self.get_password(fieldname="api_secret", raise_exception=False)
+			secret = get_decrypted_secret(self.doctype, self.name, "api_secret", raise_exception=False)
 			self.client = razorpay.Client(auth=(self.api_key, secret))
 
 	def validate(self):
@@ -101,6 +149,8 @@ class RazorpaySettings(Document):
 						self.api_key,
 						self.get_password(fieldname="api_secret", raise_exception=False),
 					),
+					gateway="Razorpay",
+					operation="list_payments",
 				)
 			except Exception:
 				frappe.throw(_("Seems API Key or API Secret is wrong !!!"))
@@ -138,6 +188,8 @@ class RazorpaySettings(Document):
 					auth=(settings.api_key, settings.api_secret),
 					data=json.dumps(addon),
 					headers={"content-type": "application/json"},
+					gateway="Razorpay",
+					operation="create_addon",
 				)
 				if not resp.get("id"):
 					frappe.log_error(message=str(resp), title="Razorpay Failed while creating subscription")
@@ -172,6 +224,8 @@ class RazorpaySettings(Document):
 				auth=(settings.api_key, settings.api_secret),
 				data=json.dumps(subscription_details),
 				headers={"content-type": "application/json"},
+				gateway="Razorpay",
+				operation="create_subscription",
 			)
 
 			if resp.get("status") == "created":
@@ -219,12 +273,16 @@ class RazorpaySettings(Document):
 					"https://api.razorpay.com/v1/orders",
 					auth=(
 						self.api_key,
-						self.get_password(fieldname="api_secret", raise_exception=False),
+						get_decrypted_secret(self.doctype, self.name, "api_secret", raise_exception=False),
 					),
 					data=payment_options,
+					gateway="Razorpay",
+					operation="create_order",
 				)
 				order["integration_request"] = integration_request.name
 				return order  # Order returned to be consumed by razorpay.js
+			except GatewayUnavailableError:
+				raise
 			except Exception:
 				frappe.log(frappe.get_traceback())
 				frappe.throw(_("Could not create razorpay order"))
@@ -233,7 +291,7 @@ class RazorpaySettings(Document):
 		self.data = frappe._dict(data)
 
 		try:
-			self.integration_request = frappe.get_doc("Integration Request", self.data.token)
+			self.integration_request = get_integration_request(self.data.token)
 			self.integration_request.update_status(self.data, "Queued")
 			return self.authorize_payment()
 
@@ -249,20 +307,27 @@ class RazorpaySettings(Document):
 				"status": 401,
 			}
 
-	def authorize_payment(self):
+	def authorize_payment(self, payment=None):
 		"""
 		An authorization is performed when user’s payment details are successfully authenticated by the bank.
 		The money is deducted from the customer’s account, but will not be transferred to the merchant’s account
 		until it is explicitly captured by merchant.
+
+		`payment` can be passed when the payment entity was already fetched (e.g. while reconciling).
 		"""
 		data = json.loads(self.integration_request.data)
 		settings = self.get_settings(data)
 
 		try:
-			resp = make_get_request(
-				f"https://api.razorpay.com/v1/payments/{self.data.razorpay_payment_id}",
-				auth=(settings.api_key, settings.api_secret),
-			)
+			if payment:
+				resp = payment
+			else:
+				resp = make_get_request(
+					f"https://api.razorpay.com/v1/payments/{self.data.razorpay_payment_id}",
+					auth=(settings.api_key, settings.api_secret),
+					gateway="Razorpay",
+					operation="fetch_payment",
+				)
 
 			if resp.get("status") == "authorized":
 				self.integration_request.update_status(data, "Authorized")
@@ -287,7 +352,7 @@ class RazorpaySettings(Document):
 		except Exception:
 			frappe.log_error()
 
-		status = frappe.flags.integration_request.status_code
+		status = 200 if payment else frappe.flags.integration_request.status_code
 
 		redirect_to = data.get("redirect_to") or None
 		redirect_message = data.get("redirect_message") or None
@@ -323,7 +388,9 @@ class RazorpaySettings(Document):
 		settings = frappe._dict(
 			{
 				"api_key": self.api_key,
-				"api_secret": self.get_password(fieldname="api_secret", raise_exception=False),
+				"api_secret": get_decrypted_secret(
+					self.doctype, self.name, "api_secret", raise_exception=False
+				),
 			}
 		)
 
@@ -344,6 +411,8 @@ class RazorpaySettings(Document):
 			resp = make_post_request(
 				f"https://api.razorpay.com/v1/subscriptions/{subscription_id}/cancel",
 				auth=(settings.api_key, settings.api_secret),
+				gateway="Razorpay",
+				operation="cancel_subscription",
 			)
 		except Exception:
 			frappe.log_error(frappe.get_traceback())
@@ -369,44 +438,344 @@ def capture_payment(is_sandbox=False, sanbox_response=None):
 	After capture, the amount is transferred to the merchant within T+3 days
 	where T is the day on which payment is captured.
 
+	Authorized requests are streamed in pages of `razorpay_capture_batch_size` rows
+	(keyset paginated, so memory stays flat whatever the backlog) and each page is
+	leased before being processed, so overlapping scheduler runs and additional RQ
+	workers running this job never capture the same payment twice. Requests that could
+	not be captured keep their lease until it expires, which spaces out the retries.
+
+	The GET/capture round trips for each payment are fanned out over a thread pool
+	of `razorpay_capture_workers` threads (site config), while all database writes
+	happen on the calling thread and are committed row by row. With
+	`razorpay_capture_from_listing` enabled, live payments are looked up in an index
+	built from the paginated payments listing instead of one GET per payment. The index
+	only covers the last `razorpay_capture_listing_hours` (24 by default), so that a stale
+	request doesn't pull months of payments into memory; older requests use a GET. With
+	`payments_async_transport` enabled, the round trips of a page run concurrently on an
+	event loop instead, bounded by `payments_async_concurrency` rather than the thread pool;
+	all the pages share the loop and its client.
+
 	Note: Attempting to capture a payment whose status is not authorized will produce an error.
 	"""
 	controller = frappe.get_doc("Razorpay Settings")
+	owner = get_lease_owner()
+	batch_size = cint(frappe.conf.razorpay_capture_batch_size) or DEFAULT_CAPTURE_BATCH_SIZE
+	filters = {"status": "Authorized", "integration_request_service": "Razorpay"}
+	stats = frappe._dict(processed=0, captured=0, failed=0)
+	use_async = not is_sandbox and use_async_transport()
+	start = time.monotonic()
+
+	payment_index = {}
+	if not is_sandbox and cint(frappe.conf.razorpay_capture_from_listing):
+		IntegrationRequest = frappe.qb.DocType("Integration Request")
+		query = frappe.qb.from_(IntegrationRequest).select(Min(IntegrationRequest.creation))
+		for condition in get_filter_conditions(IntegrationRequest, filters):
+			query = query.where(condition)
+
+		if oldest := query.run(pluck=True)[0]:
+			to_time = now_datetime()
+			hours = cint(frappe.conf.razorpay_capture_listing_hours) or DEFAULT_CAPTURE_LISTING_HOURS
+			from_time = max(get_datetime(oldest), add_to_date(to_time, hours=-hours))
+			payment_index = get_payment_index(controller.get_settings({}), from_time, to_time)
+
+	def get_captures():
+		"""Lease each page and yield the args of `fetch_and_capture_payment` of its payments"""
+		for page in iterate_in_pages("Integration Request", filters=filters, page_length=batch_size):
+			claimed = claim_integration_requests(
+				{**filters, "name": ("in", [row.name for row in page])},
+				limit=len(page),
+				owner=owner,
+			)
+			if not claimed:
+				continue
+
+			captures = {}
+			for doc in frappe.get_all(
+				"Integration Request",
+				filters={"name": ("in", claimed)},
+				fields=["name", "gateway_payment_id", "gateway_amount", "is_sandbox"],
+			):
+				if is_sandbox:
+					captures[doc.name] = None
+					continue
 
-	for doc in frappe.get_all(
-		"Integration Request",
-		filters={"status": "Authorized", "integration_request_service": "Razorpay"},
-		fields=["name", "data"],
-	):
-		try:
-			if is_sandbox:
-				resp = sanbox_response
-			else:
-				data = json.loads(doc.data)
-				settings = controller.get_settings(data)
+				try:
+					settings = controller.get_settings({"use_sandbox": doc.is_sandbox})
+					captures[doc.name] = (
+						doc.gateway_payment_id,
+						get_gateway_amount(doc.gateway_amount),
+						(settings.api_key, settings.api_secret),
+						None if doc.is_sandbox else payment_index.get(doc.gateway_payment_id),
+					)
+				except Exception:
+					mark_capture_failed(doc.name)
+					stats.failed += 1
 
-				resp = make_get_request(
-					"https://api.razorpay.com/v1/payments/{}".format(data.get("razorpay_payment_id")),
-					auth=(settings.api_key, settings.api_secret),
-					data={"amount": data.get("amount")},
-				)
+			yield captures
+
+	def record_captures(results):
+		for name, resp in results:
+			stats.processed += 1
+			try:
+				if isinstance(resp, Exception):
+					raise resp
 
-				if resp.get("status") == "authorized":
-					resp = make_post_request(
-						"https://api.razorpay.com/v1/payments/{}/capture".format(data.get("razorpay_payment_id")),
-						auth=(settings.api_key, settings.api_secret),
-						data={"amount": data.get("amount")},
+				if resp.get("status") == "captured":
+					frappe.db.set_value("Integration Request", name, "status", "Completed")
+					release_integration_request_lease(name)
+					stats.captured += 1
+			except Exception:
+				mark_capture_failed(name)
+				stats.failed += 1
+
+			frappe.db.commit()
+
+	if use_async:
+		# all the pages share one event loop and one client, and with it its connections
+		async def capture_pages():
+			async with async_client():
+				for captures in get_captures():
+					responses = await gather_bounded(
+						async_fetch_and_capture_payment(*args) for args in captures.values()
 					)
+					record_captures(zip(captures, responses))
+
+		asyncio.run(capture_pages())
+	else:
+		with get_site_thread_pool(get_capture_workers()) as executor:
+			for captures in get_captures():
+				if is_sandbox:
+					record_captures((name, sanbox_response) for name in captures)
+					continue
+
+				futures = {
+					executor.submit(fetch_and_capture_payment, *args): name for name, args in captures.items()
+				}
+				record_captures(
+					(futures[future], future.exception() or future.result()) for future in as_completed(futures)
+				)
+
+	stats.elapsed = time.monotonic() - start
+	stats.captures_per_sec = stats.captured / stats.elapsed if stats.elapsed else 0.0
+	frappe.logger("payments").info(
+		"Razorpay capture: {processed} processed, {captured} captured, {failed} failed "
+		"in {elapsed:.2f}s ({captures_per_sec:.2f} captures/sec)".format(**stats)
+	)
+
+	return stats
+
+
+def get_capture_workers():
+	"""Number of threads used by `capture_payment`, capped at `MAX_CAPTURE_WORKERS`"""
+	workers = cint(frappe.conf.razorpay_capture_workers) or DEFAULT_CAPTURE_WORKERS
+	return max(1, min(workers, MAX_CAPTURE_WORKERS))
+
+
+def fetch_and_capture_payment(payment_id, amount, auth, payment=None):
+	"""Fetch a payment and capture it if it is still authorized.
+
+	The GET is skipped when the `payment` entity is passed, e.g. from a payment index.
+	Runs inside capture worker threads, so failures are raised to the caller, which
+	records them on the Integration Request.
+	"""
+	url = f"https://api.razorpay.com/v1/payments/{payment_id}"
+
+	resp = payment or make_get_request(
+		url, auth=auth, data={"amount": amount}, gateway="Razorpay", operation="fetch_payment"
+	)
+
+	if resp.get("status") == "authorized":
+		resp = make_post_request(
+			f"{url}/capture",
+			auth=auth,
+			data={"amount": amount},
+			gateway="Razorpay",
+			operation="capture",
+		)
+
+	return resp
+
+
+async def async_fetch_and_capture_payment(payment_id, amount, auth, payment=None):
+	"""asyncio counterpart of `fetch_and_capture_payment`"""
+	url = f"https://api.razorpay.com/v1/payments/{payment_id}"
+
+	resp = payment or await async_make_get_request(
+		url, auth=auth, data={"amount": amount}, gateway="Razorpay", operation="fetch_payment"
+	)
+
+	if resp.get("status") == "authorized":
+		resp = await async_make_post_request(
+			f"{url}/capture",
+			auth=auth,
+			data={"amount": amount},
+			gateway="Razorpay",
+			operation="capture",
+		)
+
+	return resp
+
+
+def fetch_payments(settings, from_time, to_time):
+	"""Yield the payments created between `from_time` and `to_time` using the paginated
+	`/v1/payments` listing, `PAYMENTS_PAGE_LENGTH` payments per round trip."""
+	skip = 0
+	while True:
+		resp = make_get_request(
+			"https://api.razorpay.com/v1/payments",
+			auth=(settings.api_key, settings.api_secret),
+			params={
+				"from": to_unix_timestamp(from_time),
+				"to": to_unix_timestamp(to_time),
+				"count": PAYMENTS_PAGE_LENGTH,
+				"skip": skip,
+			},
+			gateway="Razorpay",
+			operation="list_payments",
+		)
+		items = resp.get("items") or []
+		yield from items
+
+		if len(items) < PAYMENTS_PAGE_LENGTH:
+			return
+
+		skip += PAYMENTS_PAGE_LENGTH
+
+
+def to_unix_timestamp(value):
+	"""Convert a datetime in the system timezone to the unix timestamp Razorpay expects"""
+	return cint(get_datetime(value).replace(tzinfo=ZoneInfo(get_system_timezone())).timestamp())
+
+
+def get_payment_index(settings, from_time, to_time):
+	"""Return the payments created in the window keyed by payment id"""
+	return {payment["id"]: payment for payment in fetch_payments(settings, from_time, to_time)}
 
-			if resp.get("status") == "captured":
-				frappe.db.set_value("Integration Request", doc.name, "status", "Completed")
 
+def reconcile_payments(from_time=None, to_time=None, use_sandbox=False):
+	"""
+	Sync Razorpay Integration Requests with the payments created in a time window.
+
+	Scheduled runs pick up where the last successful run stopped, going back at most
+	`razorpay_reconciliation_window_hours` (24 by default). Sites without Razorpay
+	credentials are skipped.
+
+	The window is fetched with a handful of listing calls and matched against pending
+	requests by their indexed `gateway_payment_id`:
+
+	- Authorized requests whose payment was captured or failed are updated in bulk.
+	- Queued requests whose payment got authorized or captured, including those whose
+	  browser callback never reached us (matched through the `token` Razorpay Checkout
+	  stores in the payment notes), go through the regular authorization flow.
+	"""
+	controller = frappe.get_doc("Razorpay Settings")
+	settings = controller.get_settings({"use_sandbox": use_sandbox})
+	if not (settings.api_key and settings.api_secret):
+		return
+
+	scheduled = not from_time
+	last_run_key = RECONCILED_UNTIL_KEY + (":sandbox" if use_sandbox else "")
+	to_time = get_datetime(to_time) if to_time else now_datetime()
+	if scheduled:
+		window = cint(frappe.conf.razorpay_reconciliation_window_hours) or 24
+		from_time = add_to_date(to_time, hours=-window)
+		if reconciled_until := frappe.db.get_global(last_run_key):
+			from_time = max(from_time, get_datetime(reconciled_until))
+	else:
+		from_time = get_datetime(from_time)
+
+	payment_index = get_payment_index(settings, from_time, to_time)
+	if not payment_index:
+		if scheduled:
+			set_reconciled_until(last_run_key, to_time)
+		return
+
+	payment_ids = list(payment_index)
+	tokens = {
+		payment["notes"]["token"]: payment
+		for payment in payment_index.values()
+		if isinstance(payment.get("notes"), dict) and payment["notes"].get("token")
+	}
+
+	bulk_updates = {"Completed": [], "Failed": []}
+	to_authorize = {}
+
+	for i in range(0, len(payment_ids), PAYMENTS_PAGE_LENGTH):
+		for request in frappe.get_all(
+			"Integration Request",
+			filters={
+				"integration_request_service": "Razorpay",
+				"gateway_payment_id": ("in", payment_ids[i : i + PAYMENTS_PAGE_LENGTH]),
+				"status": ("in", ("Queued", "Authorized")),
+			},
+			fields=["name", "status", "gateway_payment_id"],
+		):
+			payment = payment_index[request.gateway_payment_id]
+			if request.status == "Authorized":
+				if status := RECONCILED_STATUSES.get(payment["status"]):
+					bulk_updates[status].append(request.name)
+			elif payment["status"] in ("authorized", "captured"):
+				to_authorize[request.name] = payment
+
+	if tokens:
+		for request in frappe.get_all(
+			"Integration Request",
+			filters={
+				"name": ("in", list(tokens)),
+				"integration_request_service": "Razorpay",
+				"status": "Queued",
+				"gateway_payment_id": ("is", "not set"),
+			},
+			pluck="name",
+		):
+			if tokens[request]["status"] in ("authorized", "captured"):
+				to_authorize[request] = tokens[request]
+
+	# settled requests also give up the lease a capture run may hold on them
+	IntegrationRequest = frappe.qb.DocType("Integration Request")
+	for status, names in bulk_updates.items():
+		if names:
+			(
+				frappe.qb.update(IntegrationRequest)
+				.set(IntegrationRequest.status, status)
+				.set(IntegrationRequest.lease_owner, None)
+				.set(IntegrationRequest.lease_expires_on, None)
+				.set(IntegrationRequest.modified, now_datetime())
+				.where(IntegrationRequest.name.isin(names))
+			).run()
+
+	frappe.db.commit()
+
+	for name, payment in to_authorize.items():
+		try:
+			integration_request = frappe.get_doc("Integration Request", name)
+			integration_request.update_status({"razorpay_payment_id": payment["id"]}, "Queued")
+
+			controller.integration_request = integration_request
+			controller.data = frappe._dict(json.loads(integration_request.data))
+			controller.flags.status_changed_to = None
+			controller.authorize_payment(payment)
+			frappe.db.commit()
 		except Exception:
-			doc = frappe.get_doc("Integration Request", doc.name)
-			doc.status = "Failed"
-			doc.error = frappe.get_traceback()
-			doc.save()
-			frappe.log_error(doc.error, f"{doc.name} Failed")
+			frappe.db.rollback()
+			frappe.log_error(title=f"Razorpay reconciliation failed for {name}")
+
+	if scheduled:
+		set_reconciled_until(last_run_key, to_time)
+
+
+def set_reconciled_until(key, to_time):
+	frappe.db.set_global(key, str(to_time))
+	frappe.db.commit()
+
+
+def mark_capture_failed(integration_request):
+	doc = frappe.get_doc("Integration Request", integration_request)
+	doc.status = "Failed"
+	doc.error = frappe.get_traceback()
+	doc.lease_owner = doc.lease_expires_on = None
+	doc.save()
+	frappe.log_error(doc.error, f"{doc.name} Failed")
 
 
 @frappe.whitelist(allow_guest=True)
@@ -438,7 +807,7 @@ def order_payment_success(integration_request, params):
 	        params (string): Params to be updated for integration request.
 	"""
 	params = json.loads(params)
-	integration = frappe.get_doc("Integration Request", integration_request)
+	integration = get_integration_request(integration_request)
 
 	# Update integration request
 	integration.update_status(params, integration.status)
@@ -465,7 +834,7 @@ def order_payment_failure(integration_request, params):
 	"""
 	frappe.log_error(params, "Razorpay Payment Failure")
 	params = json.loads(params)
-	integration = frappe.get_doc("Integration Request", integration_request)
+	integration = get_integration_request(integration_request)
 	integration.update_status(params, integration.status)
 
 
@@ -478,23 +847,47 @@ def convert_rupee_to_paisa(**kwargs):
 
 @frappe.whitelist(allow_guest=True)
 def razorpay_subscription_callback():
+	event_id = frappe.get_request_header("X-Razorpay-Event-Id")
+	webhook_secret = get_decrypted_secret(
+		"Razorpay Settings", "Razorpay Settings", "webhook_secret", raise_exception=False
+	)
+	if webhook_secret:
+		# verified locally and acknowledged right away, `process_subscription_webhooks`
+		# checks the subscriptions with Razorpay later on
+		frappe.get_cached_doc("Razorpay Settings").verify_signature(
+			frappe.request.get_data(as_text=True),
+			frappe.get_request_header("X-Razorpay-Signature") or "",
+			webhook_secret,
+		)
+		persist_webhook(
+			"Razorpay", {**frappe.local.form_dict, "payment_gateway": "Razorpay"}, event_id=event_id
+		)
+		return
+
 	try:
 		data = frappe.local.form_dict
 
 		validate_payment_callback(data)
 
+		if not claim_webhook_event("Razorpay", event_id):
+			return
+
 		data.update({"payment_gateway": "Razorpay"})
 
-		doc = frappe.get_doc(
-			{
-				"data": json.dumps(frappe.local.form_dict),
-				"doctype": "Integration Request",
-				"request_description": "Subscription Notification",
-				"is_remote_request": 1,
-				"status": "Queued",
-			}
-		).insert(ignore_permissions=True)
-		frappe.db.commit()
+		try:
+			doc = frappe.get_doc(
+				{
+					"data": json.dumps(frappe.local.form_dict),
+					"doctype": "Integration Request",
+					"request_description": "Subscription Notification",
+					"is_remote_request": 1,
+					"status": "Queued",
+				}
+			).insert(ignore_permissions=True)
+			frappe.db.commit()
+		except Exception:
+			release_webhook_event("Razorpay", event_id)
+			raise
 
 		frappe.enqueue(
 			method="payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.handle_subscription_notification",
@@ -510,6 +903,42 @@ def razorpay_subscription_callback():
 		frappe.log(frappe.log_error(title=e))
 
 
+def process_subscription_webhooks():
+	"""Check the subscriptions of pending webhooks, one call per subscription"""
+	if not has_pending_webhooks("Razorpay"):
+		return
+
+	controller = frappe.get_doc("Razorpay Settings")
+	auth = {}
+	for use_sandbox in (0, 1):
+		settings = controller.get_settings({"use_sandbox": use_sandbox})
+		auth[use_sandbox] = (settings.api_key, settings.api_secret)
+
+	def get_subscription(data):
+		subscription_id = data["payload"]["subscription"]["entity"]["id"]
+		if subscription_id:
+			# same sandbox detection as `get_settings`
+			use_sandbox = cint(data.get("notes", {}).get("use_sandbox") or data.get("use_sandbox"))
+			return subscription_id, use_sandbox
+
+	def is_active(subscription):
+		subscription_id, use_sandbox = subscription
+		resp = make_get_request(
+			f"https://api.razorpay.com/v1/subscriptions/{subscription_id}",
+			auth=auth[use_sandbox],
+			gateway="Razorpay",
+			operation="fetch_subscription",
+		)
+		return resp.get("status") == "active"
+
+	process_pending_webhooks(
+		"Razorpay",
+		get_subscription,
+		is_active,
+		"payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.handle_subscription_notification",
+	)
+
+
 def validate_payment_callback(data):
 	def _throw():
 		frappe.throw(_("Invalid Subscription"), exc=frappe.InvalidStatusError)
@@ -526,6 +955,8 @@ def validate_payment_callback(data):
 	resp = make_get_request(
 		f"https://api.razorpay.com/v1/subscriptions/{subscription_id}",
 		auth=(settings.api_key, settings.api_secret),
+		gateway="Razorpay",
+		operation="fetch_subscription",
 	)
 
 	if resp.get("status") != "active":
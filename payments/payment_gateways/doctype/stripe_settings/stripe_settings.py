@@ -5,11 +5,12 @@ from urllib.parse import urlencode
 
 import frappe
 from frappe import _
-from frappe.integrations.utils import create_request_log, make_get_request
+from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
 from frappe.utils import call_hook_method, cint, flt, get_url
 
 from payments.utils import create_payment_gateway
+from payments.utils.http_client import make_get_request
 
 
 class StripeSettings(Document):
@@ -166,7 +167,12 @@ class StripeSettings(Document):
 				)
 			}
 			try:
-				make_get_request(url="https://api.stripe.com/v1/charges", headers=header)
+				make_get_request(
+					url="https://api.stripe.com/v1/charges",
+					headers=header,
+					gateway="Stripe",
+					operation="Charge.list",
+				)
 			except Exception:
 				frappe.throw(_("Seems Publishable Key or Secret Key is wrong !!!"))
 
@@ -191,11 +197,10 @@ class StripeSettings(Document):
 		return get_url(f"./stripe_checkout?{urlencode(kwargs)}")
 
 	def create_request(self, data):
-		import stripe
+		from payments.payment_gateways.stripe_integration import get_stripe_client
 
 		self.data = frappe._dict(data)
-		stripe.api_key = self.get_password(fieldname="secret_key", raise_exception=False)
-		stripe.default_http_client = stripe.http_client.RequestsClient()
+		self.client = get_stripe_client(self.name)
 
 		try:
 			self.integration_request = create_request_log(self.data, service_name="Stripe")
@@ -214,10 +219,8 @@ class StripeSettings(Document):
 			}
 
 	def create_charge_on_stripe(self):
-		import stripe
-
 		try:
-			charge = stripe.Charge.create(
+			charge = self.client.create_charge(
 				amount=cint(flt(self.data.amount) * 100),
 				currency=self.data.currency,
 				source=self.data.stripe_token_id,
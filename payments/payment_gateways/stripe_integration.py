@@ -1,18 +1,80 @@
 # Copyright (c) 2018, Frappe Technologies Pvt. Ltd. and contributors
 # For license information, please see license.txt
 
+import os
+import threading
+
 import stripe
 import frappe
 from frappe import _
 from frappe.integrations.utils import create_request_log
 
+from payments.utils.circuit_breaker import circuit_breaker
+from payments.utils.http_client import get_session, get_timeout
+from payments.utils.metrics import track_gateway_call
+from payments.utils.secrets import get_decrypted_secret
+
+# (site, Stripe Settings name) -> StripeClient
+_clients = {}
+_lock = threading.Lock()
+
+
+class StripeClient:
+	"""Stripe API access for a single account.
+
+	The secret key is passed with every request instead of being set on the `stripe`
+	module, and requests go over the pooled session of `payments.utils.http_client`, so
+	clients of different accounts can be used concurrently from the same process.
+	"""
+
+	def __init__(self, api_key):
+		self.api_key = api_key
+		self.pid = os.getpid()
+		# test and live mode share the API host but have a circuit each
+		self.mode = "live" if (api_key or "").startswith(("sk_live_", "rk_live_")) else "test"
+		self.requestor = stripe.api_requestor.APIRequestor(
+			key=api_key,
+			client=stripe.http_client.RequestsClient(
+				timeout=get_timeout(), session=get_session(stripe.api_base)
+			),
+		)
+
+	def request(self, method, url, operation, **params):
+		with circuit_breaker("Stripe", self.mode), track_gateway_call("Stripe", operation):
+			response, api_key = self.requestor.request(method, url, params)
+
+		return stripe.util.convert_to_stripe_object(response, api_key)
+
+	def create_charge(self, **params):
+		return self.request("post", "/v1/charges", "Charge.create", **params)
+
+	def create_customer(self, **params):
+		return self.request("post", "/v1/customers", "Customer.create", **params)
+
+	def create_subscription(self, **params):
+		return self.request("post", "/v1/subscriptions", "Subscription.create", **params)
+
+
+def get_stripe_client(gateway_controller):
+	"""Return the cached `StripeClient` of a Stripe Settings record"""
+	api_key = get_decrypted_secret(
+		"Stripe Settings", gateway_controller, "secret_key", raise_exception=False
+	)
+	key = (frappe.local.site, gateway_controller)
+
+	with _lock:
+		client = _clients.get(key)
+		# rebuilt when the key is rotated, or in a forked worker that can't share sockets
+		if not client or client.api_key != api_key or client.pid != os.getpid():
+			client = _clients[key] = StripeClient(api_key)
+
+	return client
+
 
 def create_stripe_subscription(gateway_controller, data):
 	stripe_settings = frappe.get_doc("Stripe Settings", gateway_controller)
 	stripe_settings.data = frappe._dict(data)
-
-	stripe.api_key = stripe_settings.get_password(fieldname="secret_key", raise_exception=False)
-	stripe.default_http_client = stripe.http_client.RequestsClient()
+	stripe_settings.client = get_stripe_client(gateway_controller)
 
 	try:
 		stripe_settings.integration_request = create_request_log(stripe_settings.data, "Host", "Stripe")
@@ -41,13 +103,13 @@ def create_subscription_on_stripe(stripe_settings):
 		items.append({"price": plan, "quantity": payment_plan.qty})
 
 	try:
-		customer = stripe.Customer.create(
+		customer = stripe_settings.client.create_customer(
 			source=stripe_settings.data.stripe_token_id,
 			description=stripe_settings.data.payer_name,
 			email=stripe_settings.data.payer_email,
 		)
 
-		subscription = stripe.Subscription.create(customer=customer, items=items)
+		subscription = stripe_settings.client.create_subscription(customer=customer.id, items=items)
 
 		if subscription.status == "active":
 			stripe_settings.integration_request.db_set("status", "Completed", update_modified=False)
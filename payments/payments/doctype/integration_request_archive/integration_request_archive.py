@@ -0,0 +1,14 @@
+# Copyright (c) 2026, Frappe Technologies and contributors
+# For license information, please see license.txt
+
+from frappe.model.document import Document
+
+from payments.utils.archive import decompress_payload
+
+
+class IntegrationRequestArchive(Document):
+	"""Settled Integration Request moved out of the live table, see `payments.utils.archive`."""
+
+	def get_request(self):
+		"""Return the columns of the archived Integration Request"""
+		return decompress_payload(self.payload)
@@ -0,0 +1,62 @@
+# Copyright (c) 2026, Frappe Technologies and Contributors
+# See license.txt
+
+import json
+import unittest
+
+import frappe
+from frappe.utils import add_days, now_datetime
+
+from payments.utils.archive import archive_integration_requests, get_integration_request
+
+
+class TestIntegrationRequestArchive(unittest.TestCase):
+	def setUp(self):
+		self.requests = []
+
+	def tearDown(self):
+		# archiving commits, so the requests of the test are deleted rather than rolled back
+		for doctype in ("Integration Request", "Integration Request Archive"):
+			frappe.db.delete(doctype, {"name": ("in", self.requests)})
+		frappe.db.commit()
+
+	def test_settled_requests_are_archived_and_restored(self):
+		settled = create_old_integration_request("Completed")
+		pending = create_old_integration_request("Queued")
+		self.requests += [settled, pending]
+
+		archive_integration_requests(filters={"name": ("in", self.requests)})
+
+		self.assertFalse(frappe.db.exists("Integration Request", settled))
+		self.assertTrue(frappe.db.exists("Integration Request Archive", settled))
+		self.assertTrue(frappe.db.exists("Integration Request", pending))
+
+		# a late callback still finds the request
+		request = get_integration_request(settled)
+		self.assertEqual(request.status, "Completed")
+		self.assertEqual(json.loads(request.data), {"amount": 100, "token": settled})
+		self.assertFalse(frappe.db.exists("Integration Request Archive", settled))
+
+
+def create_old_integration_request(status):
+	request = frappe.get_doc(
+		{
+			"doctype": "Integration Request",
+			"integration_request_service": "Razorpay",
+			"status": status,
+			"data": "{}",
+		}
+	).insert(ignore_permissions=True)
+
+	request.db_set(
+		{"data": json.dumps({"amount": 100, "token": request.name}), "status": status},
+		update_modified=False,
+	)
+	frappe.db.set_value(
+		"Integration Request",
+		request.name,
+		"creation",
+		add_days(now_datetime(), -365),
+		update_modified=False,
+	)
+	return request.name
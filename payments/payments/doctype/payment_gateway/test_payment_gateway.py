@@ -2,8 +2,36 @@
 # License: MIT. See LICENSE
 import unittest
 
+import frappe
+
+from payments.utils import (
+	clear_payment_gateway_controller_cache,
+	create_payment_gateway,
+	get_payment_gateway_controller,
+	validate_not_from_controller_cache,
+)
+
 # test_records = frappe.get_test_records('Payment Gateway')
 
 
 class TestPaymentGateway(unittest.TestCase):
-	pass
+	def tearDown(self):
+		frappe.db.delete("Payment Gateway", {"gateway": "_Test Gateway"})
+		clear_payment_gateway_controller_cache()
+
+	def test_missing_controller_is_cached_until_gateway_is_created(self):
+		self.assertRaises(frappe.ValidationError, get_payment_gateway_controller, "_Test Gateway")
+		self.assertEqual(frappe.cache().hget("payment_gateway_controller", "_Test Gateway"), {})
+
+		create_payment_gateway("_Test Gateway")
+		self.assertIsNone(frappe.cache().hget("payment_gateway_controller", "_Test Gateway"))
+
+	def test_cached_controller_can_not_be_saved(self):
+		create_payment_gateway(
+			"_Test Gateway", settings="Razorpay Settings", controller="Razorpay Settings"
+		)
+
+		controller = get_payment_gateway_controller("_Test Gateway")
+		self.assertRaises(frappe.ValidationError, validate_not_from_controller_cache, controller)
+		# settings loaded from the database can be saved
+		validate_not_from_controller_cache(frappe.get_doc("Razorpay Settings"))
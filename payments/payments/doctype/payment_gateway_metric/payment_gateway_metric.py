@@ -0,0 +1,40 @@
+# Copyright (c) 2026, Frappe Technologies and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import flt
+
+from payments.utils.metrics import get_latency_quantile
+
+
+class PaymentGatewayMetric(Document):
+	"""Latency summary of the calls of one gateway operation with one outcome."""
+
+	def autoname(self):
+		self.name = get_metric_name(self.gateway, self.operation, self.outcome)
+
+	def set_histogram(self, histogram):
+		"""Summarize a histogram of `payments.utils.metrics`, latencies are in milliseconds"""
+		self.calls = histogram["count"]
+		self.mean_latency = flt(histogram["sum"] * 1000 / histogram["count"], 2) if self.calls else 0
+		self.p50_latency = flt(get_latency_quantile(histogram, 0.5) * 1000, 2)
+		self.p95_latency = flt(get_latency_quantile(histogram, 0.95) * 1000, 2)
+		self.p99_latency = flt(get_latency_quantile(histogram, 0.99) * 1000, 2)
+
+
+def get_metric_name(gateway, operation, outcome):
+	return f"{gateway}-{operation}-{outcome}"
+
+
+def update_gateway_metric(gateway, operation, outcome, histogram):
+	name = get_metric_name(gateway, operation, outcome)
+
+	if frappe.db.exists("Payment Gateway Metric", name):
+		metric = frappe.get_doc("Payment Gateway Metric", name)
+	else:
+		metric = frappe.new_doc("Payment Gateway Metric")
+		metric.update({"gateway": gateway, "operation": operation, "outcome": outcome})
+
+	metric.set_histogram(histogram)
+	metric.save(ignore_permissions=True)
@@ -0,0 +1,32 @@
+# Copyright (c) 2026, Frappe Technologies and Contributors
+# See license.txt
+
+import unittest
+
+import frappe
+
+from payments.utils.metrics import BUCKET_LABELS
+
+
+class TestPaymentGatewayMetric(unittest.TestCase):
+	def test_latency_percentiles_are_interpolated_within_buckets(self):
+		buckets = dict.fromkeys(BUCKET_LABELS, 0)
+		buckets.update({"0.1": 50, "0.25": 40, "0.5": 10})
+
+		metric = frappe.new_doc("Payment Gateway Metric")
+		metric.set_histogram({"buckets": buckets, "count": 100, "sum": 15.0})
+
+		self.assertEqual(metric.calls, 100)
+		self.assertEqual(metric.mean_latency, 150)
+		self.assertEqual(metric.p50_latency, 100)
+		self.assertEqual(metric.p95_latency, 375)
+		self.assertEqual(metric.p99_latency, 475)
+
+	def test_slow_calls_are_reported_at_the_last_bound(self):
+		buckets = dict.fromkeys(BUCKET_LABELS, 0)
+		buckets["+Inf"] = 3
+
+		metric = frappe.new_doc("Payment Gateway Metric")
+		metric.set_histogram({"buckets": buckets, "count": 3, "sum": 120.0})
+
+		self.assertEqual(metric.p99_latency, 30000)
@@ -11,6 +11,7 @@ from payments.payment_gateways.doctype.braintree_settings.braintree_settings imp
 	get_client_token,
 	get_gateway_controller,
 )
+from payments.utils import get_checkout_profile, get_checkout_reference
 
 no_cache = 1
 
@@ -35,14 +36,16 @@ def get_context(context):
 		for key in expected_keys:
 			context[key] = frappe.form_dict[key]
 
-		context.client_token = get_client_token(context.reference_docname)
+		gateway_controller = get_checkout_reference(
+			"Payment Request", context.reference_docname
+		).gateway_controller
+		context.client_token = get_client_token(context.reference_docname, gateway_controller)
 
 		context["amount"] = flt(context["amount"])
 
-		gateway_controller = get_gateway_controller(context.reference_docname)
-		context["header_img"] = frappe.db.get_value(
-			"Braintree Settings", gateway_controller, "header_img"
-		)
+		context["header_img"] = get_checkout_profile(
+			"Braintree Settings", gateway_controller
+		).header_img
 
 	else:
 		frappe.redirect_to_message(
@@ -8,9 +8,9 @@ from frappe import _
 from frappe.utils import flt, get_url
 
 from payments.payment_gateways.doctype.gocardless_settings.gocardless_settings import (
-	get_gateway_controller,
 	gocardless_initialization,
 )
+from payments.utils import get_checkout_profile, get_checkout_reference
 
 no_cache = 1
 
@@ -37,10 +37,12 @@ def get_context(context):
 
 		context["amount"] = flt(context["amount"])
 
-		gateway_controller = get_gateway_controller(context.reference_docname)
-		context["header_img"] = frappe.db.get_value(
-			"GoCardless Settings", gateway_controller, "header_img"
-		)
+		gateway_controller = get_checkout_reference(
+			"Payment Request", context.reference_docname
+		).gateway_controller
+		context["header_img"] = get_checkout_profile(
+			"GoCardless Settings", gateway_controller
+		).header_img
 
 	else:
 		frappe.redirect_to_message(
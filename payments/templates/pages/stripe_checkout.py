@@ -9,6 +9,7 @@ from frappe.utils import cint, fmt_money
 from payments.payment_gateways.doctype.stripe_settings.stripe_settings import (
 	get_gateway_controller,
 )
+from payments.utils import get_checkout_profile, get_checkout_reference
 
 no_cache = 1
 
@@ -33,17 +34,16 @@ def get_context(context):
 		for key in expected_keys:
 			context[key] = frappe.form_dict[key]
 
-		gateway_controller = get_gateway_controller(context.reference_doctype, context.reference_docname)
-		context.publishable_key = get_api_key(context.reference_docname, gateway_controller)
-		context.image = get_header_image(context.reference_docname, gateway_controller)
+		reference = get_checkout_reference(
+			context.reference_doctype, context.reference_docname, ("is_a_subscription", "payment_plan")
+		)
+		context.publishable_key = get_api_key(context.reference_docname, reference.gateway_controller)
+		context.image = get_header_image(context.reference_docname, reference.gateway_controller)
 
 		context["amount"] = fmt_money(amount=context["amount"], currency=context["currency"])
 
-		if is_a_subscription(context.reference_doctype, context.reference_docname):
-			payment_plan = frappe.db.get_value(
-				context.reference_doctype, context.reference_docname, "payment_plan"
-			)
-			recurrence = frappe.db.get_value("Payment Plan", payment_plan, "recurrence")
+		if reference.is_a_subscription:
+			recurrence = frappe.db.get_value("Payment Plan", reference.payment_plan, "recurrence")
 
 			context["amount"] = context["amount"] + " " + _(recurrence)
 
@@ -57,7 +57,7 @@ def get_context(context):
 
 
 def get_api_key(doc, gateway_controller):
-	publishable_key = frappe.db.get_value("Stripe Settings", gateway_controller, "publishable_key")
+	publishable_key = get_checkout_profile("Stripe Settings", gateway_controller).publishable_key
 	if cint(frappe.form_dict.get("use_sandbox")):
 		publishable_key = frappe.conf.sandbox_publishable_key
 
@@ -65,7 +65,7 @@ def get_api_key(doc, gateway_controller):
 
 
 def get_header_image(doc, gateway_controller):
-	header_image = frappe.db.get_value("Stripe Settings", gateway_controller, "header_img")
+	header_image = get_checkout_profile("Stripe Settings", gateway_controller).header_img
 
 	return header_image
 
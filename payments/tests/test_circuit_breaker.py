@@ -0,0 +1,90 @@
+# Copyright (c) 2026, Frappe Technologies and Contributors
+# See license.txt
+
+import unittest
+
+import frappe
+
+from payments.utils import get_site_thread_pool
+from payments.utils.circuit_breaker import (
+	GatewayUnavailableError,
+	circuit_breaker,
+	get_circuit_keys,
+	get_circuit_state,
+	get_failure_threshold,
+	reset_circuit,
+)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+	def tearDown(self):
+		reset_circuit("_Test Gateway")
+
+	def test_circuit_opens_after_failures_and_closes_after_a_successful_probe(self):
+		trip_circuit("live")
+		self.assertEqual(get_circuit_state("_Test Gateway", "live"), "open")
+		self.assertRaises(GatewayUnavailableError, call_gateway, "live")
+		# the other targets of the gateway keep their own circuit
+		self.assertEqual(get_circuit_state("_Test Gateway", "sandbox"), "closed")
+
+		end_open_period("live")
+		self.assertEqual(get_circuit_state("_Test Gateway", "live"), "half-open")
+		with circuit_breaker("_Test Gateway", "live"):
+			# only one call probes the gateway at a time
+			self.assertRaises(GatewayUnavailableError, call_gateway, "live")
+
+		self.assertEqual(get_circuit_state("_Test Gateway", "live"), "closed")
+
+	def test_failed_probe_opens_the_circuit_again(self):
+		trip_circuit("live")
+		end_open_period("live")
+
+		self.assertRaises(ConnectionError, call_gateway, "live", ConnectionError())
+		self.assertEqual(get_circuit_state("_Test Gateway", "live"), "open")
+
+	def test_errors_with_an_answer_from_the_gateway_do_not_open_the_circuit(self):
+		for _i in range(get_failure_threshold()):
+			self.assertRaises(frappe.ValidationError, call_gateway, "live", frappe.ValidationError())
+
+		self.assertEqual(get_circuit_state("_Test Gateway", "live"), "closed")
+
+		trip_circuit("live")
+		end_open_period("live")
+		# a probe failing for a reason of its own lets the next call probe
+		self.assertRaises(ValueError, call_gateway, "live", ValueError())
+		self.assertEqual(get_circuit_state("_Test Gateway", "live"), "half-open")
+		call_gateway("live")
+		self.assertEqual(get_circuit_state("_Test Gateway", "live"), "closed")
+
+	def test_calls_from_site_thread_pools_are_guarded(self):
+		with get_site_thread_pool(2) as executor:
+			futures = [
+				executor.submit(call_gateway, "live", ConnectionError())
+				for _i in range(get_failure_threshold())
+			]
+
+		for future in futures:
+			self.assertIsInstance(future.exception(), ConnectionError)
+		self.assertEqual(get_circuit_state("_Test Gateway", "live"), "open")
+
+		with get_site_thread_pool(1) as executor:
+			future = executor.submit(call_gateway, "live")
+		self.assertIsInstance(future.exception(), GatewayUnavailableError)
+
+
+def call_gateway(target, exception=None):
+	with circuit_breaker("_Test Gateway", target):
+		if exception:
+			raise exception
+
+
+def trip_circuit(target):
+	for _i in range(get_failure_threshold()):
+		try:
+			call_gateway(target, ConnectionError())
+		except ConnectionError:
+			pass
+
+
+def end_open_period(target):
+	frappe.cache().delete(get_circuit_keys("_Test Gateway", target).open)
@@ -0,0 +1,36 @@
+# Copyright (c) 2026, Frappe Technologies and Contributors
+# See license.txt
+
+import time
+import unittest
+
+import frappe
+
+from payments.utils import http_client
+
+
+class TestHttpClient(unittest.TestCase):
+	def test_adaptive_timeouts_are_clamped(self):
+		conf = frappe.local.conf
+		keys = (
+			"payments_http_read_timeout",
+			"payments_http_min_read_timeout",
+			"payments_http_timeout_multiplier",
+		)
+		saved = {key: conf.get(key) for key in keys}
+		conf.update(dict(zip(keys, (30, 2, 3))))
+		http_client._latency_p99s[frappe.local.site] = (
+			time.monotonic(),
+			{("_Test", "fast"): 0.1, ("_Test", "typical"): 1.5, ("_Test", "slow"): 20},
+		)
+
+		try:
+			connect = http_client.get_timeout()[0]
+			self.assertEqual(http_client.get_adaptive_timeout("_Test", "fast"), (connect, 2))
+			self.assertEqual(http_client.get_adaptive_timeout("_Test", "typical"), (connect, 4.5))
+			self.assertEqual(http_client.get_adaptive_timeout("_Test", "slow"), (connect, 30))
+			# operations without enough history use the configured timeouts
+			self.assertEqual(http_client.get_adaptive_timeout("_Test", "new"), (connect, 30))
+		finally:
+			http_client._latency_p99s.pop(frappe.local.site, None)
+			conf.update(saved)
@@ -0,0 +1,145 @@
+# Copyright (c) 2026, Frappe Technologies and Contributors
+# See license.txt
+
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import frappe
+from frappe.utils import add_to_date, now_datetime
+
+from payments.utils import (
+	claim_integration_requests,
+	iterate_in_pages,
+	release_integration_request_lease,
+)
+
+TEST_SERVICE = "_Test Utils"
+
+
+class TestClaimIntegrationRequests(unittest.TestCase):
+	def setUp(self):
+		self.names = [create_integration_request() for _i in range(6)]
+		frappe.db.commit()
+
+	def tearDown(self):
+		# claiming commits, the records can't be rolled back
+		frappe.db.rollback()
+		frappe.db.delete("Integration Request", {"integration_request_service": TEST_SERVICE})
+		frappe.db.commit()
+
+	def test_concurrent_claimers_get_different_rows(self):
+		owners = [f"_Test Owner {i}" for i in range(3)]
+		barrier = threading.Barrier(len(owners))
+		site = frappe.local.site
+		sites_path = frappe.local.sites_path
+
+		with ThreadPoolExecutor(max_workers=len(owners)) as executor:
+			futures = [
+				executor.submit(claim_from_new_connection, site, sites_path, barrier, owner)
+				for owner in owners
+			]
+
+		claimed = [future.result() for future in futures]
+		all_claimed = [name for names in claimed for name in names]
+		self.assertEqual(len(all_claimed), len(set(all_claimed)))
+		self.assertTrue(set(all_claimed) <= set(self.names))
+
+		for owner, names in zip(owners, claimed):
+			for name in names:
+				self.assertEqual(frappe.db.get_value("Integration Request", name, "lease_owner"), owner)
+
+	def test_live_lease_is_not_claimed_by_another_owner(self):
+		claimed = claim_integration_requests(get_test_filters(), 2, "_Test Owner 1")
+		self.assertEqual(len(claimed), 2)
+
+		others = claim_integration_requests(get_test_filters(), 10, "_Test Owner 2")
+		self.assertFalse(set(claimed) & set(others))
+		self.assertEqual(len(others), len(self.names) - 2)
+
+		# with every row leased, nothing is left to claim
+		self.assertEqual(claim_integration_requests(get_test_filters(), 10, "_Test Owner 3"), [])
+
+	def test_expired_or_released_lease_can_be_claimed_again(self):
+		claimed = claim_integration_requests(get_test_filters(), len(self.names), "_Test Owner 1")
+		self.assertEqual(sorted(claimed), sorted(self.names))
+
+		frappe.db.set_value(
+			"Integration Request",
+			claimed[0],
+			"lease_expires_on",
+			add_to_date(now_datetime(), seconds=-1),
+			update_modified=False,
+		)
+		release_integration_request_lease(claimed[1])
+		frappe.db.commit()
+
+		reclaimed = claim_integration_requests(get_test_filters(), 10, "_Test Owner 2")
+		self.assertEqual(sorted(reclaimed), sorted(claimed[:2]))
+
+
+class TestIterateInPages(unittest.TestCase):
+	def setUp(self):
+		self.names = [create_integration_request() for _i in range(7)]
+		# rows created in the same instant are ordered by name
+		creation = now_datetime()
+		for name in self.names[2:5]:
+			frappe.db.set_value("Integration Request", name, "creation", creation, update_modified=False)
+
+	def tearDown(self):
+		frappe.db.rollback()
+
+	def test_pages_are_ordered_by_creation_and_name(self):
+		pages = list(iterate_in_pages("Integration Request", get_test_filters(), page_length=3))
+		self.assertEqual([len(page) for page in pages], [3, 3, 1])
+
+		rows = [row for page in pages for row in page]
+		expected = frappe.get_all(
+			"Integration Request",
+			filters=get_test_filters(),
+			order_by="creation asc, name asc",
+			pluck="name",
+		)
+		self.assertEqual([row.name for row in rows], expected)
+		self.assertEqual(sorted(expected), sorted(self.names))
+
+	def test_rows_updated_while_iterating_are_yielded_once(self):
+		seen = []
+		for page in iterate_in_pages("Integration Request", get_test_filters(), page_length=2):
+			for row in page:
+				seen.append(row.name)
+				# the row no longer matches the filters of the next pages
+				frappe.db.set_value("Integration Request", row.name, "status", "Completed")
+
+		self.assertEqual(sorted(seen), sorted(self.names))
+		self.assertEqual(len(seen), len(set(seen)))
+
+
+def create_integration_request(**kwargs):
+	return (
+		frappe.get_doc(
+			{
+				"doctype": "Integration Request",
+				"integration_request_service": TEST_SERVICE,
+				"status": "Queued",
+				"data": "{}",
+				**kwargs,
+			}
+		)
+		.insert(ignore_permissions=True)
+		.name
+	)
+
+
+def get_test_filters():
+	return {"integration_request_service": TEST_SERVICE, "status": "Queued"}
+
+
+def claim_from_new_connection(site, sites_path, barrier, owner):
+	frappe.init(site, sites_path)
+	frappe.connect()
+	try:
+		barrier.wait()
+		return claim_integration_requests(get_test_filters(), 4, owner)
+	finally:
+		frappe.destroy()
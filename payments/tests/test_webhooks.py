@@ -0,0 +1,140 @@
+# Copyright (c) 2026, Frappe Technologies and Contributors
+# See license.txt
+
+import unittest
+
+import frappe
+from frappe.utils import add_to_date, now_datetime
+
+from payments.utils.webhooks import (
+	claim_webhook_event,
+	persist_webhook,
+	process_pending_webhooks,
+	release_webhook_event,
+)
+
+TEST_SERVICE = "_Test Webhooks"
+TEST_HANDLER = "payments.tests.test_webhooks.handle_test_webhook"
+
+# notifications handled by `handle_test_webhook`, and the ones it fails to handle
+handled_webhooks = []
+failing_webhooks = set()
+
+
+class TestWebhookEvents(unittest.TestCase):
+	def setUp(self):
+		self.event_id = frappe.generate_hash(length=12)
+
+	def tearDown(self):
+		# persisting commits, the records can't be rolled back
+		frappe.db.rollback()
+		frappe.db.delete("Integration Request", {"integration_request_service": TEST_SERVICE})
+		frappe.db.commit()
+		release_webhook_event(TEST_SERVICE, self.event_id)
+
+	def test_redelivered_event_is_acknowledged_without_processing(self):
+		self.assertIsNotNone(persist_webhook(TEST_SERVICE, {"event": "created"}, self.event_id))
+		self.assertIsNone(persist_webhook(TEST_SERVICE, {"event": "created"}, self.event_id))
+		self.assertEqual(get_stored_webhooks(), 1)
+
+		# other services keep their own event ids
+		self.assertTrue(claim_webhook_event("_Test Other Webhooks", self.event_id))
+		release_webhook_event("_Test Other Webhooks", self.event_id)
+
+	def test_failed_processing_releases_the_event(self):
+		# the data can't be serialized, so storing the notification fails
+		self.assertRaises(TypeError, persist_webhook, TEST_SERVICE, {"event": object()}, self.event_id)
+		self.assertEqual(get_stored_webhooks(), 0)
+
+		# the retry of the gateway is processed
+		self.assertIsNotNone(persist_webhook(TEST_SERVICE, {"event": "created"}, self.event_id))
+		self.assertEqual(get_stored_webhooks(), 1)
+
+	def test_events_without_an_id_are_always_processed(self):
+		self.assertTrue(claim_webhook_event(TEST_SERVICE, None))
+		self.assertTrue(claim_webhook_event(TEST_SERVICE, None))
+
+
+class TestProcessPendingWebhooks(unittest.TestCase):
+	def setUp(self):
+		self.verified_subscriptions = []
+
+	def tearDown(self):
+		handled_webhooks.clear()
+		failing_webhooks.clear()
+		frappe.db.rollback()
+		frappe.db.delete("Integration Request", {"integration_request_service": TEST_SERVICE})
+		frappe.db.commit()
+
+	def test_webhooks_are_verified_per_subscription_and_handled_in_order(self):
+		active = [persist_subscription_webhook("sub_active", i) for i in range(3)]
+		inactive = persist_subscription_webhook("sub_inactive", 0)
+		invalid = persist_webhook(TEST_SERVICE, {"payload": {}}).name
+
+		self.process_webhooks()
+
+		self.assertEqual(sorted(self.verified_subscriptions), ["sub_active", "sub_inactive"])
+		self.assertEqual(handled_webhooks, active)
+		for name in active:
+			self.assertEqual(get_webhook_status(name), ("Verified", "Queued"))
+		for name in (inactive, invalid):
+			self.assertEqual(get_webhook_status(name), ("Rejected", "Failed"))
+
+		# handled notifications are not processed again
+		self.process_webhooks()
+		self.assertEqual(handled_webhooks, active)
+
+	def test_failed_handler_leaves_the_webhook_pending(self):
+		name = persist_subscription_webhook("sub_active", 0)
+		failing_webhooks.add(name)
+
+		self.process_webhooks()
+		self.assertEqual(handled_webhooks, [])
+		self.assertEqual(get_webhook_status(name), ("Pending", "Queued"))
+
+		# the notification is retried once its lease expires
+		failing_webhooks.clear()
+		frappe.db.set_value(
+			"Integration Request",
+			name,
+			"lease_expires_on",
+			add_to_date(now_datetime(), seconds=-1),
+			update_modified=False,
+		)
+		frappe.db.commit()
+
+		self.process_webhooks()
+		self.assertEqual(handled_webhooks, [name])
+		self.assertEqual(get_webhook_status(name), ("Verified", "Queued"))
+
+	def process_webhooks(self):
+		def verify(subscription_id):
+			self.verified_subscriptions.append(subscription_id)
+			return subscription_id != "sub_inactive"
+
+		process_pending_webhooks(
+			TEST_SERVICE,
+			lambda data: data["payload"]["subscription"]["entity"]["id"],
+			verify,
+			TEST_HANDLER,
+		)
+
+
+def handle_test_webhook(doctype, docname):
+	if docname in failing_webhooks:
+		raise frappe.ValidationError
+
+	handled_webhooks.append(docname)
+
+
+def persist_subscription_webhook(subscription_id, sequence):
+	data = {"payload": {"subscription": {"entity": {"id": subscription_id}}}, "sequence": sequence}
+	return persist_webhook(TEST_SERVICE, data).name
+
+
+def get_webhook_status(name):
+	return frappe.db.get_value("Integration Request", name, ["webhook_status", "status"])
+
+
+def get_stored_webhooks():
+	return frappe.db.count("Integration Request", {"integration_request_service": TEST_SERVICE})
@@ -0,0 +1,390 @@
+"""
+Test utilities shared by the tests and the offline benchmarks.
+
+Local stand-ins of the gateway APIs, and the payloads the gateways send back.
+
+Each stand-in is a small threaded HTTP server that answers the endpoints the integrations
+call with canned, successful responses. `latency_ms` delays every response and a share
+`error_rate` of the requests fails with the error the gateway would return, picked by a
+seeded random generator so that runs are repeatable.
+
+	with run_standins(["Razorpay", "PayPal"], latency_ms=20, error_rate=0.05) as standins:
+		...  # every request to the gateway hosts is now served locally
+"""
+
+import json
+import random
+import secrets
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from payments.utils.http_client import override_hosts
+
+# live and sandbox hosts of every gateway, all of them are served by its stand-in
+GATEWAY_HOSTS = {
+	"Razorpay": ("https://api.razorpay.com",),
+	"PayPal": ("https://api-3t.paypal.com", "https://api-3t.sandbox.paypal.com"),
+	"Mpesa": ("https://api.safaricom.co.ke", "https://sandbox.safaricom.co.ke"),
+	"Paytm": ("https://securegw.paytm.in", "https://securegw-stage.paytm.in"),
+	"GoCardless": ("https://api.gocardless.com", "https://api-sandbox.gocardless.com"),
+}
+
+
+class StandinServer:
+	"""Threaded HTTP server answering for one gateway on a free local port"""
+
+	def __init__(self, gateway, latency_ms=0, error_rate=0.0, seed=0):
+		self.gateway = gateway
+		self.route = ROUTES[gateway]
+		self.latency_ms = latency_ms
+		self.error_rate = error_rate
+		self.request_count = 0
+		# ids handed out by the stand-in, e.g. the checkout ids of Mpesa stk pushes
+		self.issued_ids = []
+
+		self._random = random.Random(seed)
+		self._lock = threading.Lock()
+		self._server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(self))
+		self._server.daemon_threads = True
+		self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+	@property
+	def url(self):
+		host, port = self._server.server_address[:2]
+		return f"http://{host}:{port}"
+
+	def start(self):
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self._server.shutdown()
+		self._server.server_close()
+
+	def respond(self, method, path, query, body):
+		"""Return the (status, content type, body) answering a request"""
+		with self._lock:
+			self.request_count += 1
+			fail = self._random.random() < self.error_rate
+
+		if self.latency_ms:
+			time.sleep(self.latency_ms / 1000)
+
+		if fail:
+			return ERRORS[self.gateway]()
+
+		return self.route(self, method, path, query, body)
+
+	def issue_id(self, prefix):
+		new_id = prefix + random_id(14)
+		with self._lock:
+			self.issued_ids.append(new_id)
+		return new_id
+
+
+def make_handler(standin):
+	class Handler(BaseHTTPRequestHandler):
+		# keep connections alive, as the gateways do
+		protocol_version = "HTTP/1.1"
+
+		def handle_request(self):
+			parts = urlsplit(self.path)
+			length = int(self.headers.get("Content-Length") or 0)
+			body = self.rfile.read(length).decode() if length else ""
+
+			status, content_type, payload = standin.respond(
+				self.command, parts.path, parse_qs(parts.query), parse_body(self.headers, body)
+			)
+			if not isinstance(payload, str):
+				payload = json.dumps(payload)
+			payload = payload.encode()
+
+			self.send_response(status)
+			self.send_header("Content-Type", content_type)
+			self.send_header("Content-Length", str(len(payload)))
+			self.end_headers()
+			self.wfile.write(payload)
+
+		do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+		def log_message(self, format, *args):
+			pass
+
+	return Handler
+
+
+def random_id(length):
+	return secrets.token_hex(length)[:length].upper()
+
+
+def parse_body(headers, body):
+	if not body:
+		return {}
+
+	if "json" in (headers.get("Content-Type") or "").lower() or body.lstrip().startswith("{"):
+		return json.loads(body)
+
+	return {key: values[0] for key, values in parse_qs(body).items()}
+
+
+@contextmanager
+def run_standins(gateways, latency_ms=0, error_rate=0.0, seed=0):
+	"""Start a stand-in per gateway and route the requests to the gateway hosts to it.
+
+	Yields a dict of the `StandinServer` of every gateway.
+	"""
+	with ExitStack() as stack:
+		standins = {}
+		for gateway in gateways:
+			standin = StandinServer(gateway, latency_ms, error_rate, seed).start()
+			stack.callback(standin.stop)
+			standins[gateway] = standin
+
+		stack.enter_context(
+			override_hosts(
+				{host: standins[gateway].url for gateway in standins for host in GATEWAY_HOSTS[gateway]}
+			)
+		)
+		yield standins
+
+
+def json_response(payload, status=200):
+	return status, "application/json; charset=utf-8", payload
+
+
+def not_found():
+	return json_response({"error": {"code": "NOT_FOUND", "description": "Unknown endpoint"}}, 404)
+
+
+def razorpay_route(standin, method, path, query, body):
+	segments = path.strip("/").split("/")[1:]
+
+	if segments == ["payments"]:
+		return json_response({"entity": "collection", "count": 0, "items": []})
+
+	if segments == ["orders"] and method == "POST":
+		return json_response(
+			{
+				"id": standin.issue_id("order_"),
+				"entity": "order",
+				"amount": int(body.get("amount") or 0),
+				"currency": body.get("currency") or "INR",
+				"receipt": body.get("receipt"),
+				"status": "created",
+			}
+		)
+
+	if len(segments) >= 2 and segments[0] == "payments":
+		captured = segments[2:] == ["capture"]
+		return json_response(
+			{
+				"id": segments[1],
+				"entity": "payment",
+				"amount": int(body.get("amount") or query.get("amount", [0])[0]),
+				"currency": "INR",
+				"status": "captured" if captured else "authorized",
+				"captured": captured,
+			}
+		)
+
+	if len(segments) >= 2 and segments[0] == "subscriptions":
+		return json_response({"id": segments[1], "entity": "subscription", "status": "active"})
+
+	return not_found()
+
+
+def paypal_route(standin, method, path, query, body):
+	response = {"ACK": "Success", "CORRELATIONID": random_id(13)}
+	api_method = body.get("METHOD")
+
+	if api_method == "SetExpressCheckout":
+		response["TOKEN"] = standin.issue_id("EC-")
+	elif api_method == "GetExpressCheckoutDetails":
+		response.update(
+			{"TOKEN": body.get("TOKEN"), "PAYERID": "BENCHPAYER", "EMAIL": "payer@example.com"}
+		)
+	elif api_method == "DoExpressCheckoutPayment":
+		response.update(
+			{
+				"TOKEN": body.get("TOKEN"),
+				"PAYMENTINFO_0_TRANSACTIONID": standin.issue_id(""),
+				"PAYMENTINFO_0_PAYMENTSTATUS": "Completed",
+			}
+		)
+
+	# the nvp api answers with an urlencoded body
+	return 200, "text/plain; charset=utf-8", urlencode(response)
+
+
+def mpesa_route(standin, method, path, query, body):
+	if path == "/oauth/v1/generate":
+		return json_response({"access_token": random_id(28), "expires_in": "3599"})
+
+	if path == "/mpesa/stkpush/v1/processrequest":
+		return json_response(
+			{
+				"MerchantRequestID": random_id(12),
+				"CheckoutRequestID": standin.issue_id("ws_CO_"),
+				"ResponseCode": "0",
+				"ResponseDescription": "Success. Request accepted for processing",
+				"CustomerMessage": "Success. Request accepted for processing",
+			}
+		)
+
+	return not_found()
+
+
+def paytm_route(standin, method, path, query, body):
+	if path == "/order/status":
+		return json_response(
+			{
+				"MID": body.get("MID"),
+				"ORDERID": body.get("ORDERID"),
+				"TXNID": standin.issue_id(""),
+				"STATUS": "TXN_SUCCESS",
+				"RESPCODE": "01",
+				"RESPMSG": "Txn Success",
+			}
+		)
+
+	return not_found()
+
+
+def gocardless_route(standin, method, path, query, body):
+	segments = path.strip("/").split("/")
+
+	if segments == ["redirect_flows"]:
+		flow_id = standin.issue_id("RE")
+		return json_response(
+			{
+				"redirect_flows": {
+					"id": flow_id,
+					"redirect_url": f"https://pay-sandbox.gocardless.com/flow/{flow_id}",
+					"links": {"creditor": "CR0001"},
+				}
+			},
+			201,
+		)
+
+	if segments[:1] == ["redirect_flows"] and segments[2:] == ["actions", "complete"]:
+		return json_response(
+			{
+				"redirect_flows": {
+					"id": segments[1],
+					"confirmation_url": f"https://pay-sandbox.gocardless.com/flow/{segments[1]}/success",
+					"links": {
+						"creditor": "CR0001",
+						"customer": standin.issue_id("CU"),
+						"mandate": standin.issue_id("MD"),
+					},
+				}
+			}
+		)
+
+	if segments == ["payments"] and method == "POST":
+		payment = body.get("payments") or {}
+		return json_response(
+			{
+				"payments": {
+					"id": standin.issue_id("PM"),
+					"amount": payment.get("amount"),
+					"currency": payment.get("currency"),
+					"status": "pending_submission",
+					"links": payment.get("links") or {},
+				}
+			},
+			201,
+		)
+
+	if segments[:1] == ["mandates"] and len(segments) == 2:
+		return json_response({"mandates": {"id": segments[1], "status": "active"}})
+
+	return not_found()
+
+
+def razorpay_error():
+	return json_response(
+		{"error": {"code": "SERVER_ERROR", "description": "The server encountered an error."}}, 503
+	)
+
+
+def paypal_error():
+	# nvp errors come with a 200 and a failed acknowledgement
+	response = {"ACK": "Failure", "L_ERRORCODE0": "10001", "L_SHORTMESSAGE0": "Internal Error"}
+	return 200, "text/plain; charset=utf-8", urlencode(response)
+
+
+def mpesa_error():
+	return json_response(
+		{
+			"requestId": random_id(12),
+			"errorCode": "503.001.01",
+			"errorMessage": "Service is currently unavailable",
+		},
+		503,
+	)
+
+
+def paytm_error():
+	return json_response({"STATUS": "PENDING", "RESPCODE": "501", "RESPMSG": "System Error"})
+
+
+def gocardless_error():
+	return json_response(
+		{
+			"error": {
+				"type": "gocardless",
+				"code": 503,
+				"message": "Service unavailable",
+				"errors": [],
+				"documentation_url": "https://developer.gocardless.com/api-reference#gocardless",
+				"request_id": random_id(12),
+			}
+		},
+		503,
+	)
+
+
+ROUTES = {
+	"Razorpay": razorpay_route,
+	"PayPal": paypal_route,
+	"Mpesa": mpesa_route,
+	"Paytm": paytm_route,
+	"GoCardless": gocardless_route,
+}
+
+ERRORS = {
+	"Razorpay": razorpay_error,
+	"PayPal": paypal_error,
+	"Mpesa": mpesa_error,
+	"Paytm": paytm_error,
+	"GoCardless": gocardless_error,
+}
+
+
+def get_payment_callback_payload(
+	Amount=500, CheckoutRequestID="ws_CO_061020201133231972", MpesaReceiptNumber="LGR7OWQX0R"
+):
+	"""Response received from the server as callback after calling the stkpush process request API."""
+	return {
+		"Body": {
+			"stkCallback": {
+				"MerchantRequestID": "19465-780693-1",
+				"CheckoutRequestID": CheckoutRequestID,
+				"ResultCode": 0,
+				"ResultDesc": "The service request is processed successfully.",
+				"CallbackMetadata": {
+					"Item": [
+						{"Name": "Amount", "Value": Amount},
+						{"Name": "MpesaReceiptNumber", "Value": MpesaReceiptNumber},
+						{"Name": "Balance"},
+						{"Name": "TransactionDate", "Value": 20170727154800},
+						{"Name": "PhoneNumber", "Value": 254721566839},
+					]
+				},
+			}
+		}
+	}
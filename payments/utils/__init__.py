@@ -1,8 +1,24 @@
 from payments.utils.utils import (
 	before_install,
+	bulk_create_request_logs,
+	claim_integration_requests,
+	clear_payment_gateway_controller_cache,
 	create_payment_gateway,
 	delete_custom_fields,
+	get_cache_counters,
+	get_checkout_profile,
+	get_checkout_reference,
+	get_filter_conditions,
+	get_gateway_amount,
+	get_gateway_fields,
+	get_lease_owner,
 	get_payment_gateway_controller,
+	get_site_thread_pool,
+	iterate_in_pages,
 	make_custom_fields,
+	make_integration_request_fields,
+	release_integration_request_lease,
+	set_integration_request_gateway_fields,
+	validate_not_from_controller_cache,
 	erpnext_app_import_guard,
 )
@@ -0,0 +1,157 @@
+"""
+Archival of settled Integration Requests.
+
+Completed, Failed and Cancelled requests older than `payments_archive_after_days` are moved,
+a batch at a time, to Integration Request Archive. There every request is a single row
+holding its columns as compressed JSON, with the few columns needed to find it again kept
+in the clear. This keeps the live table, and the lookups of every new payment on it, small.
+
+Gateways can still call back long after a request was settled, so callbacks look requests
+up with `get_integration_request`, which transparently restores an archived request to the
+live table first.
+
+Site config:
+	payments_archive_after_days: age in days after which settled requests are archived (default 90)
+	payments_archive_batch_size: requests moved per batch and transaction (default 500)
+	payments_archive_max_batches: batches moved per run of the scheduler job (default 100)
+"""
+
+import base64
+import json
+import zlib
+
+import frappe
+from frappe.utils import add_days, cint, now_datetime
+
+from payments.utils.utils import as_json, iterate_in_pages
+
+ARCHIVED_STATUSES = ("Completed", "Failed", "Cancelled")
+DEFAULT_ARCHIVE_AFTER_DAYS = 90
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_MAX_BATCHES = 100
+
+ARCHIVE_FIELDS = (
+	"name",
+	"creation",
+	"modified",
+	"owner",
+	"modified_by",
+	"docstatus",
+	"integration_request_service",
+	"status",
+	"reference_doctype",
+	"reference_docname",
+	"gateway_payment_id",
+	"request_created_on",
+	"payload",
+)
+
+
+def archive_integration_requests(filters=None):
+	"""Move settled Integration Requests past the archival age to the archive.
+
+	Runs daily from the scheduler and moves at most `payments_archive_max_batches` batches,
+	so that a large backlog is worked off over a few runs. `filters` narrows down the
+	requests to archive further. Returns the number of requests archived.
+	"""
+	days = cint(frappe.conf.payments_archive_after_days) or DEFAULT_ARCHIVE_AFTER_DAYS
+	batch_size = cint(frappe.conf.payments_archive_batch_size) or DEFAULT_BATCH_SIZE
+	max_batches = cint(frappe.conf.payments_archive_max_batches) or DEFAULT_MAX_BATCHES
+	filters = {
+		**(filters or {}),
+		"status": ("in", ARCHIVED_STATUSES),
+		"creation": ("<", add_days(now_datetime(), -days)),
+	}
+
+	archived = 0
+	for batch, page in enumerate(
+		iterate_in_pages("Integration Request", filters=filters, page_length=batch_size), start=1
+	):
+		archived += archive_batch([row.name for row in page])
+		frappe.db.commit()
+
+		if batch >= max_batches:
+			break
+
+	return archived
+
+
+def archive_batch(names):
+	requests = frappe.get_all(
+		"Integration Request", filters={"name": ("in", names)}, fields=["*"], order_by="creation"
+	)
+	if not requests:
+		return 0
+
+	timestamp = now_datetime()
+	values = [
+		(
+			request.name,
+			timestamp,
+			timestamp,
+			frappe.session.user,
+			frappe.session.user,
+			0,
+			request.integration_request_service,
+			request.status,
+			request.reference_doctype,
+			request.reference_docname,
+			request.get("gateway_payment_id"),
+			request.creation,
+			compress_payload(request),
+		)
+		for request in requests
+	]
+
+	frappe.db.bulk_insert("Integration Request Archive", ARCHIVE_FIELDS, values)
+	frappe.db.delete("Integration Request", {"name": ("in", [request.name for request in requests])})
+	return len(requests)
+
+
+def get_integration_request(name):
+	"""Return the Integration Request `name`, restoring it from the archive if it was archived"""
+	restore_integration_request(name)
+	return frappe.get_doc("Integration Request", name)
+
+
+def get_archived_integration_requests(filters):
+	"""Return the archived Integration Requests matching `filters`, as dicts of their columns.
+
+	`filters` can only use the columns kept in the clear in the archive, e.g. the status
+	and reference of the requests.
+	"""
+	payloads = frappe.get_all(
+		"Integration Request Archive", filters=filters, pluck="payload", order_by="request_created_on"
+	)
+	return [frappe._dict(decompress_payload(payload)) for payload in payloads]
+
+
+def restore_integration_request(name):
+	"""Move an archived Integration Request back to the live table.
+
+	Returns True when the request was restored; live and unknown requests are left as they are.
+	"""
+	if not name or frappe.db.exists("Integration Request", name):
+		return False
+
+	payload = frappe.db.get_value("Integration Request Archive", name, "payload")
+	if payload is None:
+		return False
+
+	# columns may have been added or dropped since the request was archived
+	columns = set(frappe.db.get_table_columns("Integration Request"))
+	request = {key: value for key, value in decompress_payload(payload).items() if key in columns}
+	fields = tuple(request)
+	values = [tuple(request[field] for field in fields)]
+
+	frappe.db.bulk_insert("Integration Request", fields, values, ignore_duplicates=True)
+	frappe.db.delete("Integration Request Archive", {"name": name})
+	return True
+
+
+def compress_payload(request):
+	return base64.b64encode(zlib.compress(as_json(request).encode())).decode()
+
+
+def decompress_payload(payload):
+	return json.loads(zlib.decompress(base64.b64decode(payload)))
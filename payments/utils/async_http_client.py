@@ -0,0 +1,185 @@
+"""
+asyncio counterpart of `payments.utils.http_client` for batch jobs.
+
+A job that has many independent gateway calls to make (captures, reconciliations, status
+polling) builds one coroutine per call and runs them all from its worker on a single event
+loop, at most `payments_async_concurrency` at a time:
+
+	results = run_concurrently(async_fetch_and_capture_payment(...) for payment in payments)
+
+`run_concurrently` opens one `httpx.AsyncClient` for the run, so the calls share its pool of
+kept-alive connections. Jobs that make their calls in several rounds, e.g. a page at a time,
+open `async_client` once in their own coroutine and await `gather_bounded` in it per round.
+
+Calls are timed in `payments.utils.metrics`, guarded by the circuit breakers, get adaptive
+timeouts and follow the host overrides of `http_client`, exactly like their synchronous
+counterparts.
+
+The jobs that have an asyncio mode only use it with `payments_async_transport` set in site
+config, and keep their thread pools otherwise.
+
+Site config:
+	payments_async_transport: use the asyncio mode of batch jobs (default off)
+	payments_async_concurrency: calls in flight at a time per run (default 100)
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from urllib.parse import urlsplit
+
+import frappe
+import httpx
+from frappe.utils import cint
+
+from payments.utils.circuit_breaker import GatewayUnavailableError, circuit_breaker
+from payments.utils.http_client import (
+	get_adaptive_timeout,
+	get_overridden_url,
+	get_timeout,
+	in_frappe_context,
+	parse_response,
+)
+from payments.utils.metrics import track_gateway_call
+
+DEFAULT_CONCURRENCY = 100
+
+_client = ContextVar("payments_async_client", default=None)
+
+
+def use_async_transport():
+	return bool(cint(frappe.conf.payments_async_transport))
+
+
+def get_async_concurrency():
+	return cint(frappe.conf.payments_async_concurrency) or DEFAULT_CONCURRENCY
+
+
+@asynccontextmanager
+async def async_client(limit=None):
+	"""Open the client shared by the async calls made in the block"""
+	limit = limit or get_async_concurrency()
+	connect, read = get_timeout()
+	client = httpx.AsyncClient(
+		timeout=httpx.Timeout(read, connect=connect),
+		limits=httpx.Limits(max_connections=limit, max_keepalive_connections=limit),
+	)
+	token = _client.set(client)
+	try:
+		async with client:
+			yield client
+	finally:
+		_client.reset(token)
+
+
+async def gather_bounded(coroutines, limit=None):
+	"""Await `coroutines` with at most `limit` of them running at a time.
+
+	Returns their results in order, with the exception raised by a coroutine in place of
+	its result, so that one failed call doesn't lose the others.
+	"""
+	semaphore = asyncio.Semaphore(limit or get_async_concurrency())
+
+	async def bounded(coroutine):
+		async with semaphore:
+			return await coroutine
+
+	return await asyncio.gather(
+		*(bounded(coroutine) for coroutine in coroutines), return_exceptions=True
+	)
+
+
+def run_concurrently(coroutines, limit=None):
+	"""Run `coroutines` on a new event loop from synchronous code, see `gather_bounded`"""
+	limit = limit or get_async_concurrency()
+
+	async def main():
+		async with async_client(limit):
+			return await gather_bounded(coroutines, limit)
+
+	return asyncio.run(main())
+
+
+async def async_send_request(
+	method, url, timeout=None, gateway=None, operation=None, is_declined=None, **kwargs
+):
+	"""Send a request over the shared async client and return the raw `httpx.Response`.
+
+	Outside of `async_client` a client is opened for this request only. See
+	`http_client.send_request` for `is_declined`.
+	"""
+	if timeout:
+		kwargs["timeout"] = timeout
+
+	client = _client.get()
+	if not client:
+		async with async_client(limit=1):
+			return await async_send_request(
+				method, url, gateway=gateway, operation=operation, is_declined=is_declined, **kwargs
+			)
+
+	host = urlsplit(url).netloc
+	url = get_overridden_url(url)
+
+	if not gateway:
+		return await client.request(method, url, **kwargs)
+
+	if "timeout" not in kwargs:
+		connect, read = get_adaptive_timeout(gateway, operation)
+		kwargs["timeout"] = httpx.Timeout(read, connect=connect)
+
+	with circuit_breaker(gateway, host) as guard, track_gateway_call(gateway, operation) as call:
+		response = await client.request(method, url, **kwargs)
+		if response.status_code >= 400:
+			call["outcome"] = "failure"
+			guard["failed"] = response.status_code >= 500
+		elif is_declined and is_declined(parse_response(response)):
+			call["outcome"] = "failure"
+
+		return response
+
+
+async def async_make_request(
+	method,
+	url,
+	auth=None,
+	headers=None,
+	data=None,
+	json=None,
+	params=None,
+	gateway=None,
+	operation=None,
+	is_declined=None,
+):
+	"""asyncio counterpart of `http_client.make_request`; `auth` is a (user, password) tuple"""
+	try:
+		response = await async_send_request(
+			method,
+			url,
+			auth=auth or None,
+			headers=headers or {},
+			data=data or None,
+			json=json,
+			params=params,
+			gateway=gateway,
+			operation=operation,
+			is_declined=is_declined,
+		)
+		response.raise_for_status()
+		return parse_response(response)
+
+	except GatewayUnavailableError:
+		raise
+
+	except Exception:
+		if in_frappe_context():
+			frappe.log_error()
+		raise
+
+
+async def async_make_get_request(url, **kwargs):
+	return await async_make_request("GET", url, **kwargs)
+
+
+async def async_make_post_request(url, **kwargs):
+	return await async_make_request("POST", url, **kwargs)
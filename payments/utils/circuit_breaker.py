@@ -0,0 +1,214 @@
+"""
+Per gateway circuit breaker around outbound gateway calls.
+
+When a gateway degrades, waiting for each call to time out ties up every worker of the
+site. The breaker counts the calls to a gateway that get no usable answer (timeouts,
+connection errors and 5xx responses; declines, other 4xx responses and local errors don't
+count) and once `payments_circuit_failure_threshold` of them happen within
+`payments_circuit_failure_window` seconds, opens the circuit of the gateway for
+`payments_circuit_open_seconds`. Calls made while it is open fail right away with
+`GatewayUnavailableError`.
+
+A gateway has one circuit per target, e.g. the host called or the environment of the
+account, so that an outage of a sandbox doesn't stop the live payments.
+
+Once the open period is over a single call goes through as a probe, while the others keep
+failing fast: the circuit closes when the probe succeeds and opens again when it fails.
+
+The state lives in Redis, so all workers and processes of a site share it. Thread pools
+making gateway calls are created with `get_site_thread_pool`, which gives their threads the
+site of the calling thread, so that their calls are guarded too.
+
+Site config:
+	payments_circuit_failure_threshold: failed calls that open the circuit (default 5)
+	payments_circuit_failure_window: seconds over which failed calls are counted (default 60)
+	payments_circuit_open_seconds: seconds the circuit stays open (default 30)
+"""
+
+import asyncio
+from contextlib import contextmanager
+
+import frappe
+import httpx
+import requests
+from braintree.exceptions import (
+	GatewayTimeoutError,
+	RequestTimeoutError,
+	ServerError,
+	ServiceUnavailableError,
+)
+from braintree.exceptions.http import ConnectionError as BraintreeConnectionError
+from braintree.exceptions.http import TimeoutError as BraintreeTimeoutError
+from frappe import _
+from frappe.utils import cint
+from stripe.error import APIConnectionError
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_FAILURE_WINDOW = 60
+DEFAULT_OPEN_SECONDS = 30
+# a circuit that opened is half-open once its open period is over, until a probe succeeds
+TRIPPED_TTL = 24 * 60 * 60
+
+# errors of calls that got no answer from the gateway, or an answer saying it is unavailable
+TRANSPORT_ERRORS = (
+	requests.ConnectionError,
+	requests.Timeout,
+	httpx.TransportError,
+	asyncio.TimeoutError,
+	TimeoutError,
+	ConnectionError,
+	APIConnectionError,
+	BraintreeConnectionError,
+	BraintreeTimeoutError,
+	GatewayTimeoutError,
+	RequestTimeoutError,
+	ServerError,
+	ServiceUnavailableError,
+)
+
+
+class GatewayUnavailableError(frappe.ValidationError):
+	http_status_code = 503
+
+
+@contextmanager
+def circuit_breaker(gateway, target=None):
+	"""Guard the call to `target` of `gateway` made in the block.
+
+	Raises `GatewayUnavailableError` without running the block while the circuit is open.
+	The block can set `call["failed"]` to report an answer that didn't raise but counts as
+	failed, e.g. a 5xx response.
+	"""
+	if not getattr(frappe.local, "site", None):
+		yield {"failed": False}
+		return
+
+	probe = check_circuit(gateway, target)
+	call = {"failed": False}
+	try:
+		yield call
+	except Exception as e:
+		if is_gateway_failure(e):
+			record_failure(gateway, target, probe)
+		elif probe:
+			release_probe(gateway, target)
+		raise
+
+	if call["failed"]:
+		record_failure(gateway, target, probe)
+	elif probe:
+		close_circuit(gateway, target)
+
+
+def check_circuit(gateway, target=None):
+	"""Raise when the circuit is open, return True when the call is its probe"""
+	state = get_circuit_state(gateway, target)
+	if state == "closed":
+		return False
+
+	probe_key = get_circuit_keys(gateway, target).probe
+	if state == "half-open" and frappe.cache().set(probe_key, 1, nx=True, ex=get_open_seconds()):
+		return True
+
+	frappe.throw(
+		_("{0} is temporarily unavailable, please try again in a few minutes").format(gateway),
+		exc=GatewayUnavailableError,
+		title=_("Gateway Unavailable"),
+	)
+
+
+def is_gateway_failure(exception):
+	"""Whether an exception means that the gateway didn't give a usable answer"""
+	if isinstance(exception, TRANSPORT_ERRORS):
+		return True
+
+	response = getattr(exception, "response", None)
+	status = getattr(response, "status_code", None) or getattr(exception, "http_status", None)
+	return cint(status) >= 500
+
+
+def record_failure(gateway, target=None, probe=False):
+	keys = get_circuit_keys(gateway, target)
+	if probe:
+		open_circuit(keys)
+		return
+
+	# the window starts with the first failure, incr keeps its expiry
+	pipeline = frappe.cache().pipeline()
+	pipeline.set(keys.failures, 0, nx=True, ex=get_failure_window())
+	pipeline.incr(keys.failures)
+	failures = pipeline.execute()[-1]
+
+	if failures >= get_failure_threshold():
+		open_circuit(keys)
+
+
+def open_circuit(keys):
+	pipeline = frappe.cache().pipeline()
+	pipeline.set(keys.open, 1, ex=get_open_seconds())
+	pipeline.set(keys.tripped, 1, ex=TRIPPED_TTL)
+	pipeline.delete(keys.failures, keys.probe)
+	pipeline.execute()
+
+
+def close_circuit(gateway, target=None):
+	keys = get_circuit_keys(gateway, target)
+	pipeline = frappe.cache().pipeline()
+	pipeline.delete(keys.tripped, keys.failures, keys.probe)
+	pipeline.execute()
+
+
+def reset_circuit(gateway, target=None):
+	"""Forget the state of a circuit, closing it if it was open.
+
+	Without a `target`, the circuits of all the targets of `gateway` are reset.
+	"""
+	if target is None:
+		frappe.cache().delete_keys(f"payments_circuit:{gateway}:")
+		return
+
+	keys = get_circuit_keys(gateway, target)
+	pipeline = frappe.cache().pipeline()
+	pipeline.delete(*keys.values())
+	pipeline.execute()
+
+
+def release_probe(gateway, target=None):
+	"""Let another call probe the gateway, the probe failed for a reason of its own"""
+	frappe.cache().delete(get_circuit_keys(gateway, target).probe)
+
+
+def get_circuit_state(gateway, target=None):
+	"""Return "closed", "open" or "half-open" for the circuit of `target` of `gateway`"""
+	keys = get_circuit_keys(gateway, target)
+	pipeline = frappe.cache().pipeline()
+	pipeline.exists(keys.open)
+	pipeline.exists(keys.tripped)
+	is_open, tripped = pipeline.execute()
+
+	if is_open:
+		return "open"
+
+	return "half-open" if tripped else "closed"
+
+
+def get_circuit_keys(gateway, target=None):
+	make_key = frappe.cache().make_key
+	return frappe._dict(
+		{
+			state: make_key(f"payments_circuit:{gateway}:{target or ''}:{state}")
+			for state in ("open", "tripped", "probe", "failures")
+		}
+	)
+
+
+def get_failure_threshold():
+	return cint(frappe.conf.payments_circuit_failure_threshold) or DEFAULT_FAILURE_THRESHOLD
+
+
+def get_failure_window():
+	return cint(frappe.conf.payments_circuit_failure_window) or DEFAULT_FAILURE_WINDOW
+
+
+def get_open_seconds():
+	return cint(frappe.conf.payments_circuit_open_seconds) or DEFAULT_OPEN_SECONDS
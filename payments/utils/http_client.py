@@ -0,0 +1,283 @@
+"""
+Connection-pooled HTTP transport shared by all gateway integrations.
+
+Every process keeps one `requests.Session` per scheme and host, so consecutive calls to a
+gateway reuse a kept-alive connection instead of paying a new TCP + TLS handshake. The
+sessions hold no site specific state and are safe to use from worker threads.
+
+Gateway calls go through the circuit breaker of their gateway and host
+(`payments.utils.circuit_breaker`) and wait for a response in proportion to the p99 latency
+observed for the same call, see `get_adaptive_timeout`.
+
+Site config:
+	payments_http_connect_timeout: seconds to wait for a connection (default 5)
+	payments_http_read_timeout: seconds to wait for a response (default 30)
+	payments_http_min_read_timeout: lower bound of adaptive read timeouts (default 2)
+	payments_http_timeout_multiplier: adaptive read timeouts in multiples of the p99 (default 3)
+	payments_http_pool_size: connections kept alive per host (default 10)
+"""
+
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlsplit
+
+import frappe
+import requests
+from frappe.utils import cint, flt
+from requests.adapters import HTTPAdapter
+
+from payments.utils.circuit_breaker import GatewayUnavailableError, circuit_breaker
+from payments.utils.metrics import get_gateway_metrics, get_latency_quantile, track_gateway_call
+
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_MIN_READ_TIMEOUT = 2
+DEFAULT_TIMEOUT_MULTIPLIER = 3
+DEFAULT_POOL_SIZE = 10
+# successful calls an operation needs before its timeout adapts to their latency
+ADAPTIVE_TIMEOUT_MIN_CALLS = 100
+# seconds the latencies read from the gateway metrics are kept in memory
+ADAPTIVE_TIMEOUT_REFRESH = 60
+
+_lock = threading.Lock()
+_sessions = {}
+_session_stats = defaultdict(lambda: {"session_hits": 0, "session_misses": 0})
+_pid = os.getpid()
+# "scheme://host" -> "scheme://host" to send the requests to instead, see `override_hosts`
+_host_overrides = {}
+# site -> (refreshed at, {(gateway, operation): p99 latency in seconds})
+_latency_p99s = {}
+
+
+def get_conf(key, default=None):
+	"""Read site config without failing outside a frappe context (e.g. in worker threads)"""
+	conf = getattr(frappe.local, "conf", None) or {}
+	return conf.get(key) or default
+
+
+def get_timeout():
+	"""Return the (connect, read) timeout tuple used for gateway calls"""
+	return (
+		flt(get_conf("payments_http_connect_timeout", DEFAULT_CONNECT_TIMEOUT)),
+		flt(get_conf("payments_http_read_timeout", DEFAULT_READ_TIMEOUT)),
+	)
+
+
+def get_adaptive_timeout(gateway, operation):
+	"""Return the (connect, read) timeout of a gateway call, adapted to its observed latency.
+
+	The read timeout is `payments_http_timeout_multiplier` times the p99 latency of the
+	successful calls of the same gateway and operation, bounded by
+	`payments_http_min_read_timeout` and `payments_http_read_timeout`. Calls without enough
+	history, or made outside a site context, use `get_timeout`.
+	"""
+	connect, read = get_timeout()
+	p99 = get_latency_p99s().get((gateway, operation))
+	if not p99:
+		return connect, read
+
+	min_read = flt(get_conf("payments_http_min_read_timeout", DEFAULT_MIN_READ_TIMEOUT))
+	multiplier = flt(get_conf("payments_http_timeout_multiplier", DEFAULT_TIMEOUT_MULTIPLIER))
+	return connect, min(read, max(min_read, p99 * multiplier))
+
+
+def get_latency_p99s():
+	site = getattr(frappe.local, "site", None)
+	if not site:
+		return {}
+
+	refreshed_at, p99s = _latency_p99s.get(site, (None, None))
+	if refreshed_at and time.monotonic() - refreshed_at < ADAPTIVE_TIMEOUT_REFRESH:
+		return p99s
+
+	p99s = {}
+	try:
+		for (gateway, operation, outcome), histogram in get_gateway_metrics().items():
+			if outcome == "success" and histogram["count"] >= ADAPTIVE_TIMEOUT_MIN_CALLS:
+				p99s[(gateway, operation)] = get_latency_quantile(histogram, 0.99)
+	except Exception:
+		# without metrics, calls use the configured timeouts
+		pass
+
+	_latency_p99s[site] = (time.monotonic(), p99s)
+	return p99s
+
+
+def get_session(url):
+	"""Return the pooled session of this process for the host of `url`"""
+	global _pid
+
+	parts = urlsplit(url)
+	key = f"{parts.scheme}://{parts.netloc}"
+
+	with _lock:
+		if _pid != os.getpid():
+			# sockets must not be shared with the parent of a forked worker
+			_sessions.clear()
+			_session_stats.clear()
+			_pid = os.getpid()
+
+		session = _sessions.get(key)
+		if session:
+			_session_stats[key]["session_hits"] += 1
+			return session
+
+		_session_stats[key]["session_misses"] += 1
+		pool_size = cint(get_conf("payments_http_pool_size", DEFAULT_POOL_SIZE))
+		session = requests.Session()
+		session.mount(key, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+		_sessions[key] = session
+
+		return session
+
+
+def send_request(
+	method, url, timeout=None, gateway=None, operation=None, is_declined=None, **kwargs
+):
+	"""Send a request over the pooled session and return the raw `requests.Response`.
+
+	Calls labelled with a `gateway` and `operation` are timed in `payments.utils.metrics`,
+	guarded by the circuit breaker of the gateway and host and get an adaptive timeout.
+	Gateways that decline requests with a 2xx response pass `is_declined`, called with the
+	parsed response, so that the declines are counted as failures.
+	"""
+	host = urlsplit(url).netloc
+	if _host_overrides:
+		url = get_overridden_url(url)
+
+	if not gateway:
+		return get_session(url).request(method, url, timeout=timeout or get_timeout(), **kwargs)
+
+	timeout = timeout or get_adaptive_timeout(gateway, operation)
+	with circuit_breaker(gateway, host) as guard, track_gateway_call(gateway, operation) as call:
+		response = get_session(url).request(method, url, timeout=timeout, **kwargs)
+		if response.status_code >= 400:
+			call["outcome"] = "failure"
+			guard["failed"] = response.status_code >= 500
+		elif is_declined and is_declined(parse_response(response)):
+			call["outcome"] = "failure"
+
+		return response
+
+
+@contextmanager
+def override_hosts(overrides):
+	"""Send the requests for the `scheme://host` keys of `overrides` to the mapped hosts instead.
+
+	Used to point the integrations at local stand-ins of the gateway APIs, e.g. in benchmarks.
+	Applies to every thread of the process while the block runs.
+	"""
+	with _lock:
+		_host_overrides.update(overrides)
+	try:
+		yield
+	finally:
+		with _lock:
+			for key in overrides:
+				_host_overrides.pop(key, None)
+
+
+def get_overridden_url(url):
+	parts = urlsplit(url)
+	host = _host_overrides.get(f"{parts.scheme}://{parts.netloc}")
+	if not host:
+		return url
+
+	return host + url[len(parts.scheme) + 3 + len(parts.netloc) :]
+
+
+def make_request(
+	method,
+	url,
+	auth=None,
+	headers=None,
+	data=None,
+	json=None,
+	params=None,
+	gateway=None,
+	operation=None,
+	is_declined=None,
+):
+	"""Drop-in replacement for `frappe.integrations.utils.make_request` over pooled sessions"""
+	try:
+		response = send_request(
+			method,
+			url,
+			auth=auth or None,
+			headers=headers or {},
+			data=data or {},
+			json=json,
+			params=params,
+			gateway=gateway,
+			operation=operation,
+			is_declined=is_declined,
+		)
+		if in_frappe_context():
+			frappe.flags.integration_request = response
+
+		response.raise_for_status()
+		return parse_response(response)
+
+	except GatewayUnavailableError:
+		# the gateway is known to be down, there is nothing new to log
+		raise
+
+	except Exception:
+		if in_frappe_context():
+			frappe.log_error()
+		raise
+
+
+def make_get_request(url, **kwargs):
+	return make_request("GET", url, **kwargs)
+
+
+def make_post_request(url, **kwargs):
+	return make_request("POST", url, **kwargs)
+
+
+def parse_response(response):
+	content_type = response.headers.get("content-type")
+	if not content_type:
+		return
+
+	if content_type == "text/plain; charset=utf-8":
+		return parse_qs(response.text)
+	elif content_type.startswith("application/") and content_type.split(";")[0].endswith("json"):
+		return response.json()
+	elif response.text:
+		return response.text
+
+
+def in_frappe_context():
+	return bool(getattr(frappe.local, "site", None))
+
+
+def get_pool_stats():
+	"""Return per host session and connection reuse counters of this process.
+
+	`session_hits`/`session_misses` count lookups of the pooled session, while
+	`pool_hits` counts requests served over an already open connection and
+	`pool_misses` the connections that had to be opened.
+	"""
+	stats = {}
+	with _lock:
+		for key, session in _sessions.items():
+			connections = requests_sent = 0
+			for adapter in session.adapters.values():
+				pools = adapter.poolmanager.pools
+				for pool_key in pools.keys():
+					pool = pools[pool_key]
+					connections += pool.num_connections
+					requests_sent += pool.num_requests
+
+			stats[key] = {
+				**_session_stats[key],
+				"pool_hits": requests_sent - connections,
+				"pool_misses": connections,
+			}
+
+	return stats
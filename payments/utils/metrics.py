@@ -0,0 +1,213 @@
+"""
+Latency histograms of outbound payment gateway calls.
+
+Every call is labelled by gateway, operation (e.g. `stk_push`, `capture`,
+`SetExpressCheckout`, `Charge.create`) and outcome:
+
+	success: the gateway answered the call
+	failure: the gateway answered with an error or declined the request
+	timeout: the gateway didn't answer in time
+	error: the call failed without an answer from the gateway
+
+Samples are aggregated in the memory of each process and added to the counters of the site
+in Redis at most every `payments_metrics_flush_interval` seconds (site config, 10 by
+default). Samples are kept per site, taken when the call starts: calls made without a site
+context, e.g. from threads not created with `get_site_thread_pool`, are not recorded.
+
+The counters are exposed in the Prometheus text format by `get_prometheus_metrics` and
+summarized in Payment Gateway Metric by `update_gateway_metrics`.
+"""
+
+import asyncio
+import bisect
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import frappe
+import httpx
+import requests
+from frappe.utils import cint, flt
+from werkzeug.wrappers import Response
+
+from payments.utils.utils import get_cache_counters
+
+# upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BUCKET_LABELS = tuple(str(bound) for bound in LATENCY_BUCKETS) + ("+Inf",)
+METRICS_CACHE_KEY = "payments_gateway_metrics"
+METRIC_NAME = "payments_gateway_call_duration_seconds"
+DEFAULT_FLUSH_INTERVAL = 10
+
+_lock = threading.Lock()
+# (site, gateway, operation, outcome) -> [calls per bucket..., total duration]
+_samples = {}
+_last_flush = time.monotonic()
+
+
+@contextmanager
+def track_gateway_call(gateway, operation):
+	"""Time the gateway call made in the block.
+
+	Exceptions set the outcome, and the block can set `call["outcome"]` itself to report
+	a declined request that didn't raise.
+	"""
+	site = getattr(frappe.local, "site", None)
+	call = {"outcome": "success"}
+	start = time.perf_counter()
+	try:
+		yield call
+	except Exception as e:
+		call["outcome"] = get_exception_outcome(e)
+		raise
+	finally:
+		duration = time.perf_counter() - start
+		record_gateway_call(gateway, operation, call["outcome"], duration, site=site)
+
+
+def get_exception_outcome(exception):
+	if isinstance(
+		exception, (requests.Timeout, httpx.TimeoutException, asyncio.TimeoutError, TimeoutError)
+	):
+		return "timeout"
+
+	# http errors of requests and the gateway SDKs carry the status of the response
+	if getattr(exception, "response", None) is not None or getattr(exception, "http_status", None):
+		return "failure"
+
+	return "error"
+
+
+def record_gateway_call(gateway, operation, outcome, duration, site=None):
+	site = site or getattr(frappe.local, "site", None)
+	if not site:
+		# there is no site whose counters the call could be added to
+		return
+
+	bucket = bisect.bisect_left(LATENCY_BUCKETS, duration)
+
+	with _lock:
+		sample = _samples.setdefault((site, gateway, operation, outcome), [0] * (len(BUCKET_LABELS) + 1))
+		sample[bucket] += 1
+		sample[-1] += duration
+
+	# samples of another site are flushed by a call made in its context
+	in_site_context = getattr(frappe.local, "site", None) == site
+	if in_site_context and time.monotonic() - _last_flush >= get_flush_interval():
+		try:
+			flush_metrics()
+		except Exception:
+			# metrics must never fail the payment that is being made
+			pass
+
+
+def get_flush_interval():
+	return cint(frappe.conf.payments_metrics_flush_interval) or DEFAULT_FLUSH_INTERVAL
+
+
+def flush_metrics():
+	"""Add the samples of this process to the counters of the current site in Redis"""
+	global _last_flush
+
+	site = frappe.local.site
+	with _lock:
+		samples = {key: _samples.pop(key) for key in list(_samples) if key[0] == site}
+		_last_flush = time.monotonic()
+
+	if not samples:
+		return
+
+	cache_key = frappe.cache().make_key(METRICS_CACHE_KEY)
+	pipeline = frappe.cache().pipeline()
+	for (_site, gateway, operation, outcome), sample in samples.items():
+		labels = f"{gateway}|{operation}|{outcome}"
+		for le, calls in zip(BUCKET_LABELS, sample):
+			if calls:
+				pipeline.hincrby(cache_key, f"{labels}|{le}", calls)
+		pipeline.hincrbyfloat(cache_key, f"{labels}|sum", sample[-1])
+
+	pipeline.execute()
+
+
+def get_gateway_metrics():
+	"""Return the histograms of the current site by (gateway, operation, outcome).
+
+	Each histogram has the calls per bucket (not cumulative), the number of calls and their
+	total duration in seconds.
+	"""
+	metrics = defaultdict(
+		lambda: {"buckets": dict.fromkeys(BUCKET_LABELS, 0), "count": 0, "sum": 0.0}
+	)
+
+	for field, value in get_cache_counters(METRICS_CACHE_KEY).items():
+		labels, le = field.rsplit("|", 1)
+		histogram = metrics[tuple(labels.split("|", 2))]
+		if le == "sum":
+			histogram["sum"] = flt(value)
+		else:
+			histogram["buckets"][le] = cint(value)
+			histogram["count"] += cint(value)
+
+	return dict(metrics)
+
+
+def get_latency_quantile(histogram, quantile):
+	"""Estimate a quantile of a histogram in seconds, interpolating within its bucket"""
+	if not histogram["count"]:
+		return 0.0
+
+	rank = quantile * histogram["count"]
+	seen, lower = 0, 0.0
+	for le, bound in zip(BUCKET_LABELS, LATENCY_BUCKETS):
+		calls = histogram["buckets"][le]
+		if calls and seen + calls >= rank:
+			return lower + (bound - lower) * (rank - seen) / calls
+
+		seen += calls
+		lower = bound
+
+	# the quantile is above the last bound, which is as far as the histogram can tell
+	return lower
+
+
+@frappe.whitelist()
+def get_prometheus_metrics():
+	"""Return the gateway call histograms of the site in the Prometheus text format"""
+	frappe.only_for("System Manager")
+	flush_metrics()
+
+	lines = [
+		f"# HELP {METRIC_NAME} Duration of outbound payment gateway calls.",
+		f"# TYPE {METRIC_NAME} histogram",
+	]
+	for (gateway, operation, outcome), histogram in sorted(get_gateway_metrics().items()):
+		labels = ",".join(
+			f'{name}="{escape_label_value(value)}"'
+			for name, value in (("gateway", gateway), ("operation", operation), ("outcome", outcome))
+		)
+
+		cumulative = 0
+		for le in BUCKET_LABELS:
+			cumulative += histogram["buckets"][le]
+			lines.append(f'{METRIC_NAME}_bucket{{{labels},le="{le}"}} {cumulative}')
+
+		lines.append(f"{METRIC_NAME}_sum{{{labels}}} {histogram['sum']}")
+		lines.append(f"{METRIC_NAME}_count{{{labels}}} {histogram['count']}")
+
+	return Response("\n".join(lines) + "\n", content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def escape_label_value(value):
+	return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def update_gateway_metrics():
+	"""Summarize the histograms of the site in Payment Gateway Metric, runs from the scheduler"""
+	from payments.payments.doctype.payment_gateway_metric.payment_gateway_metric import (
+		update_gateway_metric,
+	)
+
+	flush_metrics()
+	for (gateway, operation, outcome), histogram in get_gateway_metrics().items():
+		update_gateway_metric(gateway, operation, outcome, histogram)
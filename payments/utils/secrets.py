@@ -0,0 +1,77 @@
+"""
+Short-lived cache of decrypted gateway credentials.
+
+Decrypted values are only ever kept in the memory of the current process, for at most
+`payments_secret_cache_ttl` seconds (site config, 300 by default). Saving or deleting the
+settings document bumps a version stamp in Redis, so every process drops its copy of the
+secrets of that document on its next lookup. The stamp is bumped again once the change is
+committed, as another process may have cached the previous secret under the first stamp.
+"""
+
+import threading
+import time
+
+import frappe
+from frappe.utils import cint
+from frappe.utils.password import get_decrypted_password
+
+DEFAULT_TTL = 300
+SECRET_VERSION_CACHE_KEY = "payments_secret_version"
+
+_lock = threading.Lock()
+_secrets = {}
+_stats = {"hits": 0, "misses": 0}
+
+
+def get_decrypted_secret(doctype, name, fieldname, raise_exception=True):
+	"""Cached counterpart of `frappe.utils.password.get_decrypted_password`"""
+	key = (frappe.local.site, doctype, name, fieldname)
+	version = get_secret_version(doctype, name)
+	now = time.monotonic()
+
+	with _lock:
+		entry = _secrets.get(key)
+		if entry and entry[0] > now and entry[1] == version:
+			_stats["hits"] += 1
+			return entry[2]
+
+	value = get_decrypted_password(doctype, name, fieldname, raise_exception=raise_exception)
+	ttl = cint(frappe.conf.payments_secret_cache_ttl) or DEFAULT_TTL
+
+	with _lock:
+		_stats["misses"] += 1
+		_secrets[key] = (now + ttl, version, value)
+
+	return value
+
+
+def get_secret_version(doctype, name):
+	# hget also caches the stamp locally for the rest of the request
+	return frappe.cache().hget(SECRET_VERSION_CACHE_KEY, f"{doctype}:{name}")
+
+
+def invalidate_secrets(doc, method=None):
+	"""Drop the cached secrets of `doc`; hooked on updates of the gateway settings"""
+	bump_secret_version(doc.doctype, doc.name)
+	frappe.db.after_commit.add(lambda: bump_secret_version(doc.doctype, doc.name))
+
+	with _lock:
+		for key in [key for key in _secrets if key[:3] == (frappe.local.site, doc.doctype, doc.name)]:
+			del _secrets[key]
+
+
+def bump_secret_version(doctype, name):
+	frappe.cache().hset(
+		SECRET_VERSION_CACHE_KEY, f"{doctype}:{name}", frappe.generate_hash(length=10)
+	)
+
+
+def get_secret_cache_stats():
+	"""Return the lookups served from the cache and the decryptions done by this process"""
+	with _lock:
+		return {
+			"hits": _stats["hits"],
+			"misses": _stats["misses"],
+			"decryptions_saved": _stats["hits"],
+			"cached_secrets": len(_secrets),
+		}
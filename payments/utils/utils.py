@@ -1,23 +1,219 @@
+import json
+import os
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
 import click
 import frappe
+import redis
 from frappe import _
-from contextlib import contextmanager
 from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
+from frappe.utils import add_to_date, cint, flt, now_datetime
+from frappe.utils.response import json_handler
+
+PAYMENT_GATEWAY_CONTROLLER_CACHE_KEY = "payment_gateway_controller"
+CHECKOUT_PROFILE_CACHE_KEY = "payment_gateway_checkout_profile"
+CHECKOUT_PROFILE_FIELDS = ("publishable_key", "header_img", "use_sandbox")
+DEFAULT_LEASE_SECONDS = 600
+DEFAULT_PAGE_LENGTH = 500
+
+FILTER_OPERATORS = {
+	"=": lambda column, value: column == value,
+	"!=": lambda column, value: column != value,
+	">": lambda column, value: column > value,
+	">=": lambda column, value: column >= value,
+	"<": lambda column, value: column < value,
+	"<=": lambda column, value: column <= value,
+	"in": lambda column, value: column.isin(value),
+	"not in": lambda column, value: column.notin(value),
+}
+
+INTEGRATION_REQUEST_CUSTOM_FIELDS = {
+	"Integration Request": [
+		{
+			"fieldname": "lease_owner",
+			"fieldtype": "Data",
+			"label": "Lease Owner",
+			"hidden": 1,
+			"read_only": 1,
+			"no_copy": 1,
+			"insert_after": "status",
+		},
+		{
+			"fieldname": "lease_expires_on",
+			"fieldtype": "Datetime",
+			"label": "Lease Expires On",
+			"hidden": 1,
+			"read_only": 1,
+			"no_copy": 1,
+			"insert_after": "lease_owner",
+		},
+		{
+			"fieldname": "webhook_status",
+			"fieldtype": "Select",
+			"label": "Webhook Status",
+			"options": "\nPending\nVerified\nRejected",
+			"read_only": 1,
+			"no_copy": 1,
+			"search_index": 1,
+			"insert_after": "lease_expires_on",
+		},
+		{
+			"fieldname": "gateway_details_section",
+			"fieldtype": "Section Break",
+			"label": "Gateway Details",
+			"insert_after": "reference_docname",
+		},
+		{
+			"fieldname": "gateway_payment_id",
+			"fieldtype": "Data",
+			"label": "Gateway Payment ID",
+			"read_only": 1,
+			"no_copy": 1,
+			"search_index": 1,
+			"insert_after": "gateway_details_section",
+		},
+		{
+			"fieldname": "is_sandbox",
+			"fieldtype": "Check",
+			"label": "Is Sandbox",
+			"read_only": 1,
+			"insert_after": "gateway_payment_id",
+		},
+		{
+			"fieldname": "gateway_details_column_break",
+			"fieldtype": "Column Break",
+			"insert_after": "is_sandbox",
+		},
+		{
+			"fieldname": "gateway_amount",
+			"fieldtype": "Float",
+			"label": "Gateway Amount",
+			"read_only": 1,
+			"insert_after": "gateway_details_column_break",
+		},
+		{
+			"fieldname": "gateway_currency",
+			"fieldtype": "Data",
+			"label": "Gateway Currency",
+			"read_only": 1,
+			"insert_after": "gateway_amount",
+		},
+	]
+}
+
+# keys under which the gateways store their payment id in the request data, in order of preference
+# (PayPal's recurring `profile_id` identifies a subscription, not a payment, and isn't one of them)
+GATEWAY_PAYMENT_ID_KEYS = ("razorpay_payment_id", "transaction_id", "TXNID")
 
 
 def get_payment_gateway_controller(payment_gateway):
-	"""Return payment gateway controller"""
-	gateway = frappe.get_doc("Payment Gateway", payment_gateway)
-	if gateway.gateway_controller is None:
-		try:
-			return frappe.get_doc(f"{payment_gateway} Settings")
-		except Exception:
-			frappe.throw(_("{0} Settings not found").format(payment_gateway))
-	else:
-		try:
-			return frappe.get_doc(gateway.gateway_settings, gateway.gateway_controller)
-		except Exception:
-			frappe.throw(_("{0} Settings not found").format(payment_gateway))
+	"""Return payment gateway controller
+
+	Resolved settings are cached per site (in Redis, and locally for the rest of the request)
+	by gateway name, including gateways whose settings don't exist. Every call still returns
+	a fresh document, so callers can't leak state into each other.
+
+	The document is rebuilt from the cache and may be stale, so it can't be saved: load the
+	settings with `frappe.get_doc` to change them.
+	"""
+	settings = frappe.cache().hget(
+		PAYMENT_GATEWAY_CONTROLLER_CACHE_KEY,
+		payment_gateway,
+		generator=lambda: resolve_payment_gateway_settings(payment_gateway),
+	)
+	if not settings:
+		frappe.throw(_("{0} Settings not found").format(payment_gateway))
+
+	controller = frappe.get_doc(settings)
+	controller.flags.from_controller_cache = True
+	return controller
+
+
+def resolve_payment_gateway_settings(payment_gateway):
+	"""Load the settings of `payment_gateway`, returning an empty dict when they don't exist"""
+	try:
+		gateway = frappe.get_doc("Payment Gateway", payment_gateway)
+		if gateway.gateway_controller is None:
+			return frappe.get_doc(f"{payment_gateway} Settings").as_dict()
+		else:
+			return frappe.get_doc(gateway.gateway_settings, gateway.gateway_controller).as_dict()
+	except Exception:
+		return {}
+
+
+def validate_not_from_controller_cache(doc, method=None):
+	"""Refuse to save settings returned by `get_payment_gateway_controller`; hooked on validate
+	of gateway settings"""
+	if doc.flags.from_controller_cache:
+		frappe.throw(
+			_("{0} loaded from the cache can't be saved, reload them to make changes").format(
+				_(doc.doctype)
+			)
+		)
+
+
+def clear_payment_gateway_controller_cache(doc=None, method=None):
+	"""Invalidate cached controllers and checkout profiles; hooked on updates of Payment
+	Gateway and gateway settings"""
+	keys = [PAYMENT_GATEWAY_CONTROLLER_CACHE_KEY, CHECKOUT_PROFILE_CACHE_KEY]
+	frappe.cache().delete_value(keys)
+	# also after commit, so that a concurrent request can't cache the previous version
+	frappe.db.after_commit.add(lambda: frappe.cache().delete_value(keys))
+
+
+def get_cache_counters(key):
+	"""Return the fields of a Redis hash of counters updated with `hincrby`.
+
+	`frappe.cache().hgetall` prefixes the key itself and unpickles the values, so the hash is
+	read with the plain redis method.
+	"""
+	counters = redis.Redis.hgetall(frappe.cache(), frappe.cache().make_key(key))
+	return {frappe.safe_decode(field): frappe.safe_decode(value) for field, value in counters.items()}
+
+
+def get_checkout_reference(reference_doctype, reference_docname, fields=None):
+	"""Return the gateway controller of a payment reference along with its `fields`.
+
+	Replaces loading the whole reference document and its Payment Gateway with a single
+	query; `fields` missing from the reference doctype are skipped.
+	"""
+	meta = frappe.get_meta(reference_doctype)
+	fields = [fieldname for fieldname in (fields or ()) if meta.has_field(fieldname)]
+
+	Reference = frappe.qb.DocType(reference_doctype)
+	PaymentGateway = frappe.qb.DocType("Payment Gateway")
+	reference = (
+		frappe.qb.from_(Reference)
+		.left_join(PaymentGateway)
+		.on(PaymentGateway.name == Reference.payment_gateway)
+		.select(PaymentGateway.gateway_controller, *(Reference[fieldname] for fieldname in fields))
+		.where(Reference.name == reference_docname)
+		.run(as_dict=True)
+	)
+	if not reference:
+		frappe.throw(
+			_("{0} {1} not found").format(_(reference_doctype), reference_docname),
+			frappe.DoesNotExistError,
+		)
+
+	return reference[0]
+
+
+def get_checkout_profile(settings_doctype, name):
+	"""Return what checkout pages need from a gateway settings record (publishable key,
+	header image and sandbox flag), cached per site like the gateway controllers"""
+
+	def get_profile():
+		meta = frappe.get_meta(settings_doctype)
+		fields = [fieldname for fieldname in CHECKOUT_PROFILE_FIELDS if meta.has_field(fieldname)]
+		return frappe.db.get_value(settings_doctype, name, fields, as_dict=True) or {}
+
+	profile = frappe.cache().hget(
+		CHECKOUT_PROFILE_CACHE_KEY, f"{settings_doctype}:{name}", generator=get_profile
+	)
+	return frappe._dict(profile)
 
 
 @frappe.whitelist(allow_guest=True, xss_safe=True)
@@ -40,6 +236,8 @@ def get_checkout_url(**kwargs):
 
 
 def create_payment_gateway(gateway, settings=None, controller=None):
+	clear_payment_gateway_controller_cache()
+
 	# NOTE: we don't translate Payment Gateway name because it is an internal doctype
 	if not frappe.db.exists("Payment Gateway", gateway):
 		payment_gateway = frappe.get_doc(
@@ -154,6 +352,12 @@ def make_custom_fields():
 
 		create_custom_fields(custom_fields)
 
+	make_integration_request_fields()
+
+
+def make_integration_request_fields():
+	create_custom_fields(INTEGRATION_REQUEST_CUSTOM_FIELDS)
+
 
 def delete_custom_fields():
 	if frappe.get_meta("Web Form").has_field("payments_tab"):
@@ -177,6 +381,12 @@ def delete_custom_fields():
 
 		frappe.clear_cache(doctype="Web Form")
 
+	for doctype, fields in INTEGRATION_REQUEST_CUSTOM_FIELDS.items():
+		for field in fields:
+			frappe.db.delete("Custom Field", {"name": f"{doctype}-{field['fieldname']}"})
+
+		frappe.clear_cache(doctype=doctype)
+
 
 def before_install():
 	# TODO: remove this
@@ -202,3 +412,246 @@ def erpnext_app_import_guard():
 		yield
 	except ImportError:
 		frappe.throw(msg, title=_("Missing ERPNext App"))
+
+
+def get_lease_owner():
+	"""Return an identifier unique to this worker process and run"""
+	return f"{socket.gethostname()}:{os.getpid()}:{frappe.generate_hash(length=8)}"
+
+
+def claim_integration_requests(filters, limit, owner, lease_seconds=None):
+	"""Lease up to `limit` Integration Requests matching `filters` to `owner`.
+
+	Only rows without a lease, or whose lease has expired (e.g. the worker holding it
+	crashed), can be claimed. The lease is taken with a single conditional UPDATE and
+	committed right away, so concurrent workers never end up holding the same row.
+
+	`filters` is a dict as accepted by `get_filter_conditions`. Returns the claimed names.
+	"""
+	lease_seconds = (
+		lease_seconds or cint(frappe.conf.integration_request_lease_seconds) or DEFAULT_LEASE_SECONDS
+	)
+	now = now_datetime()
+
+	IntegrationRequest = frappe.qb.DocType("Integration Request")
+	is_claimable = (
+		IntegrationRequest.lease_owner.isnull()
+		| (IntegrationRequest.lease_owner == "")
+		| (IntegrationRequest.lease_expires_on < now)
+	)
+	matches_filters = get_filter_conditions(IntegrationRequest, filters)
+
+	query = frappe.qb.from_(IntegrationRequest).select(IntegrationRequest.name).where(is_claimable)
+	for condition in matches_filters:
+		query = query.where(condition)
+
+	candidates = query.orderby(IntegrationRequest.creation).limit(limit).run(pluck=True)
+	if not candidates:
+		return []
+
+	query = (
+		frappe.qb.update(IntegrationRequest)
+		.set(IntegrationRequest.lease_owner, owner)
+		.set(IntegrationRequest.lease_expires_on, add_to_date(now, seconds=lease_seconds))
+		.where(IntegrationRequest.name.isin(candidates))
+		.where(is_claimable)
+	)
+	for condition in matches_filters:
+		query = query.where(condition)
+
+	query.run()
+	frappe.db.commit()
+
+	return frappe.get_all(
+		"Integration Request",
+		filters={"name": ("in", candidates), "lease_owner": owner},
+		pluck="name",
+	)
+
+
+def release_integration_request_lease(name):
+	frappe.db.set_value(
+		"Integration Request",
+		name,
+		{"lease_owner": None, "lease_expires_on": None},
+		update_modified=False,
+	)
+
+
+def get_site_thread_pool(max_workers):
+	"""Return a thread pool whose threads are initialized with the site of the calling thread.
+
+	Gateway calls made from the threads go through the circuit breakers, adaptive timeouts
+	and metrics of the site. The threads have no database connection, database writes stay
+	on the calling thread.
+	"""
+	site = getattr(frappe.local, "site", None)
+	if not site:
+		return ThreadPoolExecutor(max_workers=max_workers)
+
+	return ThreadPoolExecutor(
+		max_workers=max_workers, initializer=frappe.init, initargs=(site, frappe.local.sites_path)
+	)
+
+
+def get_filter_conditions(table, filters):
+	"""Convert `{fieldname: value}` or `{fieldname: (operator, value)}` filters into
+	query builder conditions on `table`."""
+	conditions = []
+	for fieldname, value in (filters or {}).items():
+		operator = "="
+		if isinstance(value, (list, tuple)):
+			operator, value = value
+
+		conditions.append(FILTER_OPERATORS[operator.lower()](table[fieldname], value))
+
+	return conditions
+
+
+def iterate_in_pages(doctype, filters=None, fields=None, page_length=None):
+	"""Yield records of `doctype` matching `filters` as lists of at most `page_length` rows.
+
+	Records are ordered by `creation, name` and fetched with keyset pagination: each page
+	continues after the last row of the previous one instead of using an OFFSET, so every
+	query is an index range scan and memory stays flat however large the result set is.
+	Rows updated while iterating (e.g. their status changed) do not shift later pages.
+	"""
+	page_length = page_length or DEFAULT_PAGE_LENGTH
+	fields = list(fields or ["name"])
+	for fieldname in ("name", "creation"):
+		if fieldname not in fields:
+			fields.append(fieldname)
+
+	table = frappe.qb.DocType(doctype)
+	conditions = get_filter_conditions(table, filters)
+	last = None
+
+	while True:
+		query = frappe.qb.from_(table).select(*(table[fieldname] for fieldname in fields))
+		for condition in conditions:
+			query = query.where(condition)
+
+		if last:
+			query = query.where(
+				(table.creation > last.creation)
+				| ((table.creation == last.creation) & (table.name > last.name))
+			)
+
+		page = query.orderby(table.creation).orderby(table.name).limit(page_length).run(as_dict=True)
+		if not page:
+			return
+
+		yield page
+
+		if len(page) < page_length:
+			return
+
+		last = page[-1]
+
+
+def get_gateway_fields(data):
+	"""Project the hot attributes of an Integration Request's `data` into its gateway columns"""
+	if isinstance(data, str):
+		try:
+			data = json.loads(data)
+		except ValueError:
+			return {}
+
+	if not isinstance(data, dict):
+		return {}
+
+	notes = data.get("notes") if isinstance(data.get("notes"), dict) else {}
+	fields = {
+		"gateway_amount": flt(data.get("amount") or data.get("request_amount")),
+		"gateway_currency": data.get("currency"),
+		"is_sandbox": cint(data.get("use_sandbox") or notes.get("use_sandbox")),
+	}
+
+	for key in GATEWAY_PAYMENT_ID_KEYS:
+		if data.get(key):
+			fields["gateway_payment_id"] = data[key]
+			break
+
+	return fields
+
+
+def set_integration_request_gateway_fields(doc, method=None):
+	"""Keep the gateway columns of an Integration Request in sync with its `data`.
+
+	Hooked on validate, so it runs for both `create_request_log` and `update_status`.
+	"""
+	if doc.data:
+		doc.update(get_gateway_fields(doc.data))
+
+
+def get_gateway_amount(amount):
+	"""Return `amount` as an int when it is a whole number, as gateways expect for minor units"""
+	amount = flt(amount)
+	return int(amount) if amount.is_integer() else amount
+
+
+def bulk_create_request_logs(logs, service_name, integration_type=None):
+	"""Insert one Integration Request per entry of `logs` with a single query.
+
+	Each entry is a dict with the `data`, `name` and optional `error` / `output` arguments of
+	`create_request_log`. Document hooks don't run, so the gateway columns are set here.
+	"""
+	if not logs:
+		return []
+
+	fields = [
+		"name",
+		"creation",
+		"modified",
+		"owner",
+		"modified_by",
+		"docstatus",
+		"status",
+		"integration_request_service",
+		"data",
+		"output",
+		"error",
+		"reference_doctype",
+		"reference_docname",
+		"gateway_payment_id",
+		"gateway_amount",
+		"gateway_currency",
+		"is_sandbox",
+	]
+	if integration_type:
+		fields.append("integration_type")
+
+	timestamp = now_datetime()
+	values = []
+
+	for log in logs:
+		log = frappe._dict(log)
+		data = json.loads(log.data) if isinstance(log.data, str) else log.data
+		row = frappe._dict(
+			name=log.name or frappe.generate_hash(length=10),
+			creation=timestamp,
+			modified=timestamp,
+			owner=frappe.session.user,
+			modified_by=frappe.session.user,
+			docstatus=0,
+			status="Queued",
+			integration_request_service=service_name,
+			data=as_json(data),
+			output=as_json(log.output),
+			error=as_json(log.error),
+			reference_doctype=data.get("reference_doctype"),
+			reference_docname=data.get("reference_docname"),
+			integration_type=integration_type,
+			**get_gateway_fields(data),
+		)
+		values.append(tuple(row.get(field) for field in fields))
+
+	frappe.db.bulk_insert("Integration Request", fields, values)
+	return [row[0] for row in values]
+
+
+def as_json(value):
+	if value is None or isinstance(value, str):
+		return value
+
+	return json.dumps(value, default=json_handler)
@@ -0,0 +1,201 @@
+"""
+Fast acknowledgement of gateway webhooks.
+
+Notifications are authenticated locally (signature checks only), stored as Integration
+Requests with `webhook_status` "Pending" and acknowledged right away. The verification
+round trips to the gateway happen later in `process_pending_webhooks`, which runs from the
+scheduler and verifies all pending notifications that share a subscription or profile
+with a single call.
+
+Gateways retry their webhooks, so every delivery is first checked against the event ids
+seen over the last `payments_webhook_dedupe_ttl` seconds (a Redis key per event) and
+duplicates are dropped before anything is written or enqueued.
+
+Site config:
+	payments_webhook_batch_size: pending notifications leased per batch (default 100)
+	payments_webhook_workers: concurrent verification calls (default 8)
+	payments_webhook_dedupe_ttl: seconds an event id is remembered (default 7 days)
+"""
+
+import json
+from collections import defaultdict
+from concurrent.futures import as_completed
+
+import frappe
+from frappe.utils import cint, now_datetime
+
+from payments.utils.utils import (
+	claim_integration_requests,
+	get_lease_owner,
+	get_site_thread_pool,
+	iterate_in_pages,
+)
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_WORKERS = 8
+DEFAULT_DEDUPE_TTL = 7 * 24 * 60 * 60
+
+
+def claim_webhook_event(service, event_id):
+	"""Return True for the first delivery of an event and False for its retries.
+
+	Events without an id can't be told apart and are always processed.
+	"""
+	if not event_id:
+		return True
+
+	ttl = cint(frappe.conf.payments_webhook_dedupe_ttl) or DEFAULT_DEDUPE_TTL
+	return bool(frappe.cache().set(get_webhook_event_key(service, event_id), 1, nx=True, ex=ttl))
+
+
+def release_webhook_event(service, event_id):
+	"""Forget an event whose processing failed, so that the gateway's retry goes through"""
+	if event_id:
+		frappe.cache().delete(get_webhook_event_key(service, event_id))
+
+
+def get_webhook_event_key(service, event_id):
+	return frappe.cache().make_key(f"payments_webhook_event:{service}:{event_id}")
+
+
+def persist_webhook(service, data, event_id=None):
+	"""Store a notification whose verification is deferred and return its Integration Request.
+
+	Returns None without storing anything when `event_id` was already received.
+	"""
+	if not claim_webhook_event(service, event_id):
+		return
+
+	try:
+		integration_request = frappe.get_doc(
+			{
+				"doctype": "Integration Request",
+				"integration_request_service": service,
+				"request_description": "Subscription Notification",
+				"is_remote_request": 1,
+				"status": "Queued",
+				"webhook_status": "Pending",
+				"data": data if isinstance(data, str) else json.dumps(data),
+			}
+		).insert(ignore_permissions=True)
+		frappe.db.commit()
+	except Exception:
+		release_webhook_event(service, event_id)
+		raise
+
+	return integration_request
+
+
+def has_pending_webhooks(service):
+	return bool(
+		frappe.db.exists(
+			"Integration Request", {"integration_request_service": service, "webhook_status": "Pending"}
+		)
+	)
+
+
+def process_pending_webhooks(service, get_group_key, verify, handler):
+	"""Verify the pending notifications of `service` and hand the genuine ones to `handler`.
+
+	Notifications are leased in batches and grouped by `get_group_key(data)`, typically the
+	subscription or profile id. `verify(group_key)` is then called once per group from a
+	pool of worker threads, so it must only talk to the gateway and return a truthy value
+	for genuine notifications. Notifications without a group key or that fail verification
+	are rejected. When `verify` raises, the group stays pending and is retried once its
+	lease expires.
+
+	`handler` is the dotted path of the method called with the `doctype` and `docname` of
+	every verified notification, from background jobs enqueued in the order the
+	notifications of the group were received. Notifications are marked as verified once
+	`handler` returns; when it fails they stay pending and are verified and handled again
+	once their lease expires.
+	"""
+	owner = get_lease_owner()
+	filters = {"integration_request_service": service, "webhook_status": "Pending"}
+	batch_size = cint(frappe.conf.payments_webhook_batch_size) or DEFAULT_BATCH_SIZE
+	workers = cint(frappe.conf.payments_webhook_workers) or DEFAULT_WORKERS
+
+	with get_site_thread_pool(workers) as executor:
+		for page in iterate_in_pages(
+			"Integration Request", filters=filters, fields=["name", "data"], page_length=batch_size
+		):
+			claimed = set(
+				claim_integration_requests(
+					{**filters, "name": ("in", [row.name for row in page])},
+					limit=len(page),
+					owner=owner,
+				)
+			)
+
+			groups = defaultdict(list)
+			for row in page:
+				if row.name in claimed:
+					groups[get_webhook_group_key(get_group_key, row)].append(row.name)
+
+			if None in groups:
+				set_webhook_status(groups.pop(None), "Rejected")
+
+			futures = {executor.submit(verify, key): names for key, names in groups.items()}
+			for future in as_completed(futures):
+				names = futures[future]
+				try:
+					verified = future.result()
+				except Exception:
+					frappe.log_error(title=f"{service} webhook verification failed")
+					continue
+
+				if not verified:
+					set_webhook_status(names, "Rejected")
+					continue
+
+				for name in names:
+					frappe.enqueue(
+						method="payments.utils.webhooks.handle_verified_webhook",
+						queue="long",
+						timeout=600,
+						is_async=True,
+						now=frappe.flags.in_test,
+						handler=handler,
+						doctype="Integration Request",
+						docname=name,
+					)
+
+
+def handle_verified_webhook(handler, doctype, docname):
+	# a job queued for longer than the lease may find the notification handled already
+	if frappe.db.get_value(doctype, docname, "webhook_status") != "Pending":
+		return
+
+	try:
+		frappe.get_attr(handler)(doctype=doctype, docname=docname)
+	except Exception:
+		frappe.db.rollback()
+		frappe.log_error(title=f"Webhook {docname} could not be handled")
+		return
+
+	set_webhook_status([docname], "Verified")
+
+
+def get_webhook_group_key(get_group_key, row):
+	try:
+		return get_group_key(json.loads(row.data))
+	except Exception:
+		return None
+
+
+def set_webhook_status(names, webhook_status):
+	"""Settle leased notifications; rejected ones are marked as failed"""
+	IntegrationRequest = frappe.qb.DocType("Integration Request")
+	query = (
+		frappe.qb.update(IntegrationRequest)
+		.set(IntegrationRequest.webhook_status, webhook_status)
+		.set(IntegrationRequest.lease_owner, None)
+		.set(IntegrationRequest.lease_expires_on, None)
+		.set(IntegrationRequest.modified, now_datetime())
+		.where(IntegrationRequest.name.isin(names))
+	)
+	if webhook_status == "Rejected":
+		query = query.set(IntegrationRequest.status, "Failed")
+
+	query.run()
+	frappe.db.commit()